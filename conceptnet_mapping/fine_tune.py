@@ -1,13 +1,17 @@
 import csv
+import hashlib
+import json
 import logging
+import os
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Union
 
-import torch
+import numpy as np
 from sklearn.metrics import accuracy_score
 from torch.utils.data import Dataset
 from transformers import RobertaForSequenceClassification, Trainer, TrainingArguments, RobertaConfig
-from transformers import RobertaTokenizerFast
+from transformers import RobertaTokenizerFast, DataCollatorWithPadding
+from transformers.trainer_pt_utils import LengthGroupedSampler
 
 from app_config import WORKING_DIR
 
@@ -22,27 +26,49 @@ MODEL_NAME = "roberta-base"
 TRAIN_FILE = "/path/to/your/training_file.csv"
 DEV_FILE = "/path/to/your/dev_file.csv"
 
+# Samples are truncated to this many tokens
+MAX_LENGTH = 512
 
-class MappingDataset(Dataset):
-    def __init__(self, encodings, labels, possible_labels):
-        self.encodings = encodings
-        self.labels = labels
-
-        self.possible_labels = possible_labels
+# Tokenized splits, reused until the split file or the tokenizer changes
+TOKENIZED_DIR = f"{WORKING_DIR}/conceptnet_mapping_tokenized"
 
-    def __getitem__(self, idx):
-        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
-        item["labels"] = torch.tensor(self.labels[idx], dtype=torch.float)
 
-        # true_label = self.labels[idx]
-        # for label in self.possible_labels:
-        #     item[label] = torch.tensor(float(true_label == label))
+# Token IDs of all examples, concatenated without padding, in a memory-mapped array; example i is
+# input_ids[offsets[i]:offsets[i + 1]]. Batches are padded by the data collator to their longest example.
+class MappingDataset(Dataset):
+    def __init__(self, directory: Union[str, Path]):
+        directory = Path(directory)
+        self.input_ids = np.load(directory / "input_ids.npy", mmap_mode="r")
+        self.offsets = np.load(directory / "offsets.npy")
+        self.labels = np.load(directory / "labels.npy")
+        with open(directory / "possible_labels.json") as f:
+            self.possible_labels = json.load(f)
 
-        return item
+    def __getitem__(self, idx):
+        input_ids = self.input_ids[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+        return {
+            "input_ids": input_ids,
+            "attention_mask": [1] * len(input_ids),
+            "labels": self.labels[idx].tolist(),
+        }
 
     def __len__(self):
         return len(self.labels)
 
+    @property
+    def lengths(self) -> List[int]:
+        return np.diff(self.offsets).tolist()
+
+
+# Groups training batches by the lengths of MappingDataset instead of the Trainer's default, which gets every example
+# of the memory-mapped dataset to measure it
+class LengthGroupedTrainer(Trainer):
+    def _get_train_sampler(self):
+        if not self.args.group_by_length or self.args.world_size > 1:
+            return super()._get_train_sampler()
+        return LengthGroupedSampler(dataset=self.train_dataset, batch_size=self.args.train_batch_size,
+                                    lengths=self.train_dataset.lengths)
+
 
 def compute_metrics(pred):
     labels = pred.label_ids.argmax(-1)
@@ -82,27 +108,64 @@ def read_data_split(filename: Union[str, Path], sep_token: str):
     return texts, labels, possible_labels
 
 
+def get_tokenizer_fingerprint(tokenizer) -> str:
+    # class and the full definition of a fast tokenizer (vocabulary, merges, normalization),
+    # or the vocabulary of a slow one
+    if getattr(tokenizer, "is_fast", False):
+        definition = tokenizer.backend_tokenizer.to_str()
+    else:
+        definition = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    h = hashlib.sha1(f"{type(tokenizer).__name__}\0{definition}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def get_tokenized_dir(filename: Union[str, Path], tokenizer) -> Path:
+    stat = os.stat(filename)
+    h = hashlib.sha1(f"{Path(filename).resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}\0{MODEL_NAME}\0"
+                     f"{get_tokenizer_fingerprint(tokenizer)}\0{MAX_LENGTH}".encode("utf-8"))
+    return Path(TOKENIZED_DIR) / f"{Path(filename).stem}-{h.hexdigest()[:16]}"
+
+
+def write_tokenized_split(directory: Path, encodings, labels: List[List[float]], possible_labels: List[str]):
+    tmp_dir = directory.with_name(directory.name + ".tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    lengths = [len(ids) for ids in encodings["input_ids"]]
+    np.save(tmp_dir / "input_ids.npy", np.fromiter((t for ids in encodings["input_ids"] for t in ids),
+                                                   dtype=np.int32, count=sum(lengths)))
+    np.save(tmp_dir / "offsets.npy", np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    np.save(tmp_dir / "labels.npy", np.array(labels, dtype=np.float32))
+    with open(tmp_dir / "possible_labels.json", "w") as f:
+        json.dump(possible_labels, f)
+    tmp_dir.rename(directory)
+
+
+def load_split(filename: Union[str, Path], tokenizer) -> MappingDataset:
+    directory = get_tokenized_dir(filename, tokenizer)
+    if directory.exists():
+        logger.info(f"Load tokenized \"{filename}\" from \"{directory}\"")
+    else:
+        texts, labels, possible_labels = read_data_split(filename, sep_token=tokenizer.sep_token)
+        logger.info(f"Tokenize {len(texts):,} samples of \"{filename}\"")
+        write_tokenized_split(directory, tokenizer(texts, truncation=True, max_length=MAX_LENGTH), labels, possible_labels)
+    return MappingDataset(directory)
+
+
 def main():
     logger.info(f"Load Tokenizer \"{MODEL_NAME}\"")
     tokenizer = RobertaTokenizerFast.from_pretrained(MODEL_NAME)
 
     logger.info(f"Read data")
-    train_texts, train_labels, possible_labels = read_data_split(TRAIN_FILE, sep_token=tokenizer.sep_token)
-    dev_texts, dev_labels, dev_possible_labels = read_data_split(DEV_FILE, sep_token=tokenizer.sep_token)
+    train_dataset = load_split(TRAIN_FILE, tokenizer)
+    dev_dataset = load_split(DEV_FILE, tokenizer)
+    possible_labels = train_dataset.possible_labels
+    dev_possible_labels = dev_dataset.possible_labels
 
     assert len(possible_labels) == len(dev_possible_labels) and all(
         a == b for a, b in zip(possible_labels, dev_possible_labels))
 
     # possible_labels = list(set(train_labels))
     logger.info(possible_labels)
-
-    logger.info(f"Tokenize {len(train_texts):,} training samples")
-    train_encodings = tokenizer(train_texts, truncation=True, padding=True)
-    logger.info(f"Tokenize {len(dev_texts):,} development samples")
-    dev_encodings = tokenizer(dev_texts, truncation=True, padding=True)
-
-    train_dataset = MappingDataset(train_encodings, train_labels, possible_labels)
-    dev_dataset = MappingDataset(dev_encodings, dev_labels, possible_labels)
+    logger.info(f"{len(train_dataset):,} training samples, {len(dev_dataset):,} development samples")
 
     logger.info("Create TrainingArguments")
     training_args = TrainingArguments(
@@ -118,6 +181,7 @@ def main():
         evaluation_strategy="steps",
         eval_steps=1000,
         save_steps=1000,
+        group_by_length=True,  # batches of examples of similar length, padded by the data collator
     )
 
     logger.info(f"Load model \"{MODEL_NAME}\"")
@@ -128,11 +192,12 @@ def main():
     model = RobertaForSequenceClassification.from_pretrained(MODEL_NAME, config=config)
 
     logger.info("Start training")
-    trainer = Trainer(
+    trainer = LengthGroupedTrainer(
         model=model,  # the instantiated 🤗 Transformers model to be trained
         args=training_args,  # training arguments, defined above
         train_dataset=train_dataset,  # training dataset
         eval_dataset=dev_dataset,  # evaluation dataset
+        data_collator=DataCollatorWithPadding(tokenizer),  # pads each batch to its longest example
         compute_metrics=compute_metrics,  # the callback that computes metrics of interest
     )
 
@@ -1,15 +1,21 @@
 import argparse
 import logging
-from typing import List
+from typing import List, Tuple
 
 import pymongo
-import torch
 from bson import ObjectId
 from pymongo import UpdateOne
 from transformers import RobertaForSequenceClassification
 from transformers import RobertaTokenizerFast
 
 from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from conceptnet_mapping.rules import rewrite_relations, postprocess_objects
+from inference_runtime.batching import TOKEN_BUDGET, MAX_BATCH_SIZE, run_batched
+from inference_runtime.model_server import SOCKET_FILE, ModelClient
+from inference_runtime.result_cache import add_cache_args, open_cache
+from inference_runtime.runtime import add_runtime_args, setup_device, load_model, get_model_key, \
+    get_model_fingerprint
+from ranking.assertion_resolver import AssertionResolver
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -24,21 +30,12 @@ ASSERTIONS_COL = ASCENT_DB[f"openie_assertions"]
 TRIPLES_COL = ASCENT_DB[f"grouped_triples"]
 CLUSTERS_COL = ASCENT_DB[f"clustered_triples"]
 
+# Only the fields used by the rules
+ASSERTION_RESOLVER = AssertionResolver(TRIPLES_COL, ASSERTIONS_COL, ["object", "source.tags", "source.positions"])
 
-def get_openie_assertions(cluster):
-    triples = TRIPLES_COL.find({
-        "_id": {"$in": cluster["triples"]}
-    })
-
-    assertion_ids = []
-    for t in triples:
-        assertion_ids.extend(t["assertions"])
-
-    assertions = ASSERTIONS_COL.find({
-        "_id": {"$in": assertion_ids}
-    })
-
-    return assertions
+ADJECTIVE_TAGS = {"JJ", "JJR", "JJS"}
+NOUN_TAGS = {"NN", "NNS"}
+PASSIVE_VERB_TAGS = {"VBN"}
 
 
 def get_object_tags(assertion):
@@ -47,205 +44,100 @@ def get_object_tags(assertion):
     return assertion["source"]["tags"][start:end]
 
 
-def assertion_has_adjective_object(assertion):
-    tags = ["JJ", "JJR", "JJS"]
-    object_tags = set(get_object_tags(assertion))
-    for tag in tags:
-        if tag in object_tags:
-            return True
-    return False
-
-
-def assertion_has_passive_verb_object(assertion):
-    tags = ["VBN"]
-    object_tags = set(get_object_tags(assertion))
-    for tag in tags:
-        if tag in object_tags:
-            return True
-    return False
-
-
-def assertion_has_noun_object(assertion):
-    tags = ["NN", "NNS"]
-    object_tags = set(get_object_tags(assertion))
-    for tag in tags:
-        if tag in object_tags:
-            return True
-    return False
-
-
-def has_lot_of_adjectives(cluster, assertions):
-    assertions = [a for a in assertions if a["object"] == cluster["object"]]
-    has_adj_obj = [assertion_has_adjective_object(a) for a in assertions]
-    if sum(has_adj_obj) / len(has_adj_obj) < 0.5:
-        return False
-    return True
+def get_object_pos_ratios(cluster, assertions) -> Tuple[float, float, float]:
+    # Shares of the assertions with the cluster's object whose object has an adjective, a noun and a passive verb,
+    # in one pass.
+    num_assertions = num_adj = num_noun = num_pass = 0
+    for a in assertions:
+        if a["object"] != cluster["object"]:
+            continue
+        object_tags = set(get_object_tags(a))
+        num_assertions += 1
+        num_adj += not ADJECTIVE_TAGS.isdisjoint(object_tags)
+        num_noun += not NOUN_TAGS.isdisjoint(object_tags)
+        num_pass += not PASSIVE_VERB_TAGS.isdisjoint(object_tags)
 
-
-def has_lot_of_nouns(cluster, assertions):
-    assertions = [a for a in assertions if a["object"] == cluster["object"]]
-    has_noun_obj = [assertion_has_noun_object(a) for a in assertions]
-    if sum(has_noun_obj) / len(has_noun_obj) < 0.5:
-        return False
-    return True
-
-
-def has_lot_passive_verb_object(cluster, assertions):
-    assertions = [a for a in assertions if a["object"] == cluster["object"]]
-    has_pass_obj = [assertion_has_passive_verb_object(a) for a in assertions]
-    if sum(has_pass_obj) / len(has_pass_obj) < 0.5:
-        return False
-    return True
+    if num_assertions == 0:
+        return 0.0, 0.0, 0.0
+    return num_adj / num_assertions, num_noun / num_assertions, num_pass / num_assertions
 
 
 def preprocess_triples(rows, sep_token):
     return [f"{row['subject']} {sep_token} {row['predicate']} {row['object']}" for row in rows]
 
 
-def predict_relation(rows, model, tokenizer, device, batch_size=64) -> List[str]:
-    num_batches = len(rows) / batch_size
-    if int(num_batches) != num_batches:
-        num_batches = int(num_batches) + 1
-    num_batches = int(num_batches)
+def get_relation_input_text(row) -> str:
+    return f"{row['subject']}\t{row['predicate']}\t{row['object']}"
 
-    logger.info(f"Batch size: {batch_size}. Number of batches: {num_batches:,}")
 
-    # Predictive model
-    results = []
-    for i in range(0, len(rows), batch_size):
-        # logger.info(f"Batch {int(i / batch_size):,} / {num_batches:,}")
-        batch_of_rows = rows[i:(i + batch_size)]
-        inputs = tokenizer(preprocess_triples(batch_of_rows, tokenizer.sep_token), truncation=True, padding=True,
-                           return_tensors="pt").to(device)
-        outputs = model(**inputs)
-        results.extend(outputs[0].softmax(1).argmax(-1).tolist())
+def classify_relations(rows, model, tokenizer, device, max_batch_size=MAX_BATCH_SIZE,
+                       token_budget=TOKEN_BUDGET) -> List[str]:
+    logger.info(f"Max. batch size: {max_batch_size}. Token budget per batch: {token_budget:,}")
 
-    relations = [model.config.id2label[idx] for idx in results]
+    # Predictive model, on length-sorted batches; argmax of the logits is argmax of the softmax
+    def forward(inputs):
+        outputs = model(**inputs.to(device))
+        return outputs[0].argmax(-1).tolist()
 
-    # Rules
-    for i in range(len(relations)):
-        relation = relations[i]
-        row = rows[i]
+    results = run_batched(preprocess_triples(rows, tokenizer.sep_token), tokenizer, forward, name="triples",
+                          token_budget=token_budget, max_batch_size=max_batch_size)
 
-        if relation in {"/r/IsA"}:
-            assertions = list(get_openie_assertions(row))
-            if has_lot_of_adjectives(row, assertions) and not has_lot_of_nouns(row, assertions):
-                relations[i] = "/r/HasProperty"
-            elif has_lot_passive_verb_object(row, assertions) and not has_lot_of_nouns(row, assertions):
-                relations[i] = "/r/ReceivesAction"
-
-        if relation == "/r/HasProperty" and row["predicate"] != "be":
-            relations[i] = "/r/ReceivesAction"
+    return [model.config.id2label[idx] for idx in results]
 
-        if row["predicate"] == "symbolize" or row["object"].startswith("a symbol of ") or row["object"].startswith(
-                "symbol of ") or row["object"].startswith("the symbol of "):
-            relations[i] = "/r/SymbolOf"
 
-        if row["object"].startswith("an emblem of ") or row["object"].startswith(
-                "emblem of ") or row["object"].startswith("the emblem of "):
-            relations[i] = "/r/SymbolOf"
+def rewrite_isa_relations(rows, relations) -> List[str]:
+    relations = list(relations)
 
-        if row["predicate"] in {"need", "require"}:
-            relations[i] = "/r/HasPrerequisite"
+    # Assertions of the IsA rows, resolved in batches
+    isa_indices = [i for i, relation in enumerate(relations) if relation in {"/r/IsA"}]
+    logger.info(f"Fetch assertions of {len(isa_indices):,} IsA rows")
+    isa_rows = [rows[i] for i in isa_indices]
 
-        if row["predicate"] in {"contain", "include"}:
-            relations[i] = "/r/HasA"
-
-        if row["predicate"] in {"be related to", "relate to"}:
-            relations[i] = "/r/RelatedTo"
+    for i, (row, assertions) in zip(isa_indices, ASSERTION_RESOLVER.iter_cluster_assertions(isa_rows)):
+        adj_ratio, noun_ratio, pass_ratio = get_object_pos_ratios(row, assertions)
+        if adj_ratio >= 0.5 and not noun_ratio >= 0.5:
+            relations[i] = "/r/HasProperty"
+        elif pass_ratio >= 0.5 and not noun_ratio >= 0.5:
+            relations[i] = "/r/ReceivesAction"
+    ASSERTION_RESOLVER.log_stats()
 
     return relations
 
 
-def should_concat_po(predicted_relation, old_pred):
-    if predicted_relation == "/r/CapableOf":
-        if old_pred not in {"be capable of", "can", "be able to"}:
-            return True
-    # elif predicted_relation in {"/r/UsedFor"}:
-    #     return True
-    elif predicted_relation in {"/r/HasProperty", "/r/IsA", "/r/ReceivesAction"}:
-        if old_pred != "be":
-            return True
-
-    return False
-
+def apply_relation_rules(rows, relations) -> List[str]:
+    isa_relations = rewrite_isa_relations(rows, relations)
+    return rewrite_relations(list(relations), isa_relations, [row["predicate"] for row in rows],
+                             [row["object"] for row in rows])
 
-def postprocess_object(row, predicted_relation) -> str:
-    new_obj = row["object"]
 
-    old_obj = row["object"]
-    old_pred = row["predicate"]
-
-    if should_concat_po(predicted_relation, old_pred):
-        new_obj = old_pred + " " + old_obj
-
-    if predicted_relation in {"/r/HasProperty", "/r/IsA", "/r/ReceivesAction"}:  # , "/r/UsedFor"}:
-        if old_pred.startswith("be "):
-            new_obj = old_pred[len("be "):] + " " + old_obj
-
-    elif predicted_relation == "/r/PartOf" and old_obj.startswith("a part of "):
-        new_obj = old_obj[len("a part of "):]
-
-    elif predicted_relation == "/r/PartOf" and old_obj.startswith("part of "):
-        new_obj = old_obj[len("part of "):]
-
-    elif predicted_relation == "/r/PartOf" and old_obj.startswith("the part of "):
-        new_obj = old_obj[len("the part of "):]
-
-    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("a symbol of "):
-        new_obj = old_obj[len("a symbol of "):]
-
-    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("the symbol of "):
-        new_obj = old_obj[len("the symbol of "):]
-
-    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("symbol of "):
-        new_obj = old_obj[len("symbol of "):]
-
-    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("an emblem of "):
-        new_obj = old_obj[len("an emblem of"):]
-
-    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("emblem of "):
-        new_obj = old_obj[len("emblem of"):]
-
-    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("the emblem of "):
-        new_obj = old_obj[len("the emblem of"):]
-
-    elif predicted_relation == "/r/UsedFor":
-        old_pred_toks: List[str] = old_pred.split()
-        if "to" in old_pred_toks:
-            idx = old_pred_toks.index("to")
-            if idx < len(old_pred_toks) - 1:
-                new_obj = " ".join(old_pred_toks[(idx + 1):]) + " " + old_obj
-
-    elif predicted_relation == "/r/Desires":
-        old_pred_toks: List[str] = old_pred.split()
-        if "to" in old_pred_toks:
-            idx = old_pred_toks.index("to")
-            if idx < len(old_pred_toks) - 1:
-                new_obj = " ".join(old_pred_toks[(idx + 1):]) + " " + old_obj
-
-    new_obj = new_obj.replace("n’t", "not")
-    new_obj = new_obj.replace("n't", "not")
-
-    return new_obj
+def predict_relation(rows, model, tokenizer, device, max_batch_size=MAX_BATCH_SIZE,
+                     token_budget=TOKEN_BUDGET) -> List[str]:
+    relations = classify_relations(rows, model, tokenizer, device, max_batch_size, token_budget)
+    return apply_relation_rules(rows, relations)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--gpu", type=int, required=True)
-    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--gpu", type=int, help="Same as --device cuda:<gpu>")
+    parser.add_argument("--model", type=str, help="Fine-tuned relation classifier; not needed with --server")
     parser.add_argument("--batch_id", type=int, required=True)
     parser.add_argument("--num_batches", type=int, required=True)
     parser.add_argument("--id_file", type=str, required=True)
+    parser.add_argument("--max_batch_size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--token_budget", type=int, default=TOKEN_BUDGET, help="Max. padded tokens per batch")
+    add_runtime_args(parser)
+    parser.add_argument("--server", type=str, nargs="?", const=SOCKET_FILE,
+                        help="Score on the model server (inference_runtime.model_server) listening on this socket "
+                             "instead of loading the model")
+    add_cache_args(parser)
 
     args = parser.parse_args()
 
-    assert args.gpu >= 0
+    assert args.gpu is None or args.gpu >= 0
+    assert args.server is not None or args.model is not None, "give --model or --server"
 
     model_path = args.model
 
-    device = torch.device(f"cuda:{args.gpu}")
-
     # Load data from Mongo DB
     logger.info(f"Read cluster ids from \"{args.id_file}\"")
     with open(args.id_file) as f:
@@ -270,23 +162,47 @@ def main():
     assert len(clusters) == len(process_ids)
     logger.info(f"Got {len(clusters):,} clusters")
 
-    # load model and tokenizer
-    # logger.info(f"Load tokenizer from \"{model_path}\"")
-    # tokenizer = RobertaTokenizerFast.from_pretrained(model_path)
-    tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
-
-    logger.info(f"Load model from \"{model_path}\"")
-    model = RobertaForSequenceClassification.from_pretrained(model_path)
-    model.to(device)
-
-    # inference
-    logger.info("Predict relations")
-    predicted_relations = predict_relation(clusters, model=model, tokenizer=tokenizer, device=device)
+    client = None
+    if args.server is not None:
+        client = ModelClient(args.server)
+        model_key, fingerprint = client.model_info("relation")
+    else:
+        model_key = get_model_key("relation", model_path, args.quantize)
+        fingerprint = get_model_fingerprint(model_path)
+    cache = open_cache(args, model_key, fingerprint)
+
+    def classify(rows):
+        if client is not None:
+            logger.info("Predict relations on the model server")
+            return client.score("relation", [{k: row[k] for k in ["subject", "predicate", "object"]}
+                                             for row in rows])
+
+        device = setup_device(f"cuda:{args.gpu}" if args.gpu is not None else args.device, args.num_threads)
+
+        # load model and tokenizer
+        # logger.info(f"Load tokenizer from \"{model_path}\"")
+        # tokenizer = RobertaTokenizerFast.from_pretrained(model_path)
+        tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
+
+        model = load_model(RobertaForSequenceClassification, model_path, device, args.quantize)
+
+        # inference
+        logger.info("Predict relations")
+        return classify_relations(rows, model=model, tokenizer=tokenizer, device=device,
+                                  max_batch_size=args.max_batch_size, token_budget=args.token_budget)
+
+    # the rules need the database and are applied to cached classifier labels too
+    if cache is not None:
+        relations = cache.score(model_key, clusters, classify, key=get_relation_input_text)
+        cache.close()
+    else:
+        relations = classify(clusters)
+    predicted_relations = apply_relation_rules(clusters, relations)
 
     # new object
     logger.info("Postprocess objects")
-    predicted_objects = [postprocess_object(cluster, relation) for cluster, relation in
-                         zip(clusters, predicted_relations)]
+    predicted_objects = postprocess_objects(predicted_relations, [cluster["predicate"] for cluster in clusters],
+                                            [cluster["object"] for cluster in clusters])
 
     # write new results
     queries = []
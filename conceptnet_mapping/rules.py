@@ -0,0 +1,192 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Lexical rewrite rules of conceptnet_mapping.inference as data, evaluated column-wise over batches of rows.
+# tests/test_conceptnet_rules.py compares them with the former row-by-row rules.
+#
+# Columns are Arrow string arrays and the string tests and rewrites are pyarrow.compute kernels; the masks and the
+# rule chosen for each row are numpy arrays. Arrow strings keep trailing "\0", which the values of this pipeline can
+# have and fixed-width numpy strings ("<U") would drop.
+
+BATCH_SIZE = 100_000
+
+# Applied in this order after the IsA rule; a later matching rule overrides an earlier one. A rule matches if
+# all of its conditions hold:
+#   model_relation: the classifier label (before any rule) is this relation
+#   predicate_not: the predicate is not this one
+#   predicates: the predicate is one of these
+#   object_prefixes: the object starts with one of these
+RELATION_RULES = [
+    ({"model_relation": "/r/HasProperty", "predicate_not": "be"}, "/r/ReceivesAction"),
+    ({"predicates": ["symbolize"]}, "/r/SymbolOf"),
+    ({"object_prefixes": ["a symbol of ", "symbol of ", "the symbol of "]}, "/r/SymbolOf"),
+    ({"object_prefixes": ["an emblem of ", "emblem of ", "the emblem of "]}, "/r/SymbolOf"),
+    ({"predicates": ["need", "require"]}, "/r/HasPrerequisite"),
+    ({"predicates": ["contain", "include"]}, "/r/HasA"),
+    ({"predicates": ["be related to", "relate to"]}, "/r/RelatedTo"),
+]
+
+# Relations whose object takes the predicate in front of it, unless the predicate is one of these
+PREDICATE_CONCAT_RULES = {
+    "/r/CapableOf": ["be capable of", "can", "be able to"],
+    "/r/HasProperty": ["be"],
+    "/r/IsA": ["be"],
+    "/r/ReceivesAction": ["be"],
+}
+
+# Relations whose object takes "be ..." predicates without the "be"
+BE_RELATIONS = ["/r/HasProperty", "/r/IsA", "/r/ReceivesAction"]
+
+# (prefix, number of characters removed from the object); the first matching prefix applies. The emblem rules
+# keep the space after "of", as the row-by-row rules always did.
+OBJECT_PREFIX_RULES = {
+    "/r/PartOf": [("a part of ", 10), ("part of ", 8), ("the part of ", 12)],
+    "/r/SymbolOf": [("a symbol of ", 12), ("the symbol of ", 14), ("symbol of ", 10),
+                    ("an emblem of ", 12), ("emblem of ", 9), ("the emblem of ", 13)],
+}
+
+# Relations whose object takes the words after "to" in the predicate in front of it
+TO_RELATIONS = ["/r/UsedFor", "/r/Desires"]
+
+OBJECT_REPLACEMENTS = [("n’t", "not"), ("n't", "not")]
+
+# The characters str.split() splits on (str.isspace())
+WHITESPACE = "[\t\n\x0b\x0c\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]"
+
+# After runs of WHITESPACE became one space: the words after the first "to" token, if there are any
+WORDS_AFTER_TO = r"^ ?(?:[^ ]+ )*?to (?P<words>.+?) ?$"
+
+
+def to_column(values: Sequence[str]) -> pa.Array:
+    return pa.array(values, type=pa.string())
+
+
+def to_mask(mask: pa.Array) -> np.ndarray:
+    return mask.to_numpy(zero_copy_only=False)
+
+
+def is_in(column: pa.Array, values: Sequence[str]) -> np.ndarray:
+    return to_mask(pc.is_in(column, value_set=to_column(values)))
+
+
+def starts_with_any(column: pa.Array, prefixes: Sequence[str]) -> np.ndarray:
+    mask = np.zeros(len(column), dtype=bool)
+    for prefix in prefixes:
+        mask |= to_mask(pc.starts_with(column, prefix))
+    return mask
+
+
+def select(column: pa.Array, mask: np.ndarray) -> pa.Array:
+    return pc.filter(column, pa.array(mask))
+
+
+def join(left, right) -> pa.Array:
+    # left + " " + right, element-wise; either can be a str
+    return pc.binary_join_element_wise(left, right, " ")
+
+
+def rule_mask(conditions: Dict, model_relations: pa.Array, predicates: pa.Array, objects: pa.Array) -> np.ndarray:
+    mask = np.ones(len(predicates), dtype=bool)
+    if "model_relation" in conditions:
+        mask &= to_mask(pc.equal(model_relations, conditions["model_relation"]))
+    if "predicate_not" in conditions:
+        mask &= to_mask(pc.not_equal(predicates, conditions["predicate_not"]))
+    if "predicates" in conditions:
+        mask &= is_in(predicates, conditions["predicates"])
+    if "object_prefixes" in conditions:
+        mask &= starts_with_any(objects, conditions["object_prefixes"])
+    return mask
+
+
+def rewrite_relations(model_relations: List[str], relations: List[str], predicates: List[str],
+                      objects: List[str]) -> List[str]:
+    # relations: after the IsA rule
+    rule_relations = np.array([new_relation for _, new_relation in RELATION_RULES], dtype=object)
+    results = []
+    for start in range(0, len(relations), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        model_column = to_column(model_relations[start:end])
+        predicate_column = to_column(predicates[start:end])
+        object_column = to_column(objects[start:end])
+        # 1 + index of the last matching rule, 0 if none matches
+        choice = np.zeros(len(predicate_column), dtype=np.int16)
+        for i, (conditions, _) in enumerate(RELATION_RULES):
+            choice[rule_mask(conditions, model_column, predicate_column, object_column)] = i + 1
+        new_relations = np.array(relations[start:end], dtype=object)
+        changed = choice > 0
+        new_relations[changed] = rule_relations[choice[changed] - 1]
+        results.extend(new_relations.tolist())
+    return results
+
+
+def words_after_to(predicates: pa.Array) -> pa.Array:
+    # "" if the predicate has no "to" followed by other words
+    tokens = pc.replace_substring_regex(predicates, WHITESPACE + "+", " ")
+    return pc.fill_null(pc.struct_field(pc.extract_regex(tokens, WORDS_AFTER_TO), [0]), "")
+
+
+def postprocess_object_batch(relations: pa.Array, predicates: pa.Array, objects: pa.Array) -> pa.Array:
+    # The rewrite of each row: 0 keeps the object, then the predicate concatenation, the "be ..." predicate, one
+    # per object prefix and the words after "to". Each rewrite runs on its own rows only, and one take puts the
+    # results back in row order.
+    prefix_rules = [(prefix, length) for rules in OBJECT_PREFIX_RULES.values() for prefix, length in rules]
+    concat, be, to = 1, 2, 3 + len(prefix_rules)
+    choice = np.zeros(len(objects), dtype=np.int16)
+
+    rule_relations = sorted(set(PREDICATE_CONCAT_RULES) | set(BE_RELATIONS) | set(OBJECT_PREFIX_RULES)
+                            | set(TO_RELATIONS))
+    relation_ids = pc.fill_null(pc.index_in(relations, value_set=to_column(rule_relations)), -1).to_numpy()
+
+    def rows_of(*names: str) -> np.ndarray:
+        return np.flatnonzero(np.isin(relation_ids, [rule_relations.index(name) for name in names]))
+
+    for relation, keep_predicates in PREDICATE_CONCAT_RULES.items():
+        rows = rows_of(relation)
+        choice[rows[~is_in(pc.take(predicates, rows), keep_predicates)]] = concat
+    rows = rows_of(*BE_RELATIONS)
+    choice[rows[to_mask(pc.starts_with(pc.take(predicates, rows), "be "))]] = be
+    rule = 3
+    for relation, rules in OBJECT_PREFIX_RULES.items():
+        # the first matching prefix of the relation applies
+        rows = rows_of(relation)
+        relation_objects = pc.take(objects, rows)
+        for prefix, _ in rules:
+            mask = to_mask(pc.starts_with(relation_objects, prefix))
+            choice[rows[mask & (choice[rows] == 0)]] = rule
+            rule += 1
+
+    rows = rows_of(*TO_RELATIONS)
+    words = words_after_to(pc.take(predicates, rows))
+    has_words = to_mask(pc.not_equal(words, ""))
+    choice[rows[has_words]] = to
+
+    parts = [select(objects, choice == 0),
+             join(select(predicates, choice == concat), select(objects, choice == concat)),
+             join(pc.utf8_slice_codeunits(select(predicates, choice == be), len("be ")), select(objects, choice == be))]
+    for i, (prefix, length) in enumerate(prefix_rules):
+        rest = pc.utf8_slice_codeunits(select(objects, choice == 3 + i), len(prefix))
+        parts.append(pc.binary_join_element_wise(prefix[length:], rest, ""))
+    parts.append(join(select(words, has_words), select(objects, choice == to)))
+
+    # parts are in the order of a stable sort by choice
+    order = np.argsort(choice, kind="stable")
+    positions = np.empty_like(order)
+    positions[order] = np.arange(len(order))
+    new_objects = pc.take(pa.concat_arrays(parts), positions)
+
+    for old, new in OBJECT_REPLACEMENTS:
+        new_objects = pc.replace_substring(new_objects, old, new)
+    return new_objects
+
+
+def postprocess_objects(relations: List[str], predicates: List[str], objects: List[str]) -> List[str]:
+    results = []
+    for start in range(0, len(relations), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        results.extend(postprocess_object_batch(to_column(relations[start:end]), to_column(predicates[start:end]),
+                                                to_column(objects[start:end])).to_pylist())
+    return results
+
@@ -0,0 +1,122 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Padded tokens per batch: a batch of short inputs holds many inputs, a batch of long ones few
+TOKEN_BUDGET = 16384
+MAX_BATCH_SIZE = 256
+
+# Inputs are tokenized, sorted and batched window by window, so that the next window is tokenized while the
+# model runs on the current one
+WINDOW_SIZE = 16384
+
+# Padded batches waiting for the model
+QUEUE_SIZE = 8
+
+# Seconds between checks of the producer thread whether the consumer has stopped
+PUT_TIMEOUT = 0.1
+
+
+def get_length_buckets(lengths: Sequence[int], token_budget: int = TOKEN_BUDGET,
+                       max_batch_size: int = MAX_BATCH_SIZE) -> List[List[int]]:
+    # Batches of inputs of similar length, each padded to its own longest input
+    lengths = np.asarray(lengths)
+    batches = []
+    batch = []
+    for i in np.argsort(lengths, kind="stable"):
+        # lengths are increasing, so the padded size of the batch is determined by the current input
+        if batch and ((len(batch) + 1) * lengths[i] > token_budget or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_token_lengths(texts: Sequence[str], tokenizer, max_length: Optional[int] = None) -> np.ndarray:
+    # tokens per input including special tokens, capped at the truncation length
+    lengths = np.array([len(ids) for ids in tokenizer(list(texts), add_special_tokens=True)["input_ids"]],
+                       dtype=np.int64)
+    if max_length is not None:
+        lengths = np.minimum(lengths, max_length)
+    return lengths
+
+
+def iter_padded_batches(texts: List[str], tokenizer, token_budget: int = TOKEN_BUDGET,
+                        max_batch_size: int = MAX_BATCH_SIZE,
+                        window_size: int = WINDOW_SIZE) -> Iterator[Tuple[List[int], Any]]:
+    # (positions in texts, padded PyTorch encodings) of length-sorted batches
+    for start in range(0, len(texts), window_size):
+        encodings = tokenizer(texts[start:(start + window_size)], truncation=True)
+        input_ids = encodings["input_ids"]
+        for batch in get_length_buckets([len(ids) for ids in input_ids], token_budget, max_batch_size):
+            features = {key: [values[i] for i in batch] for key, values in encodings.items()}
+            yield [start + i for i in batch], tokenizer.pad(features, return_tensors="pt")
+
+
+def prefetch(iterator: Iterator, queue_size: int = QUEUE_SIZE) -> Iterator:
+    # Runs the iterator in a background thread. If the consumer stops early, e.g. because forward() raised,
+    # the thread stops at its next put.
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_batched(texts: List[str], tokenizer, forward: Callable[[Any], List[Any]], name: str = "inputs",
+                token_budget: int = TOKEN_BUDGET, max_batch_size: int = MAX_BATCH_SIZE) -> List[Any]:
+    # forward() gets the padded encodings of a batch and returns one result per input. Results are returned
+    # in the order of texts.
+    import torch
+
+    results = [None] * len(texts)
+    num_tokens = 0
+    start = time.time()
+    with torch.inference_mode():
+        for indices, encodings in prefetch(iter_padded_batches(texts, tokenizer, token_budget, max_batch_size)):
+            num_tokens += int(encodings["attention_mask"].sum())
+            for i, result in zip(indices, forward(encodings)):
+                results[i] = result
+    elapsed = max(time.time() - start, 1e-9)
+
+    logger.info(f"Processed {len(texts):,} {name} ({num_tokens:,} tokens) in {elapsed:.1f}s: "
+                f"{(len(texts) / elapsed):,.1f} {name}/s, {(num_tokens / elapsed):,.0f} tokens/s")
+    return results
@@ -0,0 +1,92 @@
+import argparse
+import csv
+import logging
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from scipy.stats import spearmanr
+
+from .runtime import setup_device
+from .stages import STAGES, load_stage
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+
+def read_inputs(stage: str, input_file: str, limit: int) -> List[Any]:
+    # relation: CSV file with subject, predicate and object columns; other stages: one sentence per line
+    with open(input_file) as f:
+        if stage == "relation":
+            inputs = [row for row in csv.DictReader(f)]
+        else:
+            inputs = [line.strip() for line in f if line.strip()]
+    return inputs[:limit]
+
+
+def compare_outputs(stage: str, reference: List[Any], outputs: List[Any]) -> Dict[str, float]:
+    if stage == "relation":
+        return {"label agreement": np.mean([r == o for r, o in zip(reference, outputs)])}
+
+    if stage == "sentiment":
+        labels = list(reference[0].keys())
+        ref = np.array([[s[label] for label in labels] for s in reference])
+        out = np.array([[s[label] for label in labels] for s in outputs])
+        return {
+            "label agreement": np.mean(ref.argmax(1) == out.argmax(1)),
+            "mean abs. score difference": np.mean(np.abs(ref - out)),
+        }
+
+    ref = np.array(reference)
+    out = np.array(outputs)
+    return {
+        "spearman": spearmanr(ref, out).correlation,
+        "mean relative difference": np.mean(np.abs(out - ref) / ref),
+    }
+
+
+def run(stage: str, model_path: str, device: str, quantize: bool, inputs: List[Any]) -> List[Any]:
+    score = load_stage(stage, model_path, setup_device(device), quantize)
+    start = time.time()
+    outputs = score(inputs)
+    elapsed = time.time() - start
+    logger.info(f"[{stage}] device: {device}, int8: {quantize}: {len(inputs):,} inputs in {elapsed:.1f}s, "
+                f"{(len(inputs) / elapsed):,.1f} inputs/s")
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Speed of a transformer stage on CPU, with and without int8 quantization, and how much its "
+                    "outputs differ from those of the reference device")
+    parser.add_argument("--stage", type=str, choices=STAGES, required=True)
+    parser.add_argument("--model", type=str, help="Relation classifier (relation stage only)")
+    parser.add_argument("--input_file", type=str, required=True)
+    parser.add_argument("--limit", type=int, default=2000)
+    parser.add_argument("--reference_device", type=str, default="cpu")
+    parser.add_argument("--num_threads", type=int)
+
+    args = parser.parse_args()
+
+    assert args.stage != "relation" or args.model is not None, "--model is required for the relation stage"
+
+    inputs = read_inputs(args.stage, args.input_file, args.limit)
+    logger.info(f"Read {len(inputs):,} inputs from \"{args.input_file}\"")
+    setup_device("cpu", args.num_threads)
+
+    reference = run(args.stage, args.model, args.reference_device, False, inputs)
+    if args.reference_device != "cpu":
+        outputs = run(args.stage, args.model, "cpu", False, inputs)
+        for metric, value in compare_outputs(args.stage, reference, outputs).items():
+            logger.info(f"[{args.stage}] float32 on cpu, {metric}: {value:.5f}")
+
+    outputs = run(args.stage, args.model, "cpu", True, inputs)
+    for metric, value in compare_outputs(args.stage, reference, outputs).items():
+        logger.info(f"[{args.stage}] int8 on cpu, {metric}: {value:.5f}")
+
+
+if __name__ == '__main__':
+    main()
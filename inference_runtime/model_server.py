@@ -0,0 +1,228 @@
+import argparse
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .runtime import add_runtime_args, setup_device, get_model_key, get_model_fingerprint
+from .stages import STAGES, load_stage, get_stage_model_path
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+# The socket and the key live in a directory only the user can access. Connections are authenticated with the
+# key (HMAC challenge of multiprocessing.connection) before anything is unpickled. The key is read from
+# $ASCENT_MODEL_SERVER_KEY if set, otherwise from the key file, which the server creates on its first start.
+SERVER_DIR = Path.home() / ".ascent-model-server"
+SOCKET_FILE = str(SERVER_DIR / "server.sock")
+AUTHKEY_FILE = str(SERVER_DIR / "authkey")
+AUTHKEY_ENV = "ASCENT_MODEL_SERVER_KEY"
+
+# Pending requests of all clients are merged into model calls of up to this many inputs
+MAX_COALESCED_INPUTS = 4096
+
+# Inputs per request sent by a client, so that requests of different clients can interleave
+CLIENT_CHUNK_SIZE = 1024
+
+
+def make_private_dir(directory: Path):
+    # existing directories, e.g. of a --socket elsewhere, are left as they are; the socket itself is 0600
+    if not directory.exists():
+        directory.mkdir(mode=0o700, parents=True)
+
+
+def get_authkey(authkey_file: str = AUTHKEY_FILE, create: bool = False) -> bytes:
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode()
+
+    if create and not os.path.exists(authkey_file):
+        make_private_dir(Path(authkey_file).parent)
+        fd = os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(os.urandom(32).hex())
+        logger.info(f"Created model server key \"{authkey_file}\"")
+
+    with open(authkey_file) as f:
+        return f.read().strip().encode()
+
+
+# Runs one model in its own thread. Requests waiting when the model becomes free are scored together.
+class CoalescingWorker(threading.Thread):
+    def __init__(self, name: str, score: Callable[[List[Any]], List[Any]],
+                 max_inputs: int = MAX_COALESCED_INPUTS, info: Optional[Dict[str, str]] = None):
+        super().__init__(name=f"worker-{name}", daemon=True)
+        self.score = score
+        self.info = info or {}
+        self.max_inputs = max_inputs
+        self.requests = queue.Queue()
+
+    def submit(self, inputs: List[Any]) -> Future:
+        future = Future()
+        self.requests.put((inputs, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            num_inputs = len(batch[0][0])
+            while num_inputs < self.max_inputs:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_inputs += len(request[0])
+
+            try:
+                outputs = self.score([x for inputs, _ in batch for x in inputs])
+            except Exception as e:
+                logger.exception(f"{self.name} failed")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for inputs, future in batch:
+                future.set_result(outputs[start:(start + len(inputs))])
+                start += len(inputs)
+
+
+def handle_request(request: Any, workers: Dict[str, CoalescingWorker]) -> Dict[str, Any]:
+    # Request: {"model": stage name, "inputs": [...]}, response: {"outputs": [...]} or {"error": message}.
+    # Request {"model": stage name, "info": True}: response {"model_key": ..., "fingerprint": ...}, see result_cache.
+    if not isinstance(request, dict) or "model" not in request:
+        return {"error": "malformed request, expected a dict with a \"model\" key"}
+
+    worker = workers.get(request["model"])
+    if worker is None:
+        return {"error": f"model \"{request['model']}\" is not served, only {list(workers)}"}
+
+    if request.get("info"):
+        return worker.info
+
+    if not isinstance(request.get("inputs"), list):
+        return {"error": "request without an \"inputs\" list"}
+    return {"outputs": worker.submit(request["inputs"]).result()}
+
+
+def serve_connection(connection, workers: Dict[str, CoalescingWorker], authkey: bytes):
+    # Runs in its own thread, from the authentication on, so that a stalled client blocks nobody else
+    with connection:
+        try:
+            deliver_challenge(connection, authkey)
+            answer_challenge(connection, authkey)
+        except AuthenticationError:
+            logger.warning("Rejected a connection with a wrong key")
+            return
+        except (EOFError, OSError) as e:
+            logger.warning(f"Connection lost during authentication: {e!r}")
+            return
+
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                break
+            except OSError as e:
+                logger.warning(f"Connection lost: {e!r}")
+                break
+            except Exception as e:
+                # the message was read, but could not be unpickled
+                logger.warning(f"Unreadable request: {e!r}")
+                request = None
+
+            try:
+                response = handle_request(request, workers)
+            except Exception as e:
+                logger.warning(f"Request failed: {e!r}")
+                response = {"error": repr(e)}
+
+            try:
+                connection.send(response)
+            except OSError as e:
+                logger.warning(f"Connection lost: {e!r}")
+                break
+
+
+# Thin client, used by the batch scripts instead of loading their model
+class ModelClient(object):
+    def __init__(self, socket_file: str = SOCKET_FILE, authkey_file: str = AUTHKEY_FILE):
+        logger.info(f"Connecting to model server \"{socket_file}\"")
+        self.connection = Client(socket_file, family="AF_UNIX", authkey=get_authkey(authkey_file))
+
+    def score(self, model: str, inputs: List[Any], chunk_size: int = CLIENT_CHUNK_SIZE) -> List[Any]:
+        outputs = []
+        for i in range(0, len(inputs), chunk_size):
+            self.connection.send({"model": model, "inputs": inputs[i:(i + chunk_size)]})
+            response = self.connection.recv()
+            if "error" in response:
+                raise RuntimeError(f"Model server: {response['error']}")
+            outputs.extend(response["outputs"])
+        return outputs
+
+    def model_info(self, model: str) -> Tuple[str, str]:
+        self.connection.send({"model": model, "info": True})
+        response = self.connection.recv()
+        if "error" in response:
+            raise RuntimeError(f"Model server: {response['error']}")
+        return response["model_key"], response["fingerprint"]
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loads models once and scores requests of the batch scripts")
+    parser.add_argument("--socket", type=str, default=SOCKET_FILE)
+    parser.add_argument("--authkey_file", type=str, default=AUTHKEY_FILE,
+                        help=f"Created if missing; ${AUTHKEY_ENV} takes precedence")
+    parser.add_argument("--models", type=str, nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--relation_model", type=str, help="Fine-tuned relation classifier")
+    parser.add_argument("--max_coalesced_inputs", type=int, default=MAX_COALESCED_INPUTS)
+    add_runtime_args(parser)
+
+    args = parser.parse_args()
+
+    assert "relation" not in args.models or args.relation_model is not None, \
+        "--relation_model is required to serve relation"
+
+    device = setup_device(args.device, args.num_threads)
+    workers = {}
+    for stage in args.models:
+        model_path = get_stage_model_path(stage, args.relation_model)
+        info = {
+            "model_key": get_model_key(stage, model_path, args.quantize),
+            "fingerprint": get_model_fingerprint(model_path),
+        }
+        workers[stage] = CoalescingWorker(stage, load_stage(stage, model_path, device, args.quantize),
+                                          args.max_coalesced_inputs, info)
+        workers[stage].start()
+
+    authkey = get_authkey(args.authkey_file, create=True)
+    make_private_dir(Path(args.socket).parent)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    # no authkey here: serve_connection() authenticates every connection in its own thread
+    with Listener(args.socket, family="AF_UNIX") as listener:
+        os.chmod(args.socket, 0o600)
+        logger.info(f"Serving {list(workers)} on \"{args.socket}\"")
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError as e:
+                logger.warning(f"Accept failed: {e!r}")
+                continue
+            threading.Thread(target=serve_connection, args=(connection, workers, authkey), daemon=True).start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from app_config import WORKING_DIR
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_FILE = f"{WORKING_DIR}/inference_cache/results.sqlite"
+
+# Least recently used results beyond this number are evicted
+MAX_ENTRIES = 200_000_000
+
+READ_CHUNK_SIZE = 500
+WRITE_CHUNK_SIZE = 10_000
+
+# last_used of a hit is only updated when it is older than this, and the updates are written in batches at close().
+# Eviction only needs a coarse order.
+TOUCH_INTERVAL = 24 * 3600
+MAX_PENDING_TOUCHES = 1_000_000
+
+
+def get_key(model_key: str, text: str) -> bytes:
+    return hashlib.sha1(f"{model_key}\0{text}".encode("utf-8")).digest()
+
+
+# Content-addressed store of model outputs, keyed by the hash of the model key and the input text. Values are
+# JSON. Each model key has a fingerprint; when it changes, the results of the model are dropped.
+# Opt-in with --cache of the batch scripts. SQLite serializes writers and its locks are unreliable on NFS, so a file
+# belongs to one job at a time and should be on a local disk: jobs running in parallel (--batch_id) each get their
+# own file, e.g. --cache results-<batch_id>.sqlite. "python -m inference_runtime.result_cache --merge" merges them
+# into one file afterwards, and --evict drops the least recently used results of a file.
+class ResultCache(object):
+    def __init__(self, filename: Union[str, Path] = RESULT_CACHE_FILE, max_entries: int = MAX_ENTRIES):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.pending_touches = set()
+        self.connection = sqlite3.connect(str(filename), timeout=600)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(key BLOB PRIMARY KEY, model TEXT, value TEXT, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_model ON results (model)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, fingerprint TEXT)")
+        self.connection.commit()
+
+    def check_model(self, model_key: str, fingerprint: str):
+        row = self.connection.execute("SELECT fingerprint FROM models WHERE model = ?", (model_key,)).fetchone()
+        if row is not None and row[0] != fingerprint:
+            logger.info(f"Model \"{model_key}\" has changed")
+            self.invalidate(model_key)
+        self.connection.execute("INSERT OR REPLACE INTO models (model, fingerprint) VALUES (?, ?)",
+                                (model_key, fingerprint))
+        self.connection.commit()
+
+    def invalidate(self, model_key: str):
+        num_deleted = self.connection.execute("DELETE FROM results WHERE model = ?", (model_key,)).rowcount
+        self.connection.execute("DELETE FROM models WHERE model = ?", (model_key,))
+        self.connection.commit()
+        logger.info(f"Dropped {num_deleted:,} results of \"{model_key}\"")
+
+    def get_many(self, model_key: str, texts: List[str]) -> Dict[str, Any]:
+        key2text = {get_key(model_key, text): text for text in texts}
+        keys = list(key2text)
+        found = {}
+        touch_before = time.time() - TOUCH_INTERVAL
+        for start in range(0, len(keys), READ_CHUNK_SIZE):
+            chunk = keys[start:(start + READ_CHUNK_SIZE)]
+            cursor = self.connection.execute(
+                f"SELECT key, value, last_used FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, value, last_used in cursor:
+                found[key2text[key]] = json.loads(value)
+                if last_used < touch_before:
+                    self.pending_touches.add(key)
+
+        if len(self.pending_touches) >= MAX_PENDING_TOUCHES:
+            self.write_touches()
+
+        self.hits += len(found)
+        self.misses += len(key2text) - len(found)
+        return found
+
+    def write_touches(self):
+        now = time.time()
+        keys = list(self.pending_touches)
+        for start in range(0, len(keys), WRITE_CHUNK_SIZE):
+            self.connection.executemany("UPDATE results SET last_used = ? WHERE key = ?",
+                                        ((now, key) for key in keys[start:(start + WRITE_CHUNK_SIZE)]))
+            self.connection.commit()
+        self.pending_touches = set()
+
+    def put_many(self, model_key: str, texts: List[str], values: List[Any]):
+        assert len(texts) == len(values)
+        now = time.time()
+        for start in range(0, len(texts), WRITE_CHUNK_SIZE):
+            end = start + WRITE_CHUNK_SIZE
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results (key, model, value, last_used) VALUES (?, ?, ?, ?)",
+                ((get_key(model_key, t), model_key, json.dumps(v), now) for t, v in zip(texts[start:end],
+                                                                                        values[start:end]))
+            )
+            self.connection.commit()
+
+    def evict(self):
+        # COUNT(*) scans the table and the delete sorts it, so this is a maintenance step, not part of a job
+        num_entries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.connection.execute("DELETE FROM results WHERE key IN "
+                                    "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                                    (num_entries - self.max_entries,))
+            self.connection.commit()
+            logger.info(f"Evicted {(num_entries - self.max_entries):,} least recently used results")
+
+    def merge(self, filename: Union[str, Path]):
+        # Results of another cache file, for models with the same or no fingerprint here. Existing results win.
+        self.connection.execute("ATTACH DATABASE ? AS other", (str(filename),))
+        for model_key, fingerprint in list(self.connection.execute("SELECT model, fingerprint FROM other.models")):
+            row = self.connection.execute("SELECT fingerprint FROM models WHERE model = ?", (model_key,)).fetchone()
+            if row is not None and row[0] != fingerprint:
+                logger.warning(f"Skipping results of \"{model_key}\" in \"{filename}\": other fingerprint")
+                continue
+            self.connection.execute("INSERT OR IGNORE INTO models (model, fingerprint) VALUES (?, ?)",
+                                    (model_key, fingerprint))
+            num_merged = self.connection.execute(
+                "INSERT OR IGNORE INTO results (key, model, value, last_used) "
+                "SELECT key, model, value, last_used FROM other.results WHERE model = ?", (model_key,)).rowcount
+            logger.info(f"Merged {num_merged:,} results of \"{model_key}\" from \"{filename}\"")
+        self.connection.commit()
+        self.connection.execute("DETACH DATABASE other")
+
+    def score(self, model_key: str, inputs: List[Any], score: Callable[[List[Any]], List[Any]],
+              key: Optional[Callable[[Any], str]] = None) -> List[Any]:
+        # score() on the inputs whose results are not cached yet, each distinct input once.
+        # key() gives the text of an input (default: the input itself).
+        texts = [key(x) for x in inputs] if key is not None else list(inputs)
+        text2result = self.get_many(model_key, list(dict.fromkeys(texts)))
+
+        new_inputs = {}
+        for text, x in zip(texts, inputs):
+            if text not in text2result and text not in new_inputs:
+                new_inputs[text] = x
+        if new_inputs:
+            new_results = score(list(new_inputs.values()))
+            self.put_many(model_key, list(new_inputs), new_results)
+            text2result.update(zip(new_inputs, new_results))
+
+        self.log_stats()
+        return [text2result[text] for text in texts]
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        logger.info(f"Result cache: {self.hits:,} hits, {self.misses:,} misses "
+                    f"({(self.hits / max(total, 1)):.1%} hit rate)")
+
+    def close(self):
+        self.write_touches()
+        self.connection.close()
+
+
+def add_cache_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--cache", type=str, nargs="?", const=RESULT_CACHE_FILE,
+                        help=f"Use a cache of model results (default file: {RESULT_CACHE_FILE}). Jobs running in "
+                             f"parallel should each get their own file on a local disk; see "
+                             f"inference_runtime.result_cache --merge")
+
+
+def open_cache(args: argparse.Namespace, model_key: str, fingerprint: str) -> Optional[ResultCache]:
+    if args.cache is None:
+        return None
+    logger.info(f"Using result cache \"{args.cache}\" for \"{model_key}\"")
+    cache = ResultCache(args.cache)
+    cache.check_model(model_key, fingerprint)
+    return cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows, merges, invalidates or evicts cached model results")
+    parser.add_argument("--cache_file", type=str, default=RESULT_CACHE_FILE)
+    parser.add_argument("--merge", type=str, nargs="+", help="Cache files of other jobs to merge into this one")
+    parser.add_argument("--invalidate", type=str, nargs="+", help="Model keys, e.g. \"sentiment:<model id>\"")
+    parser.add_argument("--evict", action="store_true",
+                        help="Drop the least recently used results beyond --max_entries")
+    parser.add_argument("--max_entries", type=int, default=MAX_ENTRIES)
+
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache_file, max_entries=args.max_entries)
+    for filename in args.merge or []:
+        cache.merge(filename)
+    for model_key in args.invalidate or []:
+        cache.invalidate(model_key)
+    if args.evict:
+        cache.evict()
+
+    for model_key, count in cache.connection.execute("SELECT model, COUNT(*) FROM results GROUP BY model"):
+        logger.info(f"{model_key}: {count:,} results")
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def add_runtime_args(parser: argparse.ArgumentParser, default_device: str = "cuda"):
+    parser.add_argument("--device", type=str, default=default_device, help="\"cpu\", \"cuda\" or \"cuda:<index>\"")
+    parser.add_argument("--num_threads", type=int, help="Intra-op threads on CPU (default: PyTorch's choice)")
+    parser.add_argument("--quantize", action="store_true",
+                        help="int8 dynamic quantization of the linear layers (CPU only)")
+
+
+def setup_device(device: str, num_threads: Optional[int] = None):
+    import torch
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.device(device)
+    logger.info(f"Device: {device}, intra-op threads: {torch.get_num_threads()}")
+    return device
+
+
+def conv1d_to_linear(model):
+    # GPT-2 implements its projections as transformers' Conv1D (y = x W + b), which dynamic quantization does
+    # not cover; the equivalent nn.Linear has the transposed weight
+    import torch
+    try:
+        from transformers.pytorch_utils import Conv1D
+    except ImportError:
+        from transformers.modeling_utils import Conv1D
+
+    for parent in model.modules():
+        for name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+                linear.bias = torch.nn.Parameter(child.bias.detach())
+                setattr(parent, name, linear)
+    return model
+
+
+def quantize_model(model):
+    import torch
+
+    return torch.quantization.quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(model_class, model_path: str, device, quantize: bool = False):
+    # model_class: a transformers model class, e.g. RobertaForSequenceClassification
+    logger.info(f"Load model from \"{model_path}\" to device \"{device}\"" + (" (int8)" if quantize else ""))
+    model = model_class.from_pretrained(model_path)
+    model.eval()
+    if quantize:
+        assert device.type == "cpu", "int8 dynamic quantization runs on CPU only"
+        model = quantize_model(model)
+    return model.to(device)
+
+
+def get_model_key(stage: str, model_path: str, quantize: bool = False) -> str:
+    # Name of a model's outputs in the result cache; int8 outputs differ from float32 ones
+    return f"{stage}:{model_path}" + ("#int8" if quantize else "")
+
+
+def get_hub_revision(model_id: str) -> Optional[str]:
+    # The local file that from_pretrained() loads the weights of a Hub model from, without a network call.
+    # transformers 4.x names it <hash of the URL>.<hash of the ETag>, which changes with every new upload;
+    # later versions resolve it to snapshots/<commit>/. None if the model was not downloaded yet.
+    try:
+        from transformers.file_utils import WEIGHTS_NAME, cached_path, hf_bucket_url
+
+        return Path(cached_path(hf_bucket_url(model_id, WEIGHTS_NAME), local_files_only=True)).name
+    except ImportError:
+        pass
+    except Exception:
+        return None
+
+    try:
+        from transformers.utils import WEIGHTS_NAME, cached_file
+
+        return str(Path(cached_file(model_id, WEIGHTS_NAME, local_files_only=True)).parent.name)
+    except Exception:
+        return None
+
+
+def get_model_fingerprint(model_path: str) -> str:
+    # Changes when a local model directory is rewritten, e.g. by a new fine-tuning run, or when a Hub model
+    # gets a new commit
+    path = Path(model_path)
+    if not path.is_dir():
+        revision = get_hub_revision(model_path)
+        if revision is None:
+            logger.warning(f"\"{model_path}\" is not in the local model cache yet, so its results are cached under "
+                           f"its name; they are dropped once a run finds the downloaded model")
+            return model_path
+        return f"{model_path}@{revision}"
+    h = hashlib.sha1()
+    for f in sorted(p for p in path.iterdir() if p.is_file()):
+        stat = f.stat()
+        h.update(f"{f.name}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode("utf-8"))
+    return h.hexdigest()
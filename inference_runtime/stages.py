@@ -0,0 +1,55 @@
+from typing import Any, Callable, List, Optional
+
+from .batching import run_batched
+from .runtime import load_model
+
+STAGES = ["relation", "sentiment", "perplexity"]
+
+SENTIMENT_BATCH_SIZE = 64
+
+
+def get_stage_model_path(stage: str, model_path: Optional[str] = None) -> str:
+    # model_path: the fine-tuned relation classifier; the other stages use fixed models
+    if stage == "relation":
+        return model_path
+    if stage == "sentiment":
+        from ranking.sentiment import MODEL_ID
+        return MODEL_ID
+    from ranking.perplexity import model_id
+    return model_id
+
+
+def load_stage(stage: str, model_path: Optional[str], device, quantize: bool = False) \
+        -> Callable[[List[Any]], List[Any]]:
+    # A function from the inputs of a stage to its per-input outputs:
+    # relation: {"subject", "predicate", "object"} rows -> relation labels, before rules
+    # sentiment: sentences -> {"negative", "neutral", "positive"} scores
+    # perplexity: sentences -> GPT-2 perplexities
+    # Stage modules are imported here, so that only the dependencies of the loaded stages are needed.
+    if stage == "relation":
+        from transformers import RobertaForSequenceClassification, RobertaTokenizerFast
+        from conceptnet_mapping.inference import preprocess_triples
+
+        tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
+        model = load_model(RobertaForSequenceClassification, model_path, device, quantize)
+
+        def forward(inputs):
+            return model(**inputs.to(device))[0].argmax(-1).tolist()
+
+        return lambda rows: [model.config.id2label[idx] for idx in
+                             run_batched(preprocess_triples(rows, tokenizer.sep_token), tokenizer, forward,
+                                         name="triples")]
+
+    if stage == "sentiment":
+        from ranking.sentiment import load_sentiment_model, compute_sentiments
+
+        model, tokenizer = load_sentiment_model(device, quantize)
+        return lambda texts: [s for i in range(0, len(texts), SENTIMENT_BATCH_SIZE)
+                              for s in compute_sentiments(texts[i:(i + SENTIMENT_BATCH_SIZE)], model, tokenizer,
+                                                          device)]
+
+    assert stage == "perplexity"
+    from ranking.perplexity import load_perplexity_model, get_perplexities
+
+    model, tokenizer = load_perplexity_model(device, quantize)
+    return lambda texts: get_perplexities(texts, model, tokenizer, device)
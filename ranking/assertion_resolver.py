@@ -0,0 +1,67 @@
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from triple_filtering.assertion_reader import assertion_doc_id
+
+logger = logging.getLogger(__name__)
+
+# Max. number of IDs in one $in query, keeping queries well below the BSON document size limit
+IN_QUERY_CHUNK_SIZE = 50_000
+
+# Clusters resolved together by iter_cluster_assertions()
+CLUSTER_BATCH_SIZE = 10_000
+
+
+def find_in_chunks(collection, ids, projection=None, chunk_size: int = IN_QUERY_CHUNK_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), chunk_size):
+        yield from collection.find({"_id": {"$in": ids[i:(i + chunk_size)]}}, projection)
+
+
+# Resolves clusters -> grouped triples -> OpenIE assertions with a few chunked $in queries per batch of clusters
+# instead of two queries per cluster. Only the projected assertion fields are fetched, so every script creates
+# a resolver with the fields it reads. Nothing is cached across batches: clusters rarely share assertions, so
+# only the assertions of the current batch are held in memory.
+class AssertionResolver(object):
+    def __init__(self, triples_col, assertions_col, projection: Optional[List[str]] = None):
+        self.triples_col = triples_col
+        self.assertions_col = assertions_col
+        self.projection = projection
+        self.num_triples = 0
+        self.num_assertions = 0
+
+    def get_assertions(self, assertion_ids: Iterable[Any]) -> Dict[Any, Dict[str, Any]]:
+        assertions = {a["_id"]: a for a in find_in_chunks(self.assertions_col, dict.fromkeys(assertion_ids),
+                                                           self.projection)}
+        self.num_assertions += len(assertions)
+        return assertions
+
+    def resolve(self, clusters: List[Dict[str, Any]]) -> Dict[Any, List[Dict[str, Any]]]:
+        # Same assertions, in the same order, as querying the triples and then the assertions of every cluster on
+        # its own: each assertion once per cluster, sorted by _id like the _id index scan of that $in query
+        # returned them. Keys are cluster IDs.
+        triple_ids = list(dict.fromkeys(t for cluster in clusters for t in cluster["triples"]))
+        # grouped triples imported from files written with --packed_ids hold packed integer IDs
+        triple2assertions = {t["_id"]: [assertion_doc_id(a) for a in t["assertions"]]
+                             for t in find_in_chunks(self.triples_col, triple_ids, ["assertions"])}
+        self.num_triples += len(triple2assertions)
+
+        assertions = self.get_assertions(a for ids in triple2assertions.values() for a in ids)
+
+        cluster2assertions = {}
+        for cluster in clusters:
+            ids = sorted(set(a for t in cluster["triples"] for a in triple2assertions.get(t, [])))
+            cluster2assertions[cluster["_id"]] = [assertions[a] for a in ids if a in assertions]
+        return cluster2assertions
+
+    def iter_cluster_assertions(self, clusters: List[Dict[str, Any]], batch_size: int = CLUSTER_BATCH_SIZE) \
+            -> Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        for i in range(0, len(clusters), batch_size):
+            batch = clusters[i:(i + batch_size)]
+            cluster2assertions = self.resolve(batch)
+            for cluster in batch:
+                yield cluster, cluster2assertions[cluster["_id"]]
+            logger.info(f"Resolved assertions of {min(i + batch_size, len(clusters)):,}/{len(clusters):,} clusters")
+
+    def log_stats(self):
+        logger.info(f"Fetched {self.num_triples:,} grouped triples and {self.num_assertions:,} assertions")
@@ -23,7 +23,8 @@ TRIPLES_COL = ASCENT_DB[f"grouped_triples"]
 CLUSTERS_COL = ASCENT_DB[f"clustered_triples"]
 
 
-def get_freq_update_queries(clusters):
+def get_log_freqs(clusters):
+    # log frequencies min-max normalized over the given clusters, which are all the clusters of one subject
     log_scores = [math.log(c["count"]) for c in clusters]
 
     if len(log_scores) == 0:
@@ -32,12 +33,13 @@ def get_freq_update_queries(clusters):
     max_log = max(log_scores)
     min_log = min(log_scores)
     if max_log == min_log:
-        new_scores = [1] * len(log_scores)
-    else:
-        new_scores = [(s - min_log) / (max_log - min_log) for s in log_scores]
+        return [1] * len(log_scores)
+    return [(s - min_log) / (max_log - min_log) for s in log_scores]
 
+
+def get_freq_update_queries(clusters):
     queries = []
-    for c, s in zip(clusters, new_scores):
+    for c, s in zip(clusters, get_log_freqs(clusters)):
         queries.append(UpdateOne({"_id": c["_id"]}, {"$set": {"log_freq": s}}))
 
     return queries
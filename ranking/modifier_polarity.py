@@ -6,6 +6,7 @@ from bson import ObjectId
 from pymongo import UpdateOne
 
 from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from ranking.assertion_resolver import AssertionResolver
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -21,6 +22,8 @@ ASSERTIONS_COL = ASCENT_DB[f"openie_assertions"]
 TRIPLES_COL = ASCENT_DB[f"grouped_triples"]
 CLUSTERS_COL = ASCENT_DB[f"clustered_triples"]
 
+ASSERTION_RESOLVER = AssertionResolver(TRIPLES_COL, ASSERTIONS_COL, ["facets", "source.lemmas", "source.positions"])
+
 FACET2SCORE = {
     "always": 1.0,
     "typically": 0.9,
@@ -74,22 +77,6 @@ def get_plural_ratio(assertions):
     return cnt / all_cnt
 
 
-def get_openie_assertions(cluster):
-    triples = TRIPLES_COL.find({
-        "_id": {"$in": cluster["triples"]}
-    })
-
-    assertion_ids = []
-    for t in triples:
-        assertion_ids.extend(t["assertions"])
-
-    assertions = ASSERTIONS_COL.find({
-        "_id": {"$in": assertion_ids}
-    })
-
-    return assertions
-
-
 def get_relevant_facets(assertions):
     facets = []
     for a in assertions:
@@ -174,11 +161,9 @@ def get_modifier_polarity(assertions):
 # }
 
 
-def get_modifier_polarity_update_query(cluster):
+def get_modifier_polarity_update_query(cluster, openie_assertions):
     _id = cluster["_id"]
 
-    openie_assertions = list(get_openie_assertions(cluster))
-
     scores = get_modifier_polarity(openie_assertions)
 
     return UpdateOne({"_id": _id}, {"$set": scores})
@@ -216,7 +201,9 @@ def main():
     logger.info(f"Got {len(clusters):,} clusters")
 
     logger.info(f"Compute modifier polarity")
-    queries = [get_modifier_polarity_update_query(cluster) for cluster in clusters]
+    queries = [get_modifier_polarity_update_query(cluster, openie_assertions)
+               for cluster, openie_assertions in ASSERTION_RESOLVER.iter_cluster_assertions(clusters)]
+    ASSERTION_RESOLVER.log_stats()
 
     # logger.info(f"Compute normalized log frequency")
     # queries.extend(get_freq_update_queries(clusters))
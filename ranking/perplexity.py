@@ -10,6 +10,11 @@ from pymongo import UpdateOne
 from transformers import GPT2LMHeadModel, GPT2TokenizerFast
 
 from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from inference_runtime.batching import get_token_lengths, run_batched
+from inference_runtime.model_server import SOCKET_FILE, ModelClient
+from inference_runtime.result_cache import add_cache_args, open_cache
+from inference_runtime.runtime import add_runtime_args, setup_device, load_model, get_model_key, \
+    get_model_fingerprint
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -25,20 +30,27 @@ ASSERTIONS_COL = ASCENT_DB[f"openie_assertions"]
 TRIPLES_COL = ASCENT_DB[f"grouped_triples"]
 CLUSTERS_COL = ASCENT_DB[f"clustered_triples"]
 
-device = "cuda"
 model_id = "gpt2-large"
 
-logger.info(f"Loading model \"{model_id}\" to device \"{device}\"")
-model = GPT2LMHeadModel.from_pretrained(model_id).to(device)
+# Window of get_perplexity(); sentences that fit into one window are scored in padded batches
+STRIDE = 512
 
-logger.info(f"Loading tokenizer \"{model_id}\"")
-tokenizer = GPT2TokenizerFast.from_pretrained(model_id)
+# Padded tokens per batch. Far below the shared budget, since the logits of GPT-2 take 50,257 floats per token.
+PERPLEXITY_TOKEN_BUDGET = 2048
 
 
-def get_perplexity(sentence):
+def load_perplexity_model(device, quantize=False):
+    model = load_model(GPT2LMHeadModel, model_id, device, quantize)
+
+    logger.info(f"Loading tokenizer \"{model_id}\"")
+    tokenizer = GPT2TokenizerFast.from_pretrained(model_id)
+    return model, tokenizer
+
+
+def get_perplexity(sentence, model, tokenizer, device):
     encodings = tokenizer(sentence, return_tensors="pt")
     max_length = model.config.n_positions
-    stride = 512
+    stride = STRIDE
 
     lls = []
     for i in range(0, encodings.input_ids.size(1), stride):
@@ -60,14 +72,56 @@ def get_perplexity(sentence):
     return ppl
 
 
+def get_perplexities(sentences, model, tokenizer, device, token_budget=PERPLEXITY_TOKEN_BUDGET):
+    # Same values as get_perplexity() per sentence: exp of the mean negative log-likelihood of the tokens after
+    # the first. Sentences of one window are batched, padded on the right and masked out of the loss.
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+
+    def forward(encodings):
+        input_ids = encodings["input_ids"].to(device)
+        attention_mask = encodings["attention_mask"].to(device)
+        logits = model(input_ids=input_ids, attention_mask=attention_mask)[0]
+        nll = torch.nn.functional.cross_entropy(logits[:, :-1].transpose(1, 2).float(), input_ids[:, 1:],
+                                                reduction="none")
+        mask = attention_mask[:, 1:].float()
+        return torch.exp((nll * mask).sum(dim=1) / mask.sum(dim=1)).tolist()
+
+    lengths = get_token_lengths(sentences, tokenizer)
+    short = [i for i, length in enumerate(lengths) if length <= STRIDE]
+    perplexities = [None] * len(sentences)
+    for i, ppl in zip(short, run_batched([sentences[i] for i in short], tokenizer, forward, name="sentences",
+                                         token_budget=token_budget)):
+        perplexities[i] = ppl
+    for i, length in enumerate(lengths):
+        if length > STRIDE:
+            perplexities[i] = get_perplexity(sentences[i], model, tokenizer, device).item()
+    return perplexities
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_id", type=int, required=True)
     parser.add_argument("--num_batches", type=int, required=True)
     parser.add_argument("--id_file", type=str, required=True)
+    add_runtime_args(parser)
+    parser.add_argument("--server", type=str, nargs="?", const=SOCKET_FILE,
+                        help="Score on the model server (inference_runtime.model_server) listening on this socket "
+                             "instead of loading the model")
+    add_cache_args(parser)
 
     args = parser.parse_args()
 
+    client = None
+    if args.server is not None:
+        client = ModelClient(args.server)
+        model_key, fingerprint = client.model_info("perplexity")
+    else:
+        model_key = get_model_key("perplexity", model_id, args.quantize)
+        fingerprint = get_model_fingerprint(model_id)
+    cache = open_cache(args, model_key, fingerprint)
+
     logger.info(f"Read cluster ids from \"{args.id_file}\"")
     with open(args.id_file) as f:
         ids = [ObjectId(line.strip()) for line in f]
@@ -92,10 +146,23 @@ def main():
     logger.info(f"Got {len(clusters):,} clusters")
 
     logger.info("Compute perplexity")
+    def score(sentences):
+        if client is not None:
+            return client.score("perplexity", sentences)
+        # the model is only loaded if some sentences are not in the cache
+        device = setup_device(args.device, args.num_threads)
+        model, tokenizer = load_perplexity_model(device, args.quantize)
+        return get_perplexities(sentences, model, tokenizer, device)
+
+    sentences = [cluster["triple_sentence"] for cluster in clusters]
+    if cache is not None:
+        perplexities = cache.score(model_key, sentences, score)
+        cache.close()
+    else:
+        perplexities = score(sentences)
+
     queries = []
-    for cluster in clusters:
-        sentence = cluster["triple_sentence"]
-        perplexity = get_perplexity(sentence).item()
+    for cluster, perplexity in zip(clusters, perplexities):
         queries.append(UpdateOne({"_id": cluster["_id"]}, {"$set": {"perplexity": perplexity}}))
 
     logger.info(f"Bulk write {len(queries):,} queries")
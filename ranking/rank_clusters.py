@@ -0,0 +1,129 @@
+import argparse
+import csv
+import logging
+
+import pymongo
+from pymongo import UpdateOne
+
+from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from ranking.assertion_resolver import AssertionResolver
+from ranking.log_freq import get_log_freqs
+from ranking.modifier_polarity import get_modifier_polarity
+from ranking.sentiment_combine import combine_sentiment
+from ranking.triple_to_sent import get_triple_sentence
+from ranking.typicality import compute_typicality
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+MONGO_CLIENT = pymongo.MongoClient(host=MONGO_HOST, port=MONGO_PORT)
+
+ASCENT_DB = MONGO_CLIENT[DB_NAME]
+
+ASSERTIONS_COL = ASCENT_DB["openie_assertions"]
+TRIPLES_COL = ASCENT_DB["grouped_triples"]
+CLUSTERS_COL = ASCENT_DB["clustered_triples"]
+
+# Union of the assertion fields read by triple_to_sent, modifier_polarity and sentiment_combine
+ASSERTION_RESOLVER = AssertionResolver(TRIPLES_COL, ASSERTIONS_COL, [
+    "predicate", "object", "facets", "sentiment",
+    "source.sentence", "source.tokens", "source.lemmas", "source.positions",
+])
+
+# Subjects whose clusters are read, scored and written together
+SUBJECT_BATCH_SIZE = 1_000
+
+
+def get_subject_query(subjects):
+    # One $or branch per subject, each with the equality match of the per-subject query in ranking/log_freq.py,
+    # so every branch uses the same (subject, subject_type, super_subject) index
+    keys = dict.fromkeys((s["subject"], s["type"], s["super_subject"]) for s in subjects)
+    return {"$or": [{"subject": subject, "subject_type": subject_type, "super_subject": super_subject}
+                    for subject, subject_type, super_subject in keys]}
+
+
+def get_subject_clusters(subjects):
+    # All clusters of the given subjects, with one query
+    return list(CLUSTERS_COL.find(get_subject_query(subjects)))
+
+
+def get_ranking_fields(cluster, assertions, log_freq):
+    # Same values as running triple_to_sent, modifier_polarity, sentiment_combine, log_freq and typicality
+    # one after another
+    fields = {
+        "triple_sentence": get_triple_sentence(cluster, assertions),
+        **get_modifier_polarity(assertions),
+        "sentiment": combine_sentiment(assertions),
+        "log_freq": log_freq,
+    }
+    fields["typicality"] = compute_typicality(fields)
+    return fields
+
+
+def get_ranking_update_queries(clusters):
+    # log_freq is normalized per subject, so clusters must contain all clusters of their subjects
+    subject2clusters = {}
+    for c in clusters:
+        subject2clusters.setdefault((c["subject"], c["subject_type"], c["super_subject"]), []).append(c)
+
+    cluster2log_freq = {}
+    for subject_clusters in subject2clusters.values():
+        for c, s in zip(subject_clusters, get_log_freqs(subject_clusters)):
+            cluster2log_freq[c["_id"]] = s
+
+    queries = []
+    for cluster, assertions in ASSERTION_RESOLVER.iter_cluster_assertions(clusters):
+        fields = get_ranking_fields(cluster, assertions, cluster2log_freq[cluster["_id"]])
+        queries.append(UpdateOne({"_id": cluster["_id"]}, {"$set": fields}))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Computes triple_sentence, mod_pol, num_mod, sentiment, log_freq and typicality of clusters "
+                    "in one pass, instead of running the ranking scripts one by one")
+    parser.add_argument("--batch_id", type=int, required=True)
+    parser.add_argument("--num_batches", type=int, required=True)
+    parser.add_argument("--subject_file", type=str, required=True)
+    parser.add_argument("--subject_batch_size", type=int, default=SUBJECT_BATCH_SIZE)
+
+    args = parser.parse_args()
+
+    logger.info(f"Read subjects from \"{args.subject_file}\"")
+    with open(args.subject_file) as f:
+        reader = csv.DictReader(f)
+        all_subjects = [row for row in reader]
+    logger.info(f"There are {len(all_subjects):,} subjects")
+
+    batch_size = int(len(all_subjects) / args.num_batches) + 1
+    logger.info(f"Num batches: {args.num_batches}, batch id: {args.batch_id}, batch size: {batch_size}")
+
+    start = args.batch_id * batch_size
+    end = (args.batch_id + 1) * batch_size
+
+    logger.info(f"Batch start: {start:,}, batch end: {end:,}")
+
+    subjects = all_subjects[start:end]
+
+    num_queries = 0
+    for i in range(0, len(subjects), args.subject_batch_size):
+        subject_batch = subjects[i:(i + args.subject_batch_size)]
+        clusters = get_subject_clusters(subject_batch)
+        logger.info(f"Subjects {i:,}-{(i + len(subject_batch)):,}: {len(clusters):,} clusters")
+        if not clusters:
+            continue
+
+        queries = get_ranking_update_queries(clusters)
+        CLUSTERS_COL.bulk_write(queries, ordered=False)
+        num_queries += len(queries)
+        logger.info(f"Wrote {num_queries:,} clusters so far")
+
+    ASSERTION_RESOLVER.log_stats()
+    logger.info("Done")
+
+
+if __name__ == '__main__':
+    main()
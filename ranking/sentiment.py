@@ -7,6 +7,10 @@ from pymongo import UpdateOne
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
 from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from inference_runtime.model_server import SOCKET_FILE, ModelClient
+from inference_runtime.result_cache import add_cache_args, open_cache
+from inference_runtime.runtime import add_runtime_args, setup_device, load_model, get_model_key, \
+    get_model_fingerprint
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -22,20 +26,21 @@ ASSERTIONS_COL = ASCENT_DB[f"openie_assertions"]
 
 MODEL_ID = f"cardiffnlp/twitter-roberta-base-sentiment"
 
-device = "cuda"
-
 # download label mapping
 labels = ["negative", "neutral", "positive"]
 
-# PT
-logger.info(f"Load Sentiment Analysis model \"{MODEL_ID}\"")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-model = AutoModelForSequenceClassification.from_pretrained(MODEL_ID).to(device)
+
+def load_sentiment_model(device, quantize=False):
+    logger.info(f"Load Sentiment Analysis model \"{MODEL_ID}\"")
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+    model = load_model(AutoModelForSequenceClassification, MODEL_ID, device, quantize)
+    return model, tokenizer
 
 
-def compute_sentiments(texts):
+def compute_sentiments(texts, model, tokenizer, device):
     encoded_input = tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=512).to(device)
-    output = model(**encoded_input)
+    with torch.inference_mode():
+        output = model(**encoded_input)
     scores = torch.softmax(output.logits, dim=1).tolist()
 
     return [{labels[i]: s[i] for i in range(len(s))} for s in scores]
@@ -45,9 +50,23 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--c4_id", type=int, required=True)
     parser.add_argument("--batch_size", type=int, default=64)
+    add_runtime_args(parser)
+    parser.add_argument("--server", type=str, nargs="?", const=SOCKET_FILE,
+                        help="Score on the model server (inference_runtime.model_server) listening on this socket "
+                             "instead of loading the model")
+    add_cache_args(parser)
 
     args = parser.parse_args()
 
+    client = None
+    if args.server is not None:
+        client = ModelClient(args.server)
+        model_key, fingerprint = client.model_info("sentiment")
+    else:
+        model_key = get_model_key("sentiment", MODEL_ID, args.quantize)
+        fingerprint = get_model_fingerprint(MODEL_ID)
+    cache = open_cache(args, model_key, fingerprint)
+
     logger.info(f"Reading assertions from DB with _id starts with \"{args.c4_id:05d}-\"")
     assertions = list(ASSERTIONS_COL.find({
         "_id": {"$regex": f"^{args.c4_id:05d}-"}
@@ -55,25 +74,40 @@ def main():
     logger.info(f"Number of assertions: {len(assertions):,}")
 
     batch_size = args.batch_size
-    num_batches = len(assertions) / batch_size
-    if num_batches != int(num_batches):
-        num_batches = int(num_batches) + 1
-    num_batches = int(num_batches)
-
-    logger.info(f"Num batches: {num_batches}, batch size: {batch_size}")
+    logger.info(f"Batch size: {batch_size}")
+
+    model = tokenizer = device = None
+
+    def score(sentences):
+        nonlocal model, tokenizer, device
+        # the model is only loaded if some sentences are not in the cache
+        if client is None and model is None:
+            device = setup_device(args.device, args.num_threads)
+            model, tokenizer = load_sentiment_model(device, args.quantize)
+
+        num_batches = (len(sentences) + batch_size - 1) // batch_size
+        results = []
+        for i in range(0, len(sentences), batch_size):
+            batch = sentences[i:(i + batch_size)]
+            batch_id = int(i / batch_size) + 1
+            logger.info(f"Batch {batch_id:05d} / {num_batches:05d}")
+
+            if client is not None:
+                results.extend(client.score("sentiment", batch))
+            else:
+                results.extend(compute_sentiments(batch, model, tokenizer, device))
+        return results
+
+    sentences = [a["source"]["sentence"] for a in assertions]
+    if cache is not None:
+        sentiments = cache.score(model_key, sentences, score)
+        cache.close()
+    else:
+        sentiments = score(sentences)
 
     queries = []
-
-    for i in range(0, len(assertions), batch_size):
-        batch = assertions[i:(i + batch_size)]
-        batch_id = int(i / batch_size) + 1
-        logger.info(f"Batch {batch_id:05d} / {num_batches:05d}")
-
-        sentences = [a["source"]["sentence"] for a in batch]
-        sentiments = compute_sentiments(sentences)
-
-        for a, s in zip(batch, sentiments):
-            queries.append(UpdateOne({"_id": a["_id"]}, {"$set": {"sentiment": s}}))
+    for a, s in zip(assertions, sentiments):
+        queries.append(UpdateOne({"_id": a["_id"]}, {"$set": {"sentiment": s}}))
 
     logger.info(f"Bulk update {len(queries):,} queries")
     ASSERTIONS_COL.bulk_write(queries, ordered=False)
@@ -8,6 +8,7 @@ from bson import ObjectId
 from pymongo import UpdateOne
 
 from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from ranking.assertion_resolver import AssertionResolver
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -23,21 +24,13 @@ ASSERTIONS_COL = ASCENT_DB[f"openie_assertions"]
 TRIPLES_COL = ASCENT_DB[f"grouped_triples"]
 CLUSTERS_COL = ASCENT_DB[f"clustered_triples"]
 
+ASSERTION_RESOLVER = AssertionResolver(TRIPLES_COL, ASSERTIONS_COL, ["sentiment"])
 
-def get_openie_assertions(cluster):
-    triples = TRIPLES_COL.find({
-        "_id": {"$in": cluster["triples"]}
-    })
 
-    assertion_ids = []
-    for t in triples:
-        assertion_ids.extend(t["assertions"])
-
-    assertions = ASSERTIONS_COL.find({
-        "_id": {"$in": assertion_ids}
-    })
-
-    return assertions
+def combine_sentiment(openie_assertions):
+    df = pd.DataFrame([a["sentiment"] for a in openie_assertions])
+    labels = ["negative", "neutral", "positive"]
+    return {label: np.mean(df[label]) for label in labels}
 
 
 def main():
@@ -73,12 +66,10 @@ def main():
 
     logger.info("Combine sentiment")
     queries = []
-    for cluster in clusters:
-        openie_assertions = list(get_openie_assertions(cluster))
-        df = pd.DataFrame([a["sentiment"] for a in openie_assertions])
-        labels = ["negative", "neutral", "positive"]
-        sentiment = {label: np.mean(df[label]) for label in labels}
+    for cluster, openie_assertions in ASSERTION_RESOLVER.iter_cluster_assertions(clusters):
+        sentiment = combine_sentiment(openie_assertions)
         queries.append(UpdateOne({"_id": cluster["_id"]}, {"$set": {"sentiment": sentiment}}))
+    ASSERTION_RESOLVER.log_stats()
 
     logger.info(f"Bulk write {len(queries):,} queries")
     CLUSTERS_COL.bulk_write(queries, ordered=False)
@@ -7,6 +7,7 @@ from bson import ObjectId
 from pymongo import UpdateOne
 
 from app_config import MONGO_HOST, MONGO_PORT, DB_NAME
+from ranking.assertion_resolver import AssertionResolver
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -22,26 +23,11 @@ ASSERTIONS_COL = ASCENT_DB[f"openie_assertions"]
 TRIPLES_COL = ASCENT_DB[f"grouped_triples"]
 CLUSTERS_COL = ASCENT_DB[f"clustered_triples"]
 
+ASSERTION_RESOLVER = AssertionResolver(TRIPLES_COL, ASSERTIONS_COL, ["predicate", "object", "source.sentence",
+                                                                     "source.tokens", "source.positions"])
 
-def get_openie_assertions(cluster):
-    triples = TRIPLES_COL.find({
-        "_id": {"$in": cluster["triples"]}
-    })
-
-    assertion_ids = []
-    for t in triples:
-        assertion_ids.extend(t["assertions"])
-
-    assertions = ASSERTIONS_COL.find({
-        "_id": {"$in": assertion_ids}
-    })
-
-    return assertions
-
-
-def get_triple_sentence(cluster):
-    assertions = list(get_openie_assertions(cluster))
 
+def get_triple_sentence(cluster, assertions):
     counter = Counter()
     for a in assertions:
         if not (a["predicate"].rstrip("\x00") == cluster["predicate"] and a["object"].rstrip("\x00") == cluster["object"]):
@@ -74,10 +60,10 @@ def get_triple_sentence(cluster):
     return " ".join(sent_toks).replace('\0', '')
 
 
-def get_add_sentence_update_query(cluster):
+def get_add_sentence_update_query(cluster, assertions):
     _id = cluster["_id"]
 
-    return UpdateOne({"_id": _id}, {"$set": {"triple_sentence": get_triple_sentence(cluster)}})
+    return UpdateOne({"_id": _id}, {"$set": {"triple_sentence": get_triple_sentence(cluster, assertions)}})
 
 
 def main():
@@ -112,7 +98,9 @@ def main():
     logger.info(f"Got {len(clusters):,} clusters")
 
     logger.info(f"Get sentences")
-    queries = [get_add_sentence_update_query(cluster) for cluster in clusters]
+    queries = [get_add_sentence_update_query(cluster, assertions)
+               for cluster, assertions in ASSERTION_RESOLVER.iter_cluster_assertions(clusters)]
+    ASSERTION_RESOLVER.log_stats()
 
     logger.info(f"Bulk write {len(queries):,} queries")
     CLUSTERS_COL.bulk_write(queries, ordered=False)
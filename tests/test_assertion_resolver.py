@@ -0,0 +1,52 @@
+from ranking.assertion_resolver import AssertionResolver
+
+
+# The part of a pymongo collection the resolver uses: find() with {"_id": {"$in": ids}} and a list projection,
+# returning the documents in _id order like an _id index scan
+class FakeCollection(object):
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.num_queries = 0
+
+    def find(self, query, projection=None):
+        self.num_queries += 1
+        for _id in sorted(set(query["_id"]["$in"]) & set(self.docs)):
+            doc = self.docs[_id]
+            yield {k: v for k, v in doc.items() if projection is None or k == "_id" or k in projection}
+
+
+def make_resolver():
+    triples = FakeCollection([
+        {"_id": "t1", "assertions": ["a3", "a1"]},
+        {"_id": "t2", "assertions": ["a2", "a1", "a9"]},
+        {"_id": "t3", "assertions": ["a4"]},
+    ])
+    assertions = FakeCollection([{"_id": f"a{i}", "object": f"o{i}", "sentence": "s"} for i in range(1, 5)])
+    return AssertionResolver(triples, assertions, ["object"]), triples, assertions
+
+
+def per_cluster(resolver, cluster):
+    # the two queries per cluster the resolver replaces
+    ids = [a for t in resolver.triples_col.find({"_id": {"$in": cluster["triples"]}}) for a in t["assertions"]]
+    return list(resolver.assertions_col.find({"_id": {"$in": ids}}, resolver.projection))
+
+
+CLUSTERS = [{"_id": "c1", "triples": ["t2", "t1"]}, {"_id": "c2", "triples": ["t3", "t0"]},
+            {"_id": "c3", "triples": []}, {"_id": "c4", "triples": ["t1", "t1"]}]
+
+
+def test_same_assertions_and_order_as_per_cluster_queries():
+    resolver, _, _ = make_resolver()
+    cluster2assertions = resolver.resolve(CLUSTERS)
+    for cluster in CLUSTERS:
+        assert cluster2assertions[cluster["_id"]] == per_cluster(resolver, cluster)
+    assert [a["_id"] for a in cluster2assertions["c1"]] == ["a1", "a2", "a3"]
+    assert "sentence" not in cluster2assertions["c1"][0]
+
+
+def test_iter_cluster_assertions_batches():
+    resolver, triples, assertions = make_resolver()
+    results = list(resolver.iter_cluster_assertions(CLUSTERS, batch_size=3))
+    assert [cluster["_id"] for cluster, _ in results] == ["c1", "c2", "c3", "c4"]
+    assert [[a["_id"] for a in found] for _, found in results] == [["a1", "a2", "a3"], ["a4"], [], ["a1", "a3"]]
+    assert triples.num_queries == 2 and assertions.num_queries == 2
@@ -0,0 +1,161 @@
+import itertools
+import random
+from typing import List
+
+import pytest
+
+from conceptnet_mapping.rules import RELATION_RULES, PREDICATE_CONCAT_RULES, OBJECT_PREFIX_RULES, BATCH_SIZE, \
+    rewrite_relations, postprocess_objects
+
+RELATIONS = ["/r/AtLocation", "/r/CapableOf", "/r/Causes", "/r/Desires", "/r/HasA", "/r/HasPrerequisite",
+             "/r/HasProperty", "/r/HasSubevent", "/r/IsA", "/r/MadeOf", "/r/PartOf", "/r/ReceivesAction",
+             "/r/RelatedTo", "/r/SymbolOf", "/r/UsedFor"]
+
+
+# The row-by-row rules conceptnet_mapping.inference applied before conceptnet_mapping.rules
+def apply_row_rules(row, relation, new_relation) -> str:
+    if relation == "/r/HasProperty" and row["predicate"] != "be":
+        new_relation = "/r/ReceivesAction"
+
+    if row["predicate"] == "symbolize" or row["object"].startswith("a symbol of ") or row["object"].startswith(
+            "symbol of ") or row["object"].startswith("the symbol of "):
+        new_relation = "/r/SymbolOf"
+
+    if row["object"].startswith("an emblem of ") or row["object"].startswith(
+            "emblem of ") or row["object"].startswith("the emblem of "):
+        new_relation = "/r/SymbolOf"
+
+    if row["predicate"] in {"need", "require"}:
+        new_relation = "/r/HasPrerequisite"
+
+    if row["predicate"] in {"contain", "include"}:
+        new_relation = "/r/HasA"
+
+    if row["predicate"] in {"be related to", "relate to"}:
+        new_relation = "/r/RelatedTo"
+
+    return new_relation
+
+
+def should_concat_po(predicted_relation, old_pred):
+    if predicted_relation == "/r/CapableOf":
+        if old_pred not in {"be capable of", "can", "be able to"}:
+            return True
+    elif predicted_relation in {"/r/HasProperty", "/r/IsA", "/r/ReceivesAction"}:
+        if old_pred != "be":
+            return True
+
+    return False
+
+
+def postprocess_object(row, predicted_relation) -> str:
+    new_obj = row["object"]
+
+    old_obj = row["object"]
+    old_pred = row["predicate"]
+
+    if should_concat_po(predicted_relation, old_pred):
+        new_obj = old_pred + " " + old_obj
+
+    if predicted_relation in {"/r/HasProperty", "/r/IsA", "/r/ReceivesAction"}:
+        if old_pred.startswith("be "):
+            new_obj = old_pred[len("be "):] + " " + old_obj
+
+    elif predicted_relation == "/r/PartOf" and old_obj.startswith("a part of "):
+        new_obj = old_obj[len("a part of "):]
+
+    elif predicted_relation == "/r/PartOf" and old_obj.startswith("part of "):
+        new_obj = old_obj[len("part of "):]
+
+    elif predicted_relation == "/r/PartOf" and old_obj.startswith("the part of "):
+        new_obj = old_obj[len("the part of "):]
+
+    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("a symbol of "):
+        new_obj = old_obj[len("a symbol of "):]
+
+    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("the symbol of "):
+        new_obj = old_obj[len("the symbol of "):]
+
+    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("symbol of "):
+        new_obj = old_obj[len("symbol of "):]
+
+    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("an emblem of "):
+        new_obj = old_obj[len("an emblem of"):]
+
+    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("emblem of "):
+        new_obj = old_obj[len("emblem of"):]
+
+    elif predicted_relation == "/r/SymbolOf" and old_obj.startswith("the emblem of "):
+        new_obj = old_obj[len("the emblem of"):]
+
+    elif predicted_relation in {"/r/UsedFor", "/r/Desires"}:
+        old_pred_toks: List[str] = old_pred.split()
+        if "to" in old_pred_toks:
+            idx = old_pred_toks.index("to")
+            if idx < len(old_pred_toks) - 1:
+                new_obj = " ".join(old_pred_toks[(idx + 1):]) + " " + old_obj
+
+    new_obj = new_obj.replace("n’t", "not")
+    new_obj = new_obj.replace("n't", "not")
+
+    return new_obj
+
+
+def make_rows():
+    # Every predicate and object prefix mentioned by a rule, with every relation
+    predicates = {"be", "be made of", "be used to cut", "want to", "need to eat", "to", "use to go to", "eat",
+                  "be\0", "want to eat\0", "use  to\tcut", "be  big", "want\u3000to\x85eat ", "go to ", "to to"}
+    prefixes = {""}
+    for conditions, _ in RELATION_RULES:
+        predicates.update(conditions.get("predicates", []))
+        predicates.update([conditions["predicate_not"]] if "predicate_not" in conditions else [])
+        prefixes.update(conditions.get("object_prefixes", []))
+    for keep_predicates in PREDICATE_CONCAT_RULES.values():
+        predicates.update(keep_predicates)
+    for prefix_rules in OBJECT_PREFIX_RULES.values():
+        prefixes.update(prefix for prefix, _ in prefix_rules)
+    objects = [prefix + obj for prefix in prefixes for obj in ["food", "doesn't fly", "isn’t réd", "food\0\0", ""]]
+
+    rows = []
+    for relation, predicate, obj in itertools.product(RELATIONS, sorted(predicates), sorted(objects)):
+        rows.append({"relation": relation, "predicate": predicate, "object": obj})
+    return rows
+
+
+@pytest.fixture(scope="module")
+def rows():
+    rows = make_rows()
+    # The IsA rule needs the database; rewrite some IsA rows like it would
+    rng = random.Random(42)
+    for row in rows:
+        row["isa_relation"] = rng.choice(["/r/IsA", "/r/HasProperty", "/r/ReceivesAction"]) \
+            if row["relation"] == "/r/IsA" else row["relation"]
+    return rows
+
+
+def test_relation_parity(rows):
+    expected = [apply_row_rules(row, row["relation"], row["isa_relation"]) for row in rows]
+    relations = rewrite_relations([row["relation"] for row in rows], [row["isa_relation"] for row in rows],
+                                  [row["predicate"] for row in rows], [row["object"] for row in rows])
+    assert relations == expected
+
+
+def test_object_parity(rows):
+    expected = [postprocess_object(row, row["relation"]) for row in rows]
+    objects = postprocess_objects([row["relation"] for row in rows], [row["predicate"] for row in rows],
+                                  [row["object"] for row in rows])
+    assert objects == expected
+
+
+def test_batch_boundaries(rows):
+    # more than one batch, with the last one partial
+    rows = (rows * (BATCH_SIZE // len(rows) + 2))[:BATCH_SIZE + 7]
+    expected = [postprocess_object(row, row["relation"]) for row in rows]
+    objects = postprocess_objects([row["relation"] for row in rows], [row["predicate"] for row in rows],
+                                  [row["object"] for row in rows])
+    assert objects == expected
+
+
+def test_empty_input():
+    assert rewrite_relations([], [], [], []) == []
+    assert postprocess_objects([], [], []) == []
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from triple_clustering.clustering import NUM_EMBEDDING_PARTS
+from triple_clustering.compress_embeddings import compress_part
+from triple_clustering.embedding_store import get_embeddings_file, normalize_rows, read_rows, write_store_part
+
+DIMENSION = 8
+
+
+def make_triples(n):
+    return [{"triple_id": f"triple-000-{i:07d}", "subject": "s", "predicate": "p", "object": f"o{i}", "count": 3,
+             "subject_type": "t", "super_subject": "s"} for i in range(n)]
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 1e-6), ("float16", 1e-3), ("int8", 1e-2)])
+def test_store_round_trip(tmp_path, dtype, tolerance):
+    embeddings = np.random.default_rng(0).normal(size=(20, DIMENSION)).astype(np.float32)
+    write_store_part(tmp_path, 0, 1, make_triples(20), embeddings, dtype=dtype)
+    rows = read_rows(get_embeddings_file(tmp_path, 0, 1))
+    expected = normalize_rows(embeddings) if dtype == "int8" else embeddings
+    assert rows.dtype == np.float32
+    assert np.abs(rows - expected).max() < tolerance
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_empty_part(tmp_path, dtype):
+    write_store_part(tmp_path, 0, 1, [], np.empty((0, DIMENSION), dtype=np.float32), dtype=dtype)
+    assert read_rows(get_embeddings_file(tmp_path, 0, 1)).shape == (0, DIMENSION)
+
+
+def test_compress_empty_part(tmp_path):
+    source_dir = tmp_path / "source"
+    write_store_part(source_dir, 0, NUM_EMBEDDING_PARTS, [], np.empty((0, DIMENSION), dtype=np.float32))
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    compress_part(0, source_dir, output_dir, "int8", projection=None)
+    assert read_rows(get_embeddings_file(output_dir, 0, NUM_EMBEDDING_PARTS)).shape == (0, DIMENSION)
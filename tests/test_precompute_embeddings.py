@@ -0,0 +1,37 @@
+import numpy as np
+
+from triple_clustering.embedding_store import get_embeddings_file, read_rows, write_store_part
+from triple_clustering.precompute_embeddings import embed_part
+
+DIMENSION = 8
+
+
+class FakeEncoder(object):
+    def encode(self, sentences):
+        rng = np.random.default_rng(len(sentences))
+        return rng.normal(size=(len(sentences), DIMENSION)).astype(np.float32)
+
+    def get_dimension(self):
+        return DIMENSION
+
+
+def make_triple(i):
+    return {"triple_id": f"triple-000-{i:07d}", "subject": "s", "predicate": "p", "object": f"o{i % 3}",
+            "count": 3, "subject_type": "t", "super_subject": "s"}
+
+
+def test_embed_part_shape(tmp_path):
+    triples = [make_triple(i) for i in range(5)]
+    embeddings = embed_part(triples, FakeEncoder(), None, tmp_path / "checkpoints")
+    assert embeddings.shape == (5, DIMENSION)
+    # equal sentences get the same embedding
+    assert np.array_equal(embeddings[0], embeddings[3])
+
+
+def test_embed_empty_part(tmp_path):
+    embeddings = embed_part([], FakeEncoder(), None, tmp_path / "checkpoints")
+    assert embeddings.shape == (0, DIMENSION)
+    assert embeddings.dtype == np.float32
+
+    write_store_part(tmp_path / "store", 0, 1, [], embeddings)
+    assert read_rows(get_embeddings_file(tmp_path / "store", 0, 1)).shape == (0, DIMENSION)
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import cdist
+
+BLOCK_SIZE = 512
+
+
+def condensed_distances(embeddings: np.ndarray, num_threads: int = 1, block_size: int = BLOCK_SIZE) -> np.ndarray:
+    # Euclidean distances in the condensed layout of scipy.spatial.distance.pdist, computed in row blocks
+    # of the upper triangle by several threads. cdist uses the same per-pair kernel as pdist, so the values
+    # are the ones pdist would compute.
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float64)
+    n = len(embeddings)
+    dists = np.empty(n * (n - 1) // 2, dtype=np.float64)
+
+    def fill_block(start: int):
+        end = min(start + block_size, n)
+        block = cdist(embeddings[start:end], embeddings[start:])
+        for i in range(start, end):
+            offset = n * i - i * (i + 1) // 2
+            dists[offset:(offset + n - i - 1)] = block[i - start, (i - start + 1):]
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(fill_block, range(0, n, block_size)))
+
+    return dists
+
+
+def ward_tree(embeddings: np.ndarray, num_threads: int = 1, block_size: int = BLOCK_SIZE) -> np.ndarray:
+    # scipy linkage matrix: one row (cluster a, cluster b, merge distance, size) per merge
+    return linkage(condensed_distances(embeddings, num_threads, block_size), method="ward")
+
+
+def cut_tree(tree: np.ndarray, distance_threshold: float) -> np.ndarray:
+    # Same partition as AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold), which
+    # keeps exactly the Ward merges with distance < distance_threshold
+    return fcluster(tree, t=np.nextafter(distance_threshold, 0), criterion="distance") - 1
+
+
+def ward_labels(embeddings: np.ndarray, distance_threshold: float, num_threads: int = 1,
+                block_size: int = BLOCK_SIZE) -> np.ndarray:
+    return cut_tree(ward_tree(embeddings, num_threads, block_size), distance_threshold)
@@ -0,0 +1,123 @@
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# Per-subject clustering state for incremental assignment. Clusters are identified by the (predicate, object)
+# pairs of their members, which, unlike triple IDs, stay the same when the frequent triples are recomputed.
+# Centroids are means of unit-length embeddings. On every update, the centroids of existing clusters are recomputed
+# from the members that are still frequent triples; members that left are dropped, and so are clusters left
+# without members. Subjects without clusters have a state with no members.
+
+# New triples scored against all centroids with one matrix product
+BLOCK_SIZE = 1024
+
+
+def get_member_key(triple: Dict[str, Any]) -> Tuple[str, str]:
+    return triple["predicate"], triple["object"]
+
+
+def build_subject_state(dataset: Dict[str, Any], embeddings: np.ndarray,
+                        rep_triples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    id2row = {t["triple_id"]: i for i, t in enumerate(dataset["triples"])}
+    if rep_triples:
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    members = []
+    centroids = []
+    for rep in rep_triples:
+        rows = [id2row[triple_id] for triple_id in str(rep["triple_ids"]).split("|")]
+        members.append([get_member_key(dataset["triples"][row]) for row in rows])
+        centroids.append(embeddings[rows].mean(axis=0))
+
+    return {
+        "subject": dataset["subject"],
+        "subject_type": dataset["subject_type"],
+        "super_subject": dataset["super_subject"],
+        "members": members,
+        "centroids": np.array(centroids, dtype=np.float32),
+        "sizes": np.array([len(m) for m in members], dtype=np.int64),
+    }
+
+
+def assign_to_clusters(state: Dict[str, Any], triples: List[Dict[str, Any]], embeddings: np.ndarray,
+                       distance_threshold: float, block_size: int = BLOCK_SIZE) -> Tuple[List[int], Dict[str, Any]]:
+    # Triples already in a cluster keep it, and the clusters are renumbered without the ones that lost all members.
+    # Every new triple, in order, joins the cluster whose Ward merge distance
+    # sqrt(2n / (n + 1)) * ||x - centroid|| is smallest, if that is below the threshold, like the agglomerative
+    # clustering would merge it; otherwise it starts a new cluster.
+    key2cluster = {key: c for c, members in enumerate(state["members"]) for key in members}
+
+    assignment = []
+    new_rows = []
+    for row, t in enumerate(triples):
+        cluster = key2cluster.get(get_member_key(t))
+        assignment.append(cluster)
+        if cluster is None:
+            new_rows.append(row)
+
+    old_rows = [row for row, cluster in enumerate(assignment) if cluster is not None]
+    renumber = {cluster: i for i, cluster in enumerate(sorted({assignment[row] for row in old_rows}))}
+    for row in old_rows:
+        assignment[row] = renumber[assignment[row]]
+
+    # Room for one new cluster per new triple; centroids are updated in place
+    num_clusters = len(renumber)
+    capacity = num_clusters + len(new_rows)
+    dims = embeddings.shape[1] if len(triples) > 0 else 0
+    centroids = np.zeros((capacity, dims), dtype=np.float32)
+    sizes = np.zeros(capacity, dtype=np.int64)
+    for start in range(0, len(old_rows), block_size):
+        block_rows = old_rows[start:(start + block_size)]
+        block = np.asarray(embeddings[block_rows], dtype=np.float32)
+        block_clusters = [assignment[row] for row in block_rows]
+        np.add.at(centroids, block_clusters, block / np.linalg.norm(block, axis=1, keepdims=True))
+        np.add.at(sizes, block_clusters, 1)
+    centroids[:num_clusters] /= sizes[:num_clusters, None]
+
+    for start in range(0, len(new_rows), block_size):
+        block_rows = new_rows[start:(start + block_size)]
+        block = np.asarray(embeddings[block_rows], dtype=np.float32)
+        block = block / np.linalg.norm(block, axis=1, keepdims=True)
+
+        # ||x - c||^2 against the centroids at the start of the block. Centroids changed or created by earlier
+        # triples of the block are recomputed per triple, so the result is the same as scoring one by one.
+        num_scored = num_clusters
+        scored = centroids[:num_scored]
+        block_sq_dists = (np.sum(scored ** 2, axis=1)[None, :] - 2 * block @ scored.T
+                          + np.sum(block ** 2, axis=1)[:, None])
+        changed = []
+        changed_set = set()
+
+        for row, x, sq_dists in zip(block_rows, block, block_sq_dists):
+            cluster = None
+            if num_clusters > 0:
+                recompute = np.array(changed + list(range(num_scored, num_clusters)), dtype=np.int64)
+                if len(recompute) > 0:
+                    sq_dists = np.concatenate([sq_dists, np.zeros(num_clusters - num_scored)])
+                    sq_dists[recompute] = np.sum((centroids[recompute] - x) ** 2, axis=1)
+                n = sizes[:num_clusters].astype(np.float64)
+                distances = np.sqrt(2 * n / (n + 1) * np.maximum(sq_dists, 0))
+                nearest = int(np.argmin(distances))
+                if distances[nearest] < distance_threshold:
+                    cluster = nearest
+
+            if cluster is None:
+                cluster = num_clusters
+                centroids[cluster] = x
+                sizes[cluster] = 1
+                num_clusters += 1
+            else:
+                centroids[cluster] = (centroids[cluster] * sizes[cluster] + x) / (sizes[cluster] + 1)
+                sizes[cluster] += 1
+                if cluster < num_scored and cluster not in changed_set:
+                    changed.append(cluster)
+                    changed_set.add(cluster)
+            assignment[row] = cluster
+
+    members = [[] for _ in range(num_clusters)]
+    for t, cluster in zip(triples, assignment):
+        members[cluster].append(get_member_key(t))
+
+    new_state = dict(state, members=members, centroids=centroids[:num_clusters].copy(),
+                     sizes=sizes[:num_clusters].copy())
+    return assignment, new_state
@@ -1,15 +1,22 @@
 import argparse
 import csv
+import heapq
 import logging
 import pickle
+from collections import Counter
+from functools import partial
 from multiprocessing import Pool
 from pathlib import Path
-from typing import Union, NamedTuple, Any, Dict, List
+from typing import Union, NamedTuple, Any, Dict, List, Tuple, Optional
 
 import numpy as np
 from sklearn.cluster import AgglomerativeClustering
+from sklearn.neighbors import kneighbors_graph
 
 from app_config import WORKING_DIR
+from .blocked_linkage import ward_labels, ward_tree, cut_tree
+from .cluster_state import build_subject_state
+from .embedding_store import has_store, read_store_part, read_embedding_rows, count_subject_triples
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -20,8 +27,22 @@ logger = logging.getLogger(__name__)
 NUM_EMBEDDING_PARTS = 64
 MAX_TRIPLES = int(5e4)
 
+# exact: full agglomerative clustering on at most MAX_TRIPLES triples per subject
+# knn: agglomerative clustering constrained to a sparse k-nearest-neighbor graph, without the MAX_TRIPLES cut
+# auto: exact for subjects with at most MAX_TRIPLES triples, knn for larger ones
+ENGINES = ["exact", "knn", "auto"]
+KNN_NEIGHBORS = 30
+
+# Subjects with more triples are clustered after the pool, one at a time, with all processors computing
+# their distance matrix
+LARGE_SUBJECT_SIZE = int(1e4)
+
 MIN_FREQ = 3
 
+DISTANCE_THRESHOLD = 0.5
+
+FIELDNAMES = ["subject", "predicate", "object", "count", "triple_ids", "subject_type", "super_subject"]
+
 
 class FineGrainedSubject(NamedTuple):
     subject: str
@@ -36,36 +57,68 @@ def read_triples_and_embeddings(filename: Union[str, Path]) -> Dict[str, Any]:
     return stored_data
 
 
-def get_data_for_subject(subject: FineGrainedSubject, all_data: List[Dict[str, Any]]) -> Dict[str, Any]:
-    triples = [t for d in all_data for t in d["triples"] if (
-            t["subject"] == subject.subject and
-            t["subject_type"] == subject.subject_type and
-            t["super_subject"] == subject.super_subject)][:MAX_TRIPLES]
-
-    embeddings = np.array(
-        [e for d in all_data for t, e in zip(d["triples"], d["embeddings"]) if (
-                t["subject"] == subject.subject and
-                t["subject_type"] == subject.subject_type and
-                t["super_subject"] == subject.super_subject)][:MAX_TRIPLES])
-
-    return {
+def build_subject_index(all_data: List[Dict[str, Any]]) -> Dict[Tuple[str, str, str], List[Tuple[int, np.ndarray]]]:
+    # (subject, subject_type, super_subject) -> [(part, row positions of the subject's triples in that part), ...],
+    # in file order
+    index = {}
+    for part, d in enumerate(all_data):
+        part_index = {}
+        for row, t in enumerate(d["triples"]):
+            subject = (t["subject"], t["subject_type"], t["super_subject"])
+            if subject not in part_index:
+                part_index[subject] = []
+            part_index[subject].append(row)
+
+        for subject, rows in part_index.items():
+            if subject not in index:
+                index[subject] = []
+            index[subject].append((part, np.array(rows, dtype=np.int64)))
+
+    return index
+
+
+def get_data_for_subject(subject: FineGrainedSubject, all_data: List[Dict[str, Any]],
+                         index: Dict[Tuple[str, str, str], List[Tuple[int, np.ndarray]]],
+                         max_triples: Optional[int] = MAX_TRIPLES) -> Dict[str, Any]:
+    positions = index.get(tuple(subject), [])
+    triples = []
+    embeddings = []
+    embedding_rows = []
+    remaining = max_triples if max_triples is not None else sum(len(rows) for _, rows in positions)
+    for part, rows in positions:
+        rows = rows[:remaining]
+        part_triples = [all_data[part]["triples"][row] for row in rows]
+        triples.extend(part_triples)
+        if "embeddings" in all_data[part]:
+            embeddings.append(all_data[part]["embeddings"][rows])
+        else:
+            # embedding store: workers read the rows from the memory-mapped matrix themselves
+            embedding_rows.append(
+                (all_data[part]["embeddings_file"], np.array([int(t["row"]) for t in part_triples], dtype=np.int64)))
+        remaining -= len(rows)
+        if remaining <= 0:
+            break
+
+    dataset = {
         "subject": subject.subject,
         "triples": triples,
-        "embeddings": embeddings,
         "subject_type": subject.subject_type,
         "super_subject": subject.super_subject,
     }
+    if embedding_rows:
+        dataset["embedding_rows"] = embedding_rows
+    else:
+        dataset["embeddings"] = np.concatenate(embeddings) if embeddings else np.array([])
+
+    return dataset
 
 
-def clustering(triples, embeddings, distance_threshold: float = 0.5) -> Dict[int, List[Dict[str, Any]]]:
+def normalize(embeddings: np.ndarray) -> np.ndarray:
     # Normalize the embeddings to unit length
-    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 
-    # Perform clustering
-    clustering_model = AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold)
-    clustering_model.fit(embeddings)
-    cluster_assignment = clustering_model.labels_
 
+def group_by_cluster(triples, cluster_assignment) -> Dict[int, List[Dict[str, Any]]]:
     clustered_triples = {}
     for sentence_id, cluster_id in enumerate(cluster_assignment):
         if cluster_id not in clustered_triples:
@@ -75,25 +128,86 @@ def clustering(triples, embeddings, distance_threshold: float = 0.5) -> Dict[int
     return clustered_triples
 
 
-def cluster_for_one_subject(dataset: Dict[str, Any]) -> List[Dict[str, str]]:
+def clustering(triples, embeddings, distance_threshold: float = DISTANCE_THRESHOLD, engine: str = "exact",
+               n_neighbors: int = KNN_NEIGHBORS, num_threads: int = 1) -> Dict[int, List[Dict[str, Any]]]:
+    embeddings = normalize(embeddings)
+
+    # Restricting merges to k-NN graph edges keeps memory at O(n * k) instead of O(n^2)
+    connectivity = None
+    if engine == "knn" or (engine == "auto" and len(embeddings) > MAX_TRIPLES):
+        connectivity = kneighbors_graph(embeddings, n_neighbors=min(n_neighbors, len(embeddings) - 1),
+                                        include_self=False, n_jobs=num_threads)
+
+    # Perform clustering
+    if connectivity is None and num_threads > 1:
+        cluster_assignment = ward_labels(embeddings, distance_threshold, num_threads=num_threads)
+    else:
+        clustering_model = AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold,
+                                                   connectivity=connectivity)
+        clustering_model.fit(embeddings)
+        cluster_assignment = clustering_model.labels_
+
+    return group_by_cluster(triples, cluster_assignment)
+
+
+def estimate_cost(num_triples: int, max_triples: Optional[int] = MAX_TRIPLES) -> int:
+    # agglomerative clustering is roughly quadratic in the number of triples
+    if max_triples is not None:
+        num_triples = min(num_triples, max_triples)
+    return num_triples ** 2
+
+
+def lpt_partitions(costs: List[int], num_partitions: int) -> List[List[int]]:
+    # Longest processing time first: every item, largest first, goes to the currently least loaded partition
+    loads = [(0, k) for k in range(num_partitions)]
+    partitions = [[] for _ in range(num_partitions)]
+    for i in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+        load, k = heapq.heappop(loads)
+        partitions[k].append(i)
+        heapq.heappush(loads, (load + costs[i], k))
+    return [sorted(partition) for partition in partitions]
+
+
+def get_single_rep_triple(rep: Dict[str, Any]) -> List[Dict[str, str]]:
+    return [{
+        "subject": rep["subject"],
+        "predicate": rep["predicate"],
+        "object": rep["object"],
+        "count": rep["count"],
+        "triple_ids": rep["triple_id"],
+        "subject_type": rep["subject_type"],
+        "super_subject": rep["super_subject"],
+    }]
+
+
+def get_dataset_embeddings(dataset: Dict[str, Any]) -> np.ndarray:
+    if "embeddings" in dataset:
+        return dataset["embeddings"]
+    return read_embedding_rows(dataset["embedding_rows"])
+
+
+def cluster_for_one_subject(dataset: Dict[str, Any], engine: str = "exact", n_neighbors: int = KNN_NEIGHBORS,
+                            num_threads: int = 1, distance_threshold: float = DISTANCE_THRESHOLD) \
+        -> List[Dict[str, str]]:
     if len(dataset["triples"]) == 0:
         return []
     elif len(dataset["triples"]) == 1:
-        rep = dataset["triples"][0]
-        return [{
-            "subject": rep["subject"],
-            "predicate": rep["predicate"],
-            "object": rep["object"],
-            "count": rep["count"],
-            "triple_ids": rep["triple_id"],
-            "subject_type": rep["subject_type"],
-            "super_subject": rep["super_subject"],
-        }]
+        return get_single_rep_triple(dataset["triples"][0])
 
-    rep_triples = []
+    embeddings = get_dataset_embeddings(dataset)
 
     logger.info(f"  - Clustering subject \"{dataset['subject']}\" - {(len(dataset['triples'])):,} triples")
-    clustered_triples = clustering(dataset["triples"], dataset["embeddings"])
+    clustered_triples = clustering(dataset["triples"], embeddings, distance_threshold=distance_threshold,
+                                   engine=engine, n_neighbors=n_neighbors, num_threads=num_threads)
+    rep_triples = get_rep_triples(clustered_triples)
+    logger.info(
+        f"  + There are {(len(rep_triples)):,} cluster triples for subject \"{dataset['subject']}\"")
+
+    return rep_triples
+
+
+def get_rep_triples(clustered_triples: Dict[int, List[Dict[str, Any]]]) -> List[Dict[str, str]]:
+    rep_triples = []
     sorted_clustered_triples = sorted(clustered_triples.values(), key=lambda cls: sum(int(t["count"]) for t in cls),
                                       reverse=True)
     for cluster in sorted_clustered_triples:
@@ -108,12 +222,45 @@ def cluster_for_one_subject(dataset: Dict[str, Any]) -> List[Dict[str, str]]:
             "subject_type": rep["subject_type"],
             "super_subject": rep["super_subject"],
         })
-    logger.info(
-        f"  + There are {(len(sorted_clustered_triples)):,} cluster triples for subject \"{dataset['subject']}\"")
 
     return rep_triples
 
 
+def dendrogram_for_one_subject(dataset: Dict[str, Any], num_threads: int = 1) -> Dict[str, Any]:
+    # Full Ward tree of the subject, which can be cut at any distance threshold later
+    tree = None
+    if len(dataset["triples"]) > 1:
+        logger.info(f"  - Building dendrogram of subject \"{dataset['subject']}\" - "
+                    f"{(len(dataset['triples'])):,} triples")
+        tree = ward_tree(normalize(get_dataset_embeddings(dataset)), num_threads=num_threads)
+
+    return {
+        "subject": dataset["subject"],
+        "subject_type": dataset["subject_type"],
+        "super_subject": dataset["super_subject"],
+        "triples": [{k: t[k] for k in ["triple_id", "subject", "predicate", "object", "count", "subject_type",
+                                       "super_subject"]} for t in dataset["triples"]],
+        "tree": tree,
+    }
+
+
+def cut_dendrogram(dendrogram: Dict[str, Any], distance_threshold: float) -> List[Dict[str, str]]:
+    if len(dendrogram["triples"]) == 0:
+        return []
+    elif len(dendrogram["triples"]) == 1:
+        return get_single_rep_triple(dendrogram["triples"][0])
+
+    cluster_assignment = cut_tree(dendrogram["tree"], distance_threshold)
+    return get_rep_triples(group_by_cluster(dendrogram["triples"], cluster_assignment))
+
+
+def write_rep_triples(output_file: Union[str, Path], rep_triples: List[Dict[str, str]]):
+    with open(output_file, "w+") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rep_triples)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--subjects", type=str, required=True)
@@ -121,11 +268,34 @@ def main():
     parser.add_argument("--embeddings_dir", type=str,
                         default=f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}_embeddings/")
     parser.add_argument("--num_processors", type=int, default=64)
-    parser.add_argument("--id", type=int, required=True)
-    parser.add_argument("--step", type=int, required=True)
+    parser.add_argument("--id", type=int)
+    parser.add_argument("--step", type=int)
+    parser.add_argument("--num_partitions", type=int,
+                        help="Split subjects into this many partitions of balanced estimated cost, instead of "
+                             "--id/--step slices")
+    parser.add_argument("--partition", type=int)
+    parser.add_argument("--engine", type=str, choices=ENGINES, default="exact")
+    parser.add_argument("--knn_neighbors", type=int, default=KNN_NEIGHBORS)
+    parser.add_argument("--large_subject_size", type=int, default=LARGE_SUBJECT_SIZE)
+    parser.add_argument("--distance_threshold", type=float, default=DISTANCE_THRESHOLD)
+    parser.add_argument("--dendrogram_dir", type=str,
+                        help="Also store the full Ward tree of every subject here, to be cut at other thresholds "
+                             "by triple_clustering.cut_dendrograms (exact engine only)")
+    parser.add_argument("--state_dir", type=str,
+                        help="Also store cluster centroids and members here, for triple_clustering.incremental")
 
     args = parser.parse_args()
 
+    if args.dendrogram_dir is not None:
+        assert args.engine == "exact"
+
+    if args.num_partitions is not None:
+        assert args.partition is not None and 0 <= args.partition < args.num_partitions
+    else:
+        assert args.id is not None and args.step is not None
+
+    max_triples = MAX_TRIPLES if args.engine == "exact" else None
+
     logger.info(f"Reading subject file \"{args.subjects}\"")
     subjects = []
     with open(args.subjects) as f:
@@ -138,44 +308,114 @@ def main():
             ))
     logger.info(f"There are {len(subjects):,} subjects in total")
 
-    out_num_parts = int(len(subjects) / args.step) + 1
-    out_part_id = int(args.id / args.step)
-
-    subjects = subjects[args.id:(args.id + args.step)]
+    embeddings_dir = Path(args.embeddings_dir)
+    use_store = has_store(embeddings_dir, NUM_EMBEDDING_PARTS)
+    if not use_store:
+        logger.info("Reading triples and precomputed embeddings from disk")
+        embeddings_filenames = [embeddings_dir / f"embeddings-{i:03d}-of-{NUM_EMBEDDING_PARTS:03d}.pkl" for i in
+                                range(NUM_EMBEDDING_PARTS)]
+        with Pool(args.num_processors) as p:
+            all_data = p.map(read_triples_and_embeddings, embeddings_filenames)
+        # all_data = []
+        # for embeddings_filename in embeddings_filenames:
+        #     all_data.append(read_triples_and_embeddings(embeddings_filename))
+        logger.info(f"There are {(sum(len(data['triples']) for data in all_data)):,} triples in total")
+
+        logger.info("Indexing triples by subject")
+        index = build_subject_index(all_data)
+        logger.info(f"There are {len(index):,} subjects in the index")
+
+    if args.num_partitions is not None:
+        logger.info("Estimating clustering cost of all subjects")
+        if use_store:
+            func = partial(count_subject_triples, embeddings_dir, num_parts=NUM_EMBEDDING_PARTS)
+            with Pool(args.num_processors) as p:
+                counts = sum(p.map(func, range(NUM_EMBEDDING_PARTS)), Counter())
+        else:
+            counts = {subject: sum(len(rows) for _, rows in positions) for subject, positions in index.items()}
+        costs = [estimate_cost(counts.get(tuple(subject), 0), max_triples) for subject in subjects]
+
+        out_num_parts = args.num_partitions
+        out_part_id = args.partition
+        selected = lpt_partitions(costs, args.num_partitions)[args.partition]
+        logger.info(f"Partition {args.partition} / {args.num_partitions}: {len(selected):,} subjects, "
+                    f"estimated cost {sum(costs[i] for i in selected):,} / {sum(costs):,}")
+        subjects = [subjects[i] for i in selected]
+    else:
+        out_num_parts = int(len(subjects) / args.step) + 1
+        out_part_id = int(args.id / args.step)
+
+        subjects = subjects[args.id:(args.id + args.step)]
     logger.info(f"Selected subjects: {subjects}")
 
-    logger.info("Reading triples and precomputed embeddings from disk")
-    embeddings_dir = Path(args.embeddings_dir)
-    embeddings_filenames = [embeddings_dir / f"embeddings-{i:03d}-of-{NUM_EMBEDDING_PARTS:03d}.pkl" for i in
-                            range(NUM_EMBEDDING_PARTS)]
-    with Pool(args.num_processors) as p:
-        all_data = p.map(read_triples_and_embeddings, embeddings_filenames)
-    # all_data = []
-    # for embeddings_filename in embeddings_filenames:
-    #     all_data.append(read_triples_and_embeddings(embeddings_filename))
-    logger.info(f"There are {(sum(len(data['triples']) for data in all_data)):,} triples in total")
+    if use_store:
+        logger.info(f"Reading triples of the selected subjects from embedding store \"{embeddings_dir}\"")
+        func = partial(read_store_part, embeddings_dir, num_parts=NUM_EMBEDDING_PARTS,
+                       subjects={tuple(subject) for subject in subjects})
+        with Pool(args.num_processors) as p:
+            all_data = p.map(func, range(NUM_EMBEDDING_PARTS))
+        index = build_subject_index(all_data)
 
     logger.info("Getting triples to be computed")
-    datasets = [get_data_for_subject(subject, all_data) for subject in subjects]
+    datasets = [get_data_for_subject(subject, all_data, index, max_triples=max_triples)
+                for subject in subjects]
     logger.info(
         f"There are {(sum(len(dataset['triples']) for dataset in datasets)):,} triples of the {len(subjects)} "
         f"subjects to be processed")
 
     logger.info("Clustering started")
+    # Largest estimated cost first, one subject per task, so that no big subject starts last (LPT)
+    costs = [estimate_cost(len(dataset["triples"]), max_triples=None) for dataset in datasets]
+    order = sorted(range(len(datasets)), key=lambda i: costs[i], reverse=True)
+    large = [i for i in order if len(datasets[i]["triples"]) > args.large_subject_size]
+    small = [i for i in order if len(datasets[i]["triples"]) <= args.large_subject_size]
+
+    if args.dendrogram_dir is not None:
+        func = dendrogram_for_one_subject
+    else:
+        func = partial(cluster_for_one_subject, engine=args.engine, n_neighbors=args.knn_neighbors,
+                       distance_threshold=args.distance_threshold)
+
+    results = [None for _ in datasets]
     with Pool(args.num_processors) as p:
-        all_rep_triples = p.map(cluster_for_one_subject, datasets)
+        for i, result in zip(small, p.imap(func, [datasets[i] for i in small], chunksize=1)):
+            results[i] = result
+
+    # Large subjects use all processors each: blocked multi-threaded distances for the exact engine,
+    # parallel neighbor search for the knn engine
+    logger.info(f"Clustering {len(large)} subjects with more than {args.large_subject_size:,} triples")
+    for i in large:
+        results[i] = func(datasets[i], num_threads=args.num_processors)
+
+    if args.dendrogram_dir is not None:
+        dendrogram_dir = Path(args.dendrogram_dir)
+        dendrogram_dir.mkdir(exist_ok=True)
+        dendrogram_file = dendrogram_dir / f"dendrograms-{out_part_id:05d}-of-{out_num_parts:05d}.pkl"
+        logger.info(f"Writing dendrograms to \"{dendrogram_file}\"")
+        with open(dendrogram_file, "wb") as f_out:
+            pickle.dump(results, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+        all_rep_triples = [cut_dendrogram(dendrogram, args.distance_threshold) for dendrogram in results]
+    else:
+        all_rep_triples = results
 
     logger.info(f"There are {(sum(len(rep_triples) for rep_triples in all_rep_triples)):,} clustered triples in total")
 
+    if args.state_dir is not None:
+        state_dir = Path(args.state_dir)
+        state_dir.mkdir(exist_ok=True)
+        state_file = state_dir / f"state-{out_part_id:05d}-of-{out_num_parts:05d}.pkl"
+        logger.info(f"Writing cluster states to \"{state_file}\"")
+        # also subjects without triples, whose new triples incremental clusters from scratch
+        states = [build_subject_state(dataset, get_dataset_embeddings(dataset), rep_triples)
+                  for dataset, rep_triples in zip(datasets, all_rep_triples)]
+        with open(state_file, "wb") as f_out:
+            pickle.dump(states, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+
     output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
     output_file = output_dir / f"triples-{out_part_id:05d}-of-{out_num_parts:05d}.csv"
     logger.info(f"Writing results to \"{output_file}\"")
-    with open(output_file, "w+") as f:
-        writer = csv.DictWriter(f, fieldnames=["subject", "predicate", "object", "count", "triple_ids", "subject_type",
-                                               "super_subject"])
-        writer.writeheader()
-        writer.writerows([rep for rep_triples in all_rep_triples for rep in rep_triples])
+    write_rep_triples(output_file, [rep for rep_triples in all_rep_triples for rep in rep_triples])
 
     logger.info("Finished.")
 
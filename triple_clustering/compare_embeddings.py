@@ -0,0 +1,139 @@
+import argparse
+import logging
+import random
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+from app_config import WORKING_DIR
+from .blocked_linkage import ward_labels
+from .clustering import FineGrainedSubject, NUM_EMBEDDING_PARTS, MIN_FREQ, DISTANCE_THRESHOLD, normalize, \
+    build_subject_index, get_data_for_subject, get_dataset_embeddings
+from .cpu_encoder import encode_on_cpu, start_cpu_pool
+from .embedding_store import has_store, read_store_part, count_subject_triples
+from .precompute_embeddings import MODEL_NAME, make_sentence
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+# Triples per subject whose pairwise similarities are compared
+MAX_SIMILARITY_ROWS = 1000
+
+
+def compare_partitions(embeddings: np.ndarray, other_embeddings: np.ndarray,
+                       distance_threshold: float = DISTANCE_THRESHOLD) -> Dict[str, Any]:
+    # How the clusters of one subject change when its embeddings are replaced. Similarities are compared instead
+    # of the embeddings themselves, which may live in different (e.g. PCA-reduced) spaces.
+    embeddings = normalize(np.asarray(embeddings, dtype=np.float64))
+    other_embeddings = normalize(np.asarray(other_embeddings, dtype=np.float64))
+    labels = ward_labels(embeddings, distance_threshold)
+    other_labels = ward_labels(other_embeddings, distance_threshold)
+
+    return {
+        "num_triples": len(embeddings),
+        "ari": adjusted_rand_score(labels, other_labels),
+        "num_clusters": len(set(labels)),
+        "other_num_clusters": len(set(other_labels)),
+        "similarity_error": float(np.mean(np.abs(
+            embeddings[:MAX_SIMILARITY_ROWS] @ embeddings[:MAX_SIMILARITY_ROWS].T
+            - other_embeddings[:MAX_SIMILARITY_ROWS] @ other_embeddings[:MAX_SIMILARITY_ROWS].T))),
+    }
+
+
+def summarize(results: List[Dict[str, Any]]):
+    logger.info(f"Subjects: {len(results):,}, triples: {sum(r['num_triples'] for r in results):,}")
+    logger.info(f"Mean absolute error of pairwise cosine similarities: "
+                f"{np.mean([r['similarity_error'] for r in results]):.5f}")
+    logger.info(f"Mean adjusted Rand index of clusterings: {np.mean([r['ari'] for r in results]):.5f}, "
+                f"min: {min(r['ari'] for r in results):.5f}")
+    logger.info(f"Subjects with identical clusterings: {sum(r['ari'] == 1.0 for r in results):,}")
+    num_clusters = sum(r["num_clusters"] for r in results)
+    other_num_clusters = sum(r["other_num_clusters"] for r in results)
+    logger.info(f"Clusters: {num_clusters:,} -> {other_num_clusters:,} "
+                f"({((other_num_clusters - num_clusters) / num_clusters):+.2%})")
+
+
+def sample_subjects(embeddings_dir: Path, num_subjects: int, min_triples: int, max_triples: int,
+                    seed: int) -> List[FineGrainedSubject]:
+    counter = Counter()
+    for part in range(NUM_EMBEDDING_PARTS):
+        counter.update(count_subject_triples(embeddings_dir, part, NUM_EMBEDDING_PARTS))
+    candidates = sorted(FineGrainedSubject(*subject) for subject, count in counter.items()
+                        if min_triples <= count <= max_triples)
+    random.Random(seed).shuffle(candidates)
+    return candidates[:num_subjects]
+
+
+def read_datasets(embeddings_dir: Path, subjects: List[FineGrainedSubject]) -> List[Dict[str, Any]]:
+    all_data = [read_store_part(embeddings_dir, part, NUM_EMBEDDING_PARTS, subjects={tuple(s) for s in subjects})
+                for part in range(NUM_EMBEDDING_PARTS)]
+    index = build_subject_index(all_data)
+    datasets = [get_data_for_subject(subject, all_data, index, max_triples=None) for subject in subjects]
+    for dataset in datasets:
+        dataset["embeddings"] = get_dataset_embeddings(dataset)
+    return datasets
+
+
+def align_embeddings(dataset: Dict[str, Any], other_dataset: Dict[str, Any]) -> np.ndarray:
+    # embeddings of the other dataset in the order of the triples of the first one
+    id2row = {t["triple_id"]: i for i, t in enumerate(other_dataset["triples"])}
+    return other_dataset["embeddings"][[id2row[t["triple_id"]] for t in dataset["triples"]]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Clusters a sample of subjects with the stored float32 embeddings and with other embeddings "
+                    "of the same triples, re-computed on CPU or read from another store, and reports how the "
+                    "clusters change")
+    parser.add_argument("--embeddings_dir", type=str,
+                        default=f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}_embeddings/")
+    parser.add_argument("--other_embeddings_dir", type=str,
+                        help="Compare with this store, e.g. written by triple_clustering.compress_embeddings, "
+                             "instead of re-computing the embeddings")
+    parser.add_argument("--num_subjects", type=int, default=200)
+    parser.add_argument("--min_triples", type=int, default=10)
+    parser.add_argument("--max_triples", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--distance_threshold", type=float, default=DISTANCE_THRESHOLD)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--threads_per_worker", type=int, default=4)
+    parser.add_argument("--quantize", action="store_true")
+
+    args = parser.parse_args()
+
+    embeddings_dir = Path(args.embeddings_dir)
+    assert has_store(embeddings_dir, NUM_EMBEDDING_PARTS), "the baseline is read from the embedding store"
+
+    subjects = sample_subjects(embeddings_dir, args.num_subjects, args.min_triples, args.max_triples, args.seed)
+    logger.info(f"Sampled {len(subjects):,} subjects")
+    datasets = read_datasets(embeddings_dir, subjects)
+
+    if args.other_embeddings_dir is not None:
+        other_datasets = read_datasets(Path(args.other_embeddings_dir), subjects)
+        other_embeddings = np.concatenate([align_embeddings(dataset, other_dataset)
+                                           for dataset, other_dataset in zip(datasets, other_datasets)])
+    else:
+        sentences = [make_sentence(t) for dataset in datasets for t in dataset["triples"]]
+        with start_cpu_pool(MODEL_NAME, args.num_workers, args.threads_per_worker, args.quantize) as pool:
+            other_embeddings = encode_on_cpu(sentences, MODEL_NAME, pool,
+                                             args.num_workers * args.threads_per_worker)
+
+    results = []
+    start = 0
+    for dataset in datasets:
+        end = start + len(dataset["triples"])
+        results.append(compare_partitions(dataset["embeddings"], other_embeddings[start:end],
+                                          args.distance_threshold))
+        start = end
+
+    summarize(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import logging
+import shutil
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from app_config import WORKING_DIR
+from .clustering import NUM_EMBEDDING_PARTS, MIN_FREQ
+from .embedding_store import STORE_DTYPES, has_store, get_embeddings_file, get_metadata_file, open_embeddings, \
+    read_rows, normalize_rows, write_embeddings_file
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+PROJECTION_FILE = "projection.npy"
+
+
+def sample_rows(embeddings_dir: Path, sample_size: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    samples = []
+    for part in range(NUM_EMBEDDING_PARTS):
+        embeddings_file = get_embeddings_file(embeddings_dir, part, NUM_EMBEDDING_PARTS)
+        num_rows = len(open_embeddings(embeddings_file))
+        size = min(num_rows, sample_size // NUM_EMBEDDING_PARTS + 1)
+        samples.append(read_rows(embeddings_file, np.sort(rng.choice(num_rows, size=size, replace=False))))
+    return normalize_rows(np.concatenate(samples))
+
+
+def fit_projection(sample: np.ndarray, dims: int) -> np.ndarray:
+    # Uncentered PCA (truncated SVD) of unit vectors: the projections keep most of the vector length, so the
+    # cosine geometry that the clustering sees after normalization is preserved
+    _, singular_values, vt = np.linalg.svd(sample, full_matrices=False)
+    energy = np.sum(singular_values[:dims] ** 2) / np.sum(singular_values ** 2)
+    logger.info(f"{dims} components keep {energy:.2%} of the energy")
+    return vt[:dims].T.astype(np.float32)
+
+
+def compress_part(part: int, embeddings_dir: Path, output_dir: Path, dtype: str,
+                  projection: Optional[np.ndarray]):
+    embeddings_file = get_embeddings_file(embeddings_dir, part, NUM_EMBEDDING_PARTS)
+    logger.info(f"Compressing \"{embeddings_file}\"")
+    # read_rows() applies the scales of an int8 source store
+    embeddings = normalize_rows(read_rows(embeddings_file))
+    if projection is not None:
+        embeddings = normalize_rows(embeddings @ projection)
+
+    write_embeddings_file(get_embeddings_file(output_dir, part, NUM_EMBEDDING_PARTS), embeddings, dtype)
+    # same triples and rows
+    shutil.copyfile(get_metadata_file(embeddings_dir, part, NUM_EMBEDDING_PARTS),
+                    get_metadata_file(output_dir, part, NUM_EMBEDDING_PARTS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a smaller copy of an embedding store")
+    parser.add_argument("--embeddings_dir", type=str,
+                        default=f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}_embeddings/")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--dtype", type=str, choices=STORE_DTYPES, default="float16")
+    parser.add_argument("--pca_dims", type=int, help="Also reduce the embeddings to this many dimensions")
+    parser.add_argument("--pca_sample_size", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--num_processors", type=int, default=16)
+
+    args = parser.parse_args()
+
+    embeddings_dir = Path(args.embeddings_dir)
+    assert has_store(embeddings_dir, NUM_EMBEDDING_PARTS)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True)
+
+    projection = None
+    if args.pca_dims is not None:
+        logger.info(f"Fitting a {args.pca_dims}-dimensional projection on {args.pca_sample_size:,} sampled rows")
+        projection = fit_projection(sample_rows(embeddings_dir, args.pca_sample_size, args.seed), args.pca_dims)
+        # not needed by readers, but needed to add new embeddings to the store
+        np.save(output_dir / PROJECTION_FILE, projection)
+
+    func = partial(compress_part, embeddings_dir=embeddings_dir, output_dir=output_dir, dtype=args.dtype,
+                   projection=projection)
+    with Pool(args.num_processors) as p:
+        p.map(func, range(NUM_EMBEDDING_PARTS))
+
+    logger.info("Done")
+
+
+if __name__ == '__main__':
+    main()
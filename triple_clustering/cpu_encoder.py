@@ -0,0 +1,89 @@
+import logging
+import time
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import List
+
+import numpy as np
+
+from inference_runtime.batching import MAX_BATCH_SIZE, TOKEN_BUDGET, get_length_buckets, get_token_lengths
+
+logger = logging.getLogger(__name__)
+
+# Half the budget of the GPU stages: a CPU worker runs with a few threads only, so bigger batches add no throughput,
+# just memory in every worker
+CPU_TOKEN_BUDGET = TOKEN_BUDGET // 2
+
+# Max. sequence length of the SentenceTransformer, which truncates longer sentences
+MAX_SEQ_LENGTH = 128
+
+_model = None
+
+
+def get_cache_model_name(model_name: str, quantize: bool) -> str:
+    # int8 embeddings differ from float32 ones, so they are cached under their own name
+    return f"{model_name}#int8" if quantize else model_name
+
+
+def load_cpu_model(model_name: str, num_threads: int, quantize: bool):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    model = SentenceTransformer(model_name, device="cpu")
+    if quantize:
+        # int8 weights for all linear layers, activations quantized on the fly
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_name: str):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+def init_worker(model_name: str, num_threads: int, quantize: bool):
+    global _model
+    _model = load_cpu_model(model_name, num_threads, quantize)
+
+
+def encode_batch(sentences: List[str]) -> np.ndarray:
+    return _model.encode(sentences, batch_size=len(sentences), show_progress_bar=False, convert_to_numpy=True)
+
+
+def get_embedding_dimension() -> int:
+    return _model.get_sentence_embedding_dimension()
+
+
+def start_cpu_pool(model_name: str, num_workers: int, threads_per_worker: int, quantize: bool = False) -> Pool:
+    # Every worker loads the model once; the pool can encode any number of sentence lists
+    logger.info(f"Starting {num_workers} workers x {threads_per_worker} threads, quantize: {quantize}")
+    return Pool(num_workers, initializer=init_worker, initargs=(model_name, threads_per_worker, quantize))
+
+
+def encode_on_cpu(sentences: List[str], model_name: str, pool: Pool, num_cores: int,
+                  token_budget: int = CPU_TOKEN_BUDGET, max_batch_size: int = MAX_BATCH_SIZE) -> np.ndarray:
+    if len(sentences) == 0:
+        return np.empty((0, pool.apply(get_embedding_dimension)), dtype=np.float32)
+
+    lengths = get_token_lengths(sentences, get_tokenizer(model_name), max_length=MAX_SEQ_LENGTH)
+    batches = get_length_buckets(lengths, token_budget, max_batch_size)
+    logger.info(f"{len(sentences):,} sentences in {len(batches):,} length-bucketed batches")
+
+    start = time.time()
+    embeddings = None
+    results = pool.imap(encode_batch, [[sentences[i] for i in batch] for batch in batches], chunksize=1)
+    for batch, batch_embeddings in zip(batches, results):
+        if embeddings is None:
+            embeddings = np.empty((len(sentences), batch_embeddings.shape[1]), dtype=np.float32)
+        embeddings[batch] = batch_embeddings
+    elapsed = time.time() - start
+
+    logger.info(f"Encoded {len(sentences):,} sentences in {elapsed:.1f}s: {(len(sentences) / elapsed):,.1f} "
+                f"sentences/s, {(len(sentences) / elapsed / num_cores):,.1f} sentences/s per core")
+    return embeddings
@@ -0,0 +1,60 @@
+import argparse
+import logging
+import pickle
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List
+
+from app_config import WORKING_DIR
+from .clustering import cut_dendrogram, write_rep_triples
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+
+def get_output_dir(output_dir: Path, distance_threshold: float) -> Path:
+    return output_dir / f"threshold-{distance_threshold}"
+
+
+def cut_file(dendrogram_file: Path, output_dir: Path, thresholds: List[float]):
+    logger.info(f"Reading dendrograms from \"{dendrogram_file}\"")
+    with open(dendrogram_file, "rb") as f:
+        dendrograms = pickle.load(f)
+
+    # dendrograms-XXXXX-of-YYYYY.pkl -> triples-XXXXX-of-YYYYY.csv, as written by triple_clustering.clustering
+    output_name = dendrogram_file.stem.replace("dendrograms-", "triples-") + ".csv"
+    for threshold in thresholds:
+        rep_triples = [rep for dendrogram in dendrograms for rep in cut_dendrogram(dendrogram, threshold)]
+        output_file = get_output_dir(output_dir, threshold) / output_name
+        logger.info(f"Threshold {threshold}: {len(rep_triples):,} clustered triples written to \"{output_file}\"")
+        write_rep_triples(output_file, rep_triples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dendrogram_dir", type=str, required=True)
+    parser.add_argument("--thresholds", type=float, nargs="+", required=True)
+    parser.add_argument("--output_dir", type=str, default=f"{WORKING_DIR}/clustered_triples_thresholds/")
+    parser.add_argument("--num_processors", type=int, default=64)
+
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    for threshold in args.thresholds:
+        get_output_dir(output_dir, threshold).mkdir(parents=True, exist_ok=True)
+
+    dendrogram_files = sorted(Path(args.dendrogram_dir).glob("dendrograms-*.pkl"))
+    logger.info(f"There are {len(dendrogram_files):,} dendrogram files")
+
+    with Pool(args.num_processors) as p:
+        p.map(partial(cut_file, output_dir=output_dir, thresholds=args.thresholds), dendrogram_files)
+
+    logger.info("Done")
+
+
+if __name__ == '__main__':
+    main()
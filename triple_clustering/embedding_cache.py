@@ -0,0 +1,62 @@
+import hashlib
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+
+from app_config import WORKING_DIR
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_FILE = f"{WORKING_DIR}/embedding_cache/embeddings.sqlite"
+
+# Items are committed in chunks, so that the transaction of a large part stays small. One job writes to a file
+# at a time (see EmbeddingCache).
+WRITE_CHUNK_SIZE = 10_000
+READ_CHUNK_SIZE = 500
+
+
+def get_key(model_name: str, sentence: str) -> bytes:
+    return hashlib.sha1(f"{model_name}\0{sentence}".encode("utf-8")).digest()
+
+
+# Content-addressed store of sentence embeddings: the key is the hash of the model name and the sentence,
+# the value the float32 embedding. Shared by all parts and all runs; opt-in with precompute_embeddings --cache.
+# Entries never expire: a different model name (or "#int8" for quantized encoders) gives different keys, but
+# an encoder that changes under the same name needs a new or deleted cache file. SQLite serializes writers,
+# so jobs that run in parallel should each use their own file.
+class EmbeddingCache(object):
+    def __init__(self, filename: Union[str, Path], model_name: str):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.connection = sqlite3.connect(str(filename), timeout=600)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, embedding BLOB)")
+        self.connection.commit()
+
+    def get_many(self, sentences: Sequence[str]) -> Dict[str, np.ndarray]:
+        key2sentence = {get_key(self.model_name, s): s for s in sentences}
+        keys = list(key2sentence)
+        found = {}
+        for start in range(0, len(keys), READ_CHUNK_SIZE):
+            chunk = keys[start:(start + READ_CHUNK_SIZE)]
+            cursor = self.connection.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, embedding in cursor:
+                found[key2sentence[key]] = np.frombuffer(embedding, dtype=np.float32)
+        return found
+
+    def put_many(self, sentences: List[str], embeddings: np.ndarray):
+        assert len(sentences) == len(embeddings)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        for start in range(0, len(sentences), WRITE_CHUNK_SIZE):
+            end = start + WRITE_CHUNK_SIZE
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, embedding) VALUES (?, ?)",
+                ((get_key(self.model_name, s), e.tobytes()) for s, e in zip(sentences[start:end], embeddings[start:end]))
+            )
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,94 @@
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from triple_filtering.triple_io import get_triple_file, read_triples, write_triples
+
+# An embedding store part consists of a float matrix saved as .npy, which readers memory-map, and a Parquet
+# metadata table with one row per triple. The "row" column is the position of the triple's embedding in the matrix.
+METADATA_FIELDS = ["row", "triple_id", "subject", "predicate", "object", "count", "subject_type", "super_subject"]
+
+# float16 halves the matrix. int8 quarters it: vectors are normalized to unit length and every dimension is scaled
+# by its largest absolute value in the part, which is saved next to the matrix. Readers always get float32.
+STORE_DTYPES = ["float32", "float16", "int8"]
+
+
+def get_embeddings_file(directory: Union[str, Path], part: int, num_parts: int) -> Path:
+    return Path(directory) / f"embeddings-{part:03d}-of-{num_parts:03d}.npy"
+
+
+def get_metadata_file(directory: Union[str, Path], part: int, num_parts: int) -> Path:
+    return get_triple_file(directory, f"triples-{part:03d}-of-{num_parts:03d}", "parquet")
+
+
+def get_scale_file(embeddings_file: Union[str, Path]) -> Path:
+    return Path(embeddings_file).with_suffix(".scale.npy")
+
+
+def has_store(directory: Union[str, Path], num_parts: int) -> bool:
+    return get_embeddings_file(directory, 0, num_parts).exists()
+
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def write_embeddings_file(filename: Union[str, Path], embeddings: np.ndarray, dtype: str = "float32"):
+    assert dtype in STORE_DTYPES
+    if dtype == "int8":
+        embeddings = normalize_rows(embeddings)
+        if len(embeddings) > 0:
+            scale = np.abs(embeddings).max(axis=0) / 127
+            scale[scale == 0] = 1
+        else:
+            # a part without rows has no largest values
+            scale = np.ones(embeddings.shape[1], dtype=np.float32)
+        np.save(get_scale_file(filename), scale.astype(np.float32))
+        embeddings = np.rint(embeddings / scale).astype(np.int8)
+    np.save(filename, np.asarray(embeddings, dtype=dtype))
+
+
+def write_store_part(directory: Union[str, Path], part: int, num_parts: int, triples: List[Dict[str, Any]],
+                     embeddings: np.ndarray, dtype: str = "float32"):
+    assert len(triples) == len(embeddings)
+    Path(directory).mkdir(exist_ok=True)
+    write_embeddings_file(get_embeddings_file(directory, part, num_parts), embeddings, dtype)
+    write_triples(get_metadata_file(directory, part, num_parts), [dict(t, row=i) for i, t in enumerate(triples)],
+                  fieldnames=METADATA_FIELDS)
+
+
+def read_store_part(directory: Union[str, Path], part: int, num_parts: int,
+                    subjects: Optional[Set[Tuple[str, str, str]]] = None) -> Dict[str, Any]:
+    # Only the metadata is read; embeddings stay on disk until read_embedding_rows()
+    return {
+        "triples": read_triples(get_metadata_file(directory, part, num_parts), subjects=subjects),
+        "embeddings_file": get_embeddings_file(directory, part, num_parts),
+    }
+
+
+def count_subject_triples(directory: Union[str, Path], part: int, num_parts: int) -> Counter:
+    columns = ["subject", "subject_type", "super_subject"]
+    rows = read_triples(get_metadata_file(directory, part, num_parts), columns=columns)
+    return Counter((row["subject"], row["subject_type"], row["super_subject"]) for row in rows)
+
+
+def open_embeddings(filename: Union[str, Path]) -> np.ndarray:
+    return np.load(filename, mmap_mode="r")
+
+
+def read_rows(filename: Union[str, Path], rows: Union[np.ndarray, slice] = slice(None)) -> np.ndarray:
+    # float32 rows, int8 rows scaled back with the part's scales; all rows by default
+    embeddings = open_embeddings(filename)[rows]
+    if embeddings.dtype == np.int8:
+        return embeddings * np.load(get_scale_file(filename))
+    return embeddings.astype(np.float32, copy=False)
+
+
+def read_embedding_rows(embedding_rows: List[Tuple[Union[str, Path], np.ndarray]]) -> np.ndarray:
+    if not embedding_rows:
+        return np.array([])
+    return np.concatenate([read_rows(filename, rows) for filename, rows in embedding_rows])
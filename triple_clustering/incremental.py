@@ -0,0 +1,151 @@
+import argparse
+import csv
+import logging
+import pickle
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+
+from app_config import WORKING_DIR
+from .cluster_state import assign_to_clusters, build_subject_state, get_member_key
+from .clustering import FineGrainedSubject, NUM_EMBEDDING_PARTS, MIN_FREQ, DISTANCE_THRESHOLD, build_subject_index, \
+    get_data_for_subject, get_dataset_embeddings, cluster_for_one_subject, group_by_cluster, get_rep_triples, \
+    write_rep_triples
+from .embedding_store import has_store, read_store_part
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                    datefmt='%d-%m %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+
+# Output and state files of subjects that had no state, e.g. triples-new-subjects.csv
+NEW_SUBJECTS_STEM = "new-subjects"
+
+
+def update_one_subject(data: Tuple[Dict[str, Any], Dict[str, Any]], distance_threshold: float,
+                       full_recluster: bool) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    dataset, state = data
+    embeddings = get_dataset_embeddings(dataset)
+    if len(dataset["triples"]) == 0:
+        return [], build_subject_state(dataset, embeddings, [])
+
+    # Subjects without clusters in the last run have nothing to assign to
+    if full_recluster or not state["members"]:
+        rep_triples = cluster_for_one_subject(dict(dataset, embeddings=embeddings), engine="auto",
+                                              distance_threshold=distance_threshold)
+        return rep_triples, build_subject_state(dataset, embeddings, rep_triples)
+
+    cluster_assignment, new_state = assign_to_clusters(state, dataset["triples"], embeddings, distance_threshold)
+    old_keys = {key for members in state["members"] for key in members}
+    num_dropped = len(old_keys - {get_member_key(t) for t in dataset["triples"]})
+    logger.info(f"  + Subject \"{dataset['subject']}\": {len(dataset['triples']):,} triples, "
+                f"{len(state['members']):,} -> {len(new_state['members']):,} clusters, "
+                f"{num_dropped:,} members dropped")
+    return get_rep_triples(group_by_cluster(dataset["triples"], cluster_assignment)), new_state
+
+
+def empty_state(subject: FineGrainedSubject) -> Dict[str, Any]:
+    return {
+        "subject": subject.subject,
+        "subject_type": subject.subject_type,
+        "super_subject": subject.super_subject,
+        "members": [],
+        "centroids": np.array([], dtype=np.float32),
+        "sizes": np.array([], dtype=np.int64),
+    }
+
+
+def update_states(states: List[Dict[str, Any]], embeddings_dir: Path, output_file: Path, new_state_file: Path,
+                  num_processors: int, distance_threshold: float, full_recluster: bool):
+    subjects = [FineGrainedSubject(subject=s["subject"], subject_type=s["subject_type"],
+                                   super_subject=s["super_subject"]) for s in states]
+    func = partial(read_store_part, embeddings_dir, num_parts=NUM_EMBEDDING_PARTS,
+                   subjects={tuple(subject) for subject in subjects})
+    with Pool(num_processors) as p:
+        all_data = p.map(func, range(NUM_EMBEDDING_PARTS))
+    index = build_subject_index(all_data)
+    datasets = [get_data_for_subject(subject, all_data, index, max_triples=None) for subject in subjects]
+
+    num_fresh = sum(1 for dataset, state in zip(datasets, states) if dataset["triples"] and not state["members"])
+    if num_fresh > 0 and not full_recluster:
+        logger.info(f"{num_fresh:,} / {len(subjects):,} subjects had no clusters and are clustered from scratch")
+
+    func = partial(update_one_subject, distance_threshold=distance_threshold, full_recluster=full_recluster)
+    with Pool(num_processors) as p:
+        results = p.map(func, zip(datasets, states), chunksize=1)
+
+    logger.info(f"Writing results to \"{output_file}\"")
+    write_rep_triples(output_file, [rep for rep_triples, _ in results for rep in rep_triples])
+
+    logger.info(f"Writing cluster states to \"{new_state_file}\"")
+    with open(new_state_file, "wb") as f_out:
+        pickle.dump([new_state for _, new_state in results], f_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_subjects(filename: str) -> List[FineGrainedSubject]:
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        return [FineGrainedSubject(subject=row["subject"], subject_type=row["type"],
+                                   super_subject=row["super_subject"]) for row in reader]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state_dir", type=str, required=True,
+                        help="Cluster states written by triple_clustering.clustering --state_dir")
+    parser.add_argument("--new_state_dir", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, default=f"{WORKING_DIR}/clustered_triples/")
+    parser.add_argument("--embeddings_dir", type=str,
+                        default=f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}_embeddings/")
+    parser.add_argument("--num_processors", type=int, default=64)
+    parser.add_argument("--distance_threshold", type=float, default=DISTANCE_THRESHOLD)
+    parser.add_argument("--full_recluster", action="store_true",
+                        help="Re-cluster every subject from scratch instead of assigning new triples")
+    parser.add_argument("--subjects", type=str,
+                        help="Subject file of the clustering run. Its subjects without a state in any state file "
+                             "(state files written before subjects without triples got one) are clustered from "
+                             f"scratch into {NEW_SUBJECTS_STEM}")
+
+    args = parser.parse_args()
+
+    embeddings_dir = Path(args.embeddings_dir)
+    assert has_store(embeddings_dir, NUM_EMBEDDING_PARTS), "incremental assignment reads the embedding store"
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True)
+    new_state_dir = Path(args.new_state_dir)
+    new_state_dir.mkdir(exist_ok=True)
+
+    state_files = sorted(Path(args.state_dir).glob("state-*.pkl"))
+    logger.info(f"There are {len(state_files):,} state files")
+
+    seen: Set[Tuple[str, str, str]] = set()
+    for state_file in state_files:
+        logger.info(f"Reading cluster states from \"{state_file}\"")
+        with open(state_file, "rb") as f:
+            states = pickle.load(f)
+        seen.update((s["subject"], s["subject_type"], s["super_subject"]) for s in states)
+
+        # state-XXXXX-of-YYYYY.pkl -> triples-XXXXX-of-YYYYY.csv, as written by triple_clustering.clustering
+        output_file = output_dir / (state_file.stem.replace("state-", "triples-") + ".csv")
+        update_states(states, embeddings_dir, output_file, new_state_dir / state_file.name, args.num_processors,
+                      args.distance_threshold, args.full_recluster)
+
+    if args.subjects is not None:
+        missing = [subject for subject in read_subjects(args.subjects) if tuple(subject) not in seen]
+        logger.info(f"{len(missing):,} subjects of \"{args.subjects}\" have no cluster state")
+        if missing:
+            update_states([empty_state(subject) for subject in missing], embeddings_dir,
+                          output_dir / f"triples-{NEW_SUBJECTS_STEM}.csv",
+                          new_state_dir / f"state-{NEW_SUBJECTS_STEM}.pkl", args.num_processors,
+                          args.distance_threshold, args.full_recluster)
+
+    logger.info("Done")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,23 @@
 """Based on https://github.com/UKPLab/sentence-transformers/blob/master/examples/applications/computing-embeddings/computing_embeddings_mutli_gpu.py"""
 
 import argparse
-import csv
-import gzip
 import logging
 import pickle
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict, List, Optional
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 
 from app_config import WORKING_DIR
+from triple_clustering.cpu_encoder import CPU_TOKEN_BUDGET, encode_on_cpu, get_cache_model_name, \
+    get_embedding_dimension, start_cpu_pool
+from triple_clustering.embedding_cache import EMBEDDING_CACHE_FILE, EmbeddingCache
+from triple_clustering.embedding_store import STORE_DTYPES, write_store_part
+from triple_filtering.assertion_reader import get_count
+from triple_filtering.triple_io import find_triple_file, iter_triples
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -25,62 +31,212 @@ NUM_BATCHES = 64
 
 MIN_FREQ = 3
 
-csv.field_size_limit(sys.maxsize)
+OUTPUT_DIR = f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}_embeddings/"
+
+# Sentences encoded between two checkpoints
+CHUNK_SIZE = 200_000
 
 
 def make_sentence(triple: Dict[str, str]) -> str:
     return f"{triple['subject']} {triple['predicate']} {triple['object']}"
 
 
-# Important, you need to shield your code with if __name__.
-# Otherwise, CUDA runs into issues when spawning new processes.
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--ind", type=int, required=True)
-    args = parser.parse_args()
-
-    assert 0 <= args.ind < NUM_BATCHES
-
-    input_file = f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}/triples-{args.ind:03d}-of-{NUM_BATCHES:03d}.csv.gz"
+def read_part(ind: int) -> List[Dict[str, Any]]:
+    input_file = find_triple_file(f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}",
+                                  f"triples-{ind:03d}-of-{NUM_BATCHES:03d}")
     logger.info(f"Read triples from \"{input_file}\"")
+    # Equal strings share one object, which pickle then stores only once
     triples = []
-    with gzip.open(input_file, "rt") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            triples.append({
-                "triple_id": row["triple_id"],
-                "subject": row["subject"],
-                "predicate": row["predicate"],
-                "object": row["object"],
-                "count": len(row["assertion_ids"].split("|")),
-                "subject_type": row["subject_type"],
-                "super_subject": row["super_subject"],
-            })
-    logger.info(f"There are {len(triples):,} triples")
-
+    for row in iter_triples(input_file):
+        triples.append({
+            "triple_id": row["triple_id"],
+            "subject": sys.intern(row["subject"]),
+            "predicate": sys.intern(row["predicate"]),
+            "object": sys.intern(row["object"]),
+            "count": get_count(row),
+            "subject_type": sys.intern(row["subject_type"]),
+            "super_subject": sys.intern(row["super_subject"]),
+        })
+    logger.info(f"There are {len(triples):,} triples in part {ind}")
+    return triples
+
+
+def write_part(output_dir: Path, ind: int, store: str, triples: List[Dict[str, Any]], embeddings: np.ndarray,
+               store_dtype: str = "float32"):
+    if store == "npy":
+        logger.info(f"Writing part {ind} to embedding store \"{output_dir}\" ({store_dtype})")
+        write_store_part(output_dir, ind, NUM_BATCHES, triples, embeddings, dtype=store_dtype)
+    else:
+        # Write pickle
+        output_file = output_dir / f"embeddings-{ind:03d}-of-{NUM_BATCHES:03d}.pkl"
+        logger.info(f"Writing results to\"{output_file}\"")
+        with open(output_file, "wb") as f_out:
+            pickle.dump({"triples": triples, "embeddings": embeddings}, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# The model and its worker processes, started once per run
+class Encoder(object):
+    def __init__(self, device: str, num_workers: int, threads_per_worker: int, quantize: bool, token_budget: int):
+        self.device = device
+        self.num_cores = num_workers * threads_per_worker
+        self.token_budget = token_budget
+
+        if device == "cpu":
+            self.pool = start_cpu_pool(MODEL_NAME, num_workers, threads_per_worker, quantize)
+        else:
+            from sentence_transformers import SentenceTransformer
+
+            # Define the model
+            logger.info(f"Load SentenceTransformer model \"{MODEL_NAME}\"")
+            self.model = SentenceTransformer(MODEL_NAME)
+
+            # Start the multi-process pool on all available CUDA devices
+            self.pool = self.model.start_multi_process_pool()
+
+    def encode(self, sentences: List[str]) -> np.ndarray:
+        if self.device == "cpu":
+            return encode_on_cpu(sentences, MODEL_NAME, self.pool, self.num_cores, token_budget=self.token_budget)
+
+        # Compute the embeddings using the multi-process pool
+        embeddings = self.model.encode_multi_process(sentences, self.pool)
+        logger.info(f"Embeddings of {len(sentences):,} sentences computed. Shape: {embeddings.shape}")
+        return embeddings
+
+    def get_dimension(self) -> int:
+        if self.device == "cpu":
+            return self.pool.apply(get_embedding_dimension)
+        return self.model.get_sentence_embedding_dimension()
+
+    def stop(self):
+        if self.device == "cpu":
+            self.pool.close()
+            self.pool.join()
+        else:
+            # Optional: Stop the processes in the pool
+            self.model.stop_multi_process_pool(self.pool)
+
+
+def embed_part(triples: List[Dict[str, Any]], encoder: Encoder, cache: Optional[EmbeddingCache],
+               checkpoint_dir: Path, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
     logger.info(f"Make sentences")
     sentences = [make_sentence(triple) for triple in triples]
+    # The same sentence comes from different subject types and super subjects; encode it once
+    unique_sentences = list(dict.fromkeys(sentences))
+    logger.info(f"There are {len(unique_sentences):,} unique sentences")
+
+    sentence2embedding = {}
+    if cache is not None:
+        sentence2embedding = cache.get_many(unique_sentences)
+        logger.info(f"Found {len(sentence2embedding):,} sentences in the embedding cache")
+    new_sentences = [s for s in unique_sentences if s not in sentence2embedding]
+
+    # Every encoded chunk is a checkpoint. With the cache, it is added to the cache, and a restarted run finds it
+    # there. Without it, the chunks of a part are always the same, and each is saved to its own file.
+    for chunk_id, start in enumerate(range(0, len(new_sentences), chunk_size)):
+        chunk = new_sentences[start:(start + chunk_size)]
+        chunk_file = checkpoint_dir / f"chunk-{chunk_id:05d}.npy"
+        if cache is None and chunk_file.exists():
+            logger.info(f"Resuming from checkpoint \"{chunk_file}\"")
+            chunk_embeddings = np.load(chunk_file)
+        else:
+            chunk_embeddings = encoder.encode(chunk)
+            if cache is not None:
+                cache.put_many(chunk, chunk_embeddings)
+            else:
+                checkpoint_dir.mkdir(parents=True, exist_ok=True)
+                tmp_file = checkpoint_dir / f"chunk-{chunk_id:05d}.tmp.npy"
+                np.save(tmp_file, chunk_embeddings)
+                tmp_file.replace(chunk_file)
+        sentence2embedding.update(zip(chunk, chunk_embeddings))
+
+    if len(sentences) == 0:
+        # (0, dimension), like the matrix of any other part
+        embeddings = np.empty((0, encoder.get_dimension()), dtype=np.float32)
+    else:
+        embeddings = np.array([sentence2embedding[s] for s in sentences], dtype=np.float32)
+    logger.info(f"Embeddings shape: {embeddings.shape}")
+    return embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ind", type=int)
+    parser.add_argument("--all", action="store_true",
+                        help="Work through all parts in one run, skipping the ones finished by an earlier run")
+    parser.add_argument("--store", type=str, choices=["pickle", "npy"], default="pickle",
+                        help="npy: memory-mappable embedding matrix plus a Parquet metadata table")
+    parser.add_argument("--store_dtype", type=str, choices=STORE_DTYPES, default="float32",
+                        help="npy store only; see also triple_clustering.compress_embeddings")
+    parser.add_argument("--output_dir", type=str, default=OUTPUT_DIR)
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="Sentences encoded between checkpoints")
+    parser.add_argument("--cache", type=str, nargs="?", const=EMBEDDING_CACHE_FILE,
+                        help=f"Use a content-addressed embedding cache, shared by all parts and runs (default file: "
+                             f"{EMBEDDING_CACHE_FILE}). Jobs running in parallel should each get their own file. "
+                             f"Delete the file when the encoder changes under the same model name")
+    parser.add_argument("--device", type=str, choices=["cuda", "cpu"], default="cuda")
+    parser.add_argument("--num_workers", type=int, default=8, help="CPU mode: number of encoding processes")
+    parser.add_argument("--threads_per_worker", type=int, default=4, help="CPU mode: intra-op threads per process")
+    parser.add_argument("--quantize", action="store_true", help="CPU mode: int8 dynamic quantization of the encoder")
+    parser.add_argument("--token_budget", type=int, default=CPU_TOKEN_BUDGET,
+                        help="CPU mode: max. padded tokens per batch")
+    args = parser.parse_args()
 
-    # Define the model
-    logger.info(f"Load SentenceTransformer model \"{MODEL_NAME}\"")
-    model = SentenceTransformer(MODEL_NAME)
-
-    # Start the multi-process pool on all available CUDA devices
-    pool = model.start_multi_process_pool()
-
-    # Compute the embeddings using the multi-process pool
-    embeddings = model.encode_multi_process(sentences, pool)
-    logger.info(f"Embeddings computed. Shape: {embeddings.shape}")
+    assert args.all != (args.ind is not None), "give either --ind or --all"
+    assert args.all or 0 <= args.ind < NUM_BATCHES
+    assert args.device == "cpu" or not args.quantize, "--quantize needs --device cpu"
 
-    # Write pickle
-    output_dir = Path(f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}_embeddings/")
+    output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
-    output_file = output_dir / f"embeddings-{args.ind:03d}-of-{NUM_BATCHES:03d}.pkl"
-    logger.info(f"Writing results to\"{output_file}\"")
-    with open(output_file, "wb") as f_out:
-        pickle.dump({"triples": triples, "embeddings": embeddings}, f_out, protocol=pickle.HIGHEST_PROTOCOL)
-
-    # Optional: Stop the processes in the pool
-    model.stop_multi_process_pool(pool)
+    checkpoint_dir = output_dir / "_checkpoints"
+
+    def get_done_file(ind: int) -> Path:
+        return checkpoint_dir / f"part-{ind:03d}.done"
+
+    if args.all:
+        parts = [ind for ind in range(NUM_BATCHES) if not get_done_file(ind).exists()]
+        logger.info(f"{(NUM_BATCHES - len(parts))} parts are done, {len(parts)} to go")
+    else:
+        parts = [args.ind]
+    if not parts:
+        return
+
+    cache = None
+    if args.cache is not None:
+        logger.info(f"Using embedding cache \"{args.cache}\"")
+        cache = EmbeddingCache(args.cache, get_cache_model_name(MODEL_NAME, args.quantize))
+
+    encoder = Encoder(args.device, args.num_workers, args.threads_per_worker, args.quantize, args.token_budget)
+
+    def finish_part(ind: int, triples: List[Dict[str, Any]], embeddings: np.ndarray):
+        write_part(output_dir, ind, args.store, triples, embeddings, args.store_dtype)
+        get_done_file(ind).touch()
+        shutil.rmtree(checkpoint_dir / f"part-{ind:03d}", ignore_errors=True)
+        logger.info(f"Part {ind} done")
+
+    # While a part is encoded, the next one is read and the previous one written in the background
+    checkpoint_dir.mkdir(exist_ok=True)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        next_triples = executor.submit(read_part, parts[0])
+        writes = []
+        for k, ind in enumerate(parts):
+            triples = next_triples.result()
+            if k + 1 < len(parts):
+                next_triples = executor.submit(read_part, parts[k + 1])
+
+            embeddings = embed_part(triples, encoder, cache, checkpoint_dir / f"part-{ind:03d}", args.chunk_size)
+            writes.append(executor.submit(finish_part, ind, triples, embeddings))
+
+        for write in writes:
+            write.result()
+
+    encoder.stop()
+    if cache is not None:
+        cache.close()
 
     logger.info("Done")
+
+
+# Important, you need to shield your code with if __name__.
+# Otherwise, CUDA runs into issues when spawning new processes.
+if __name__ == '__main__':
+    main()
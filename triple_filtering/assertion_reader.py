@@ -1,7 +1,7 @@
 import gzip
 import json
 from pathlib import Path
-from typing import Union, Any, Dict, List, NamedTuple
+from typing import Union, Any, Dict, List, NamedTuple, Iterable
 
 
 def load_one_assertion_file(filename: Union[str, Path]) -> List[Dict[str, Any]]:
@@ -12,6 +12,17 @@ def load_one_assertion_file(filename: Union[str, Path]) -> List[Dict[str, Any]]:
     return assertions
 
 
+# Packed assertion IDs fit into a signed int64: 10 bits c4_id | 6 bits part_id | 47 bits asst_id.
+# The _ids of the openie_assertions collection are the string form (str(AssertionId)); packed IDs read back
+# from the grouped_triples collection are turned into it with assertion_doc_id().
+C4_ID_BITS = 10
+PART_ID_BITS = 6
+ASST_ID_BITS = 47
+
+ID_LIST_SEPARATOR = "|"
+PACKED_ID_LIST_SEPARATOR = " "
+
+
 class AssertionId(NamedTuple):
     c4_id: int
     part_id: int
@@ -20,6 +31,9 @@ class AssertionId(NamedTuple):
     def __str__(self):
         return f"{self.c4_id:05d}-{self.part_id:03d}-{self.asst_id:07d}"
 
+    def pack(self) -> int:
+        return (self.c4_id << (PART_ID_BITS + ASST_ID_BITS)) | (self.part_id << ASST_ID_BITS) | self.asst_id
+
 
 def convert_id(aid: str) -> AssertionId:
     toks = aid.split("-")
@@ -38,3 +52,78 @@ def convert_id(aid: str) -> AssertionId:
     assert asst_id >= 0
 
     return AssertionId(c4_id=c4_id, part_id=part_id, asst_id=asst_id)
+
+
+def unpack_id(packed: int) -> AssertionId:
+    return AssertionId(c4_id=packed >> (PART_ID_BITS + ASST_ID_BITS),
+                       part_id=(packed >> ASST_ID_BITS) & ((1 << PART_ID_BITS) - 1),
+                       asst_id=packed & ((1 << ASST_ID_BITS) - 1))
+
+
+def assertion_doc_id(aid: Union[str, int]) -> str:
+    if isinstance(aid, int):
+        return str(unpack_id(aid))
+    return aid
+
+
+# accepts both the string form "00001-002-0000003" and an already packed integer
+def parse_id(aid: str) -> int:
+    if "-" in aid:
+        return convert_id(aid).pack()
+    return int(aid)
+
+
+# sorted and delta-encoded: the first ID followed by the gaps between consecutive IDs
+def encode_id_list(ids: Iterable[int]) -> str:
+    sorted_ids = sorted(ids)
+    deltas = [sorted_ids[0]] + [b - a for a, b in zip(sorted_ids, sorted_ids[1:])] if sorted_ids else []
+    return PACKED_ID_LIST_SEPARATOR.join(str(d) for d in deltas)
+
+
+def decode_id_list(cell: str) -> List[int]:
+    ids = []
+    last = 0
+    for delta in cell.split(PACKED_ID_LIST_SEPARATOR):
+        last += int(delta)
+        ids.append(last)
+    return ids
+
+
+# "assertion_ids" cells are either "|"-joined string IDs, delta-encoded packed IDs (CSV) or lists of packed IDs
+# (Parquet, stored as list<int64> with delta encoding)
+def parse_id_list(cell: Union[str, List[int]]) -> List[int]:
+    if isinstance(cell, list):
+        return cell
+    if "-" in cell:
+        return [convert_id(aid).pack() for aid in cell.split(ID_LIST_SEPARATOR)]
+    return decode_id_list(cell)
+
+
+def format_id_list(ids: Iterable[int], packed: bool, array: bool = False) -> Union[str, List[int]]:
+    # array: the cell goes to a Parquet file, which stores packed IDs as an integer list
+    if packed:
+        return sorted(ids) if array else encode_id_list(ids)
+    return ID_LIST_SEPARATOR.join(str(unpack_id(i)) for i in ids)
+
+
+def convert_id_cell(cell: Union[str, List[int]], array: bool) -> Union[str, List[int]]:
+    # an "assertion_ids" cell read from a CSV or Parquet file, in the same ID format for a CSV (array=False)
+    # or Parquet (array=True) file
+    if isinstance(cell, list):
+        return cell if array else encode_id_list(cell)
+    if array and "-" not in cell:
+        return decode_id_list(cell)
+    return cell
+
+
+def count_ids(cell: Union[str, List[int]]) -> int:
+    if isinstance(cell, list):
+        return len(cell)
+    separator = ID_LIST_SEPARATOR if "-" in cell else PACKED_ID_LIST_SEPARATOR
+    return cell.count(separator) + 1
+
+
+def get_count(row: Dict[str, str]) -> int:
+    if row.get("count"):
+        return int(row["count"])
+    return count_ids(row["assertion_ids"])
@@ -1,6 +1,5 @@
 import argparse
 import csv
-import gzip
 import logging
 from pathlib import Path
 from typing import Any, Dict, List, Set, Union, Tuple
@@ -8,6 +7,7 @@ from typing import Any, Dict, List, Set, Union, Tuple
 from app_config import WORKING_DIR
 from .assertion_reader import load_one_assertion_file, AssertionId
 from .filtering_helper import is_likely_valid
+from .triple_io import FORMATS, get_triple_file, write_triples
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -63,6 +63,8 @@ def main():
     parser.add_argument("--output_dir", type=str, required=True)
     parser.add_argument("--openie_dir", type=str, default=f"{WORKING_DIR}/openie_output")
     parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--packed_ids", action="store_true", help="Write assertion IDs as packed int64 values")
+    parser.add_argument("--format", type=str, choices=FORMATS, default="csv")
 
     args = parser.parse_args()
 
@@ -105,15 +107,16 @@ def main():
     filtered_assertions = get_assertions_of_subjects(subjects, assertion_lists, args.c4_file_index, good_su_pairs)
     logger.info(f"Got {len(filtered_assertions):,} filtered assertions")
 
+    if args.packed_ids:
+        for a in filtered_assertions:
+            a["assertion_id"] = a["assertion_id"].pack()
+
     output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
-    output_file = output_dir / Path(f"c4-train.{args.c4_file_index:05d}-of-01024.csv.gz")
+    output_file = get_triple_file(output_dir, f"c4-train.{args.c4_file_index:05d}-of-01024", args.format)
     logger.info(f"Writing to \"{output_file}\"")
-    with gzip.open(output_file, "wt") as f:
-        writer = csv.DictWriter(f, fieldnames=["subject", "predicate", "object", "assertion_id", "subject_type",
-                                               "super_subject"])
-        writer.writeheader()
-        writer.writerows(filtered_assertions)
+    write_triples(output_file, filtered_assertions,
+                  fieldnames=["subject", "predicate", "object", "assertion_id", "subject_type", "super_subject"])
 
     logger.info("Done")
 
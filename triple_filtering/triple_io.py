@@ -0,0 +1,117 @@
+import csv
+import gzip
+import sys
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+csv.field_size_limit(sys.maxsize)
+
+FORMATS = ["csv", "parquet"]
+SUFFIXES = {
+    "csv": ".csv.gz",
+    "parquet": ".parquet",
+}
+
+# Parquet files are sorted by the fine-grained subject, so that row-group statistics on these columns
+# let readers skip row groups of other subjects
+SORT_COLUMNS = ["subject", "subject_type", "super_subject"]
+INT_COLUMNS = {"count"}
+ROW_GROUP_SIZE = 100_000
+
+
+def get_triple_file(directory: Union[str, Path], stem: str, fmt: str = "csv") -> Path:
+    assert fmt in FORMATS
+    return Path(directory) / f"{stem}{SUFFIXES[fmt]}"
+
+
+def find_triple_file(directory: Union[str, Path], stem: str) -> Path:
+    # the Parquet version of a stage output takes precedence over the CSV one
+    for fmt in reversed(FORMATS):
+        filename = get_triple_file(directory, stem, fmt)
+        if filename.exists():
+            return filename
+    return get_triple_file(directory, stem, "csv")
+
+
+def is_parquet(filename: Union[str, Path]) -> bool:
+    return str(filename).endswith(SUFFIXES["parquet"])
+
+
+def iter_triples(filename: Union[str, Path], columns: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+    if is_parquet(filename):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(filename)
+        for batch in parquet_file.iter_batches(columns=columns):
+            yield from batch.to_pylist()
+        return
+
+    with gzip.open(filename, "rt") as f:
+        reader = csv.DictReader((line.replace('\0', '') for line in f))
+        for row in reader:
+            if columns is not None:
+                row = {k: row[k] for k in columns}
+            yield row
+
+
+def count_triples(filename: Union[str, Path]) -> int:
+    # Parquet: from the footer. CSV: the number of lines, an upper bound if cells contain line breaks.
+    if is_parquet(filename):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(filename).metadata.num_rows
+
+    num_lines = 0
+    with gzip.open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 24), b""):
+            num_lines += chunk.count(b"\n")
+    return max(num_lines - 1, 0)
+
+
+def read_triples(filename: Union[str, Path], columns: Optional[List[str]] = None,
+                 subjects: Optional[Set[Tuple[str, str, str]]] = None) -> List[Dict[str, Any]]:
+    if subjects is None:
+        return list(iter_triples(filename, columns))
+
+    if is_parquet(filename):
+        import pyarrow.parquet as pq
+
+        # the "in" filter on the sort column prunes row groups by their statistics
+        table = pq.read_table(filename, columns=columns,
+                              filters=[("subject", "in", sorted({s[0] for s in subjects}))])
+        rows = table.to_pylist()
+    else:
+        rows = iter_triples(filename, columns)
+
+    return [row for row in rows if (row["subject"], row["subject_type"], row["super_subject"]) in subjects]
+
+
+def _column_array(name: str, values: List[Any]):
+    import pyarrow as pa
+
+    if values and isinstance(values[0], list):
+        return pa.array(values, type=pa.list_(pa.int64()))
+    if name in INT_COLUMNS or (values and isinstance(values[0], int)):
+        return pa.array([int(v) for v in values], type=pa.int64())
+    return pa.array([str(v) for v in values], type=pa.string())
+
+
+def write_triples(filename: Union[str, Path], rows: Iterable[Dict[str, Any]], fieldnames: List[str]):
+    if not is_parquet(filename):
+        with gzip.open(filename, "wt") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sort_columns = [c for c in SORT_COLUMNS if c in fieldnames]
+    rows = sorted(rows, key=lambda r: tuple(r[c] for c in sort_columns))
+    table = pa.table({name: _column_array(name, [r[name] for r in rows]) for name in fieldnames})
+    # sorted integer lists (packed assertion IDs) are stored as deltas
+    list_columns = [f.name for f in table.schema if pa.types.is_list(f.type)]
+    pq.write_table(table, filename, row_group_size=ROW_GROUP_SIZE, compression="zstd",
+                   use_dictionary=[name for name in fieldnames if name not in list_columns],
+                   column_encoding={f"{name}.list.element": "DELTA_BINARY_PACKED" for name in list_columns})
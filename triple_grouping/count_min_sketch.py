@@ -0,0 +1,57 @@
+from typing import Hashable, Sequence
+
+import numpy as np
+
+# Smallest width chosen by width_for_rows()
+MIN_WIDTH = 2 ** 16
+
+# Odd 64-bit multipliers, one per table, for multiply-shift hashing of the key hashes
+MULTIPLIER_SEED = 42
+
+
+def width_for_rows(num_rows: int) -> int:
+    # About one counter per input row: a key of count 1 then collides with ~1 other row per table, so it
+    # reaches an estimate of 3 in all tables only rarely
+    return max(MIN_WIDTH, 1 << max(num_rows - 1, 0).bit_length())
+
+
+def hash_keys(keys: Sequence[Hashable]) -> np.ndarray:
+    # One Python hash per key. The hashes of str are randomized per process, so the sketch must be filled and
+    # queried in the same process.
+    return np.fromiter((hash(k) for k in keys), dtype=np.int64, count=len(keys)).view(np.uint64)
+
+
+# Approximate frequency counter that never underestimates: estimate(key) >= true count of key.
+# Discarding keys whose estimate is below a threshold therefore never discards a key whose true count
+# reaches that threshold.
+# Keys are added and estimated in batches of their hashes (hash_keys()); the buckets of all tables are
+# computed with numpy.
+class CountMinSketch(object):
+    def __init__(self, width: int = MIN_WIDTH, depth: int = 4):
+        assert width > 0 and depth > 0
+        # a power of two, so the bucket is the top bits of the multiply-shift hash
+        self.bits = max(width - 1, 1).bit_length()
+        self.width = 1 << self.bits
+        self.depth = depth
+        self.tables = np.zeros((depth, self.width), dtype=np.uint32)
+        rng = np.random.default_rng(MULTIPLIER_SEED)
+        self.multipliers = rng.integers(0, 2 ** 63, size=(depth, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.total = 0
+
+    def _buckets(self, hashes: np.ndarray) -> np.ndarray:
+        # (depth, len(hashes)); the multiplication wraps around modulo 2^64
+        with np.errstate(over="ignore"):
+            return ((hashes[np.newaxis, :] * self.multipliers) >> np.uint64(64 - self.bits)).astype(np.intp)
+
+    def add(self, hashes: np.ndarray, counts: np.ndarray):
+        counts = np.asarray(counts, dtype=np.uint32)
+        for table, buckets in zip(self.tables, self._buckets(hashes)):
+            np.add.at(table, buckets, counts)
+        self.total += int(counts.sum(dtype=np.uint64))
+
+    def estimate(self, hashes: np.ndarray) -> np.ndarray:
+        buckets = self._buckets(hashes)
+        return np.min([table[b] for table, b in zip(self.tables, buckets)], axis=0)
+
+    def memory_bytes(self) -> int:
+        return self.tables.nbytes
@@ -1,11 +1,18 @@
+import argparse
 import csv
 import gzip
 import logging
+import shutil
 import sys
+from itertools import accumulate
 from multiprocessing import Pool
 from pathlib import Path
+from typing import List, Tuple
 
 from app_config import WORKING_DIR
+from triple_filtering.assertion_reader import convert_id_cell, get_count
+from triple_filtering.triple_io import FORMATS, find_triple_file, get_triple_file, is_parquet, iter_triples, \
+    write_triples
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -16,61 +23,102 @@ logger = logging.getLogger(__name__)
 MIN_FREQ = 3
 NUM_BATCHES = 64
 
+FIELDNAMES = ["triple_id", "subject", "predicate", "object", "assertion_ids", "count", "subject_type",
+              "super_subject"]
+
 csv.field_size_limit(sys.maxsize)
 
 
-def one_file(i: int):
-    input_file = f"{WORKING_DIR}/grouped_triples_all/{i:03d}-of-{NUM_BATCHES:03d}.csv.gz"
-    triples = []
+def one_file(args):
+    i, part_file = args
+    input_file = find_triple_file(f"{WORKING_DIR}/grouped_triples_all", f"{i:03d}-of-{NUM_BATCHES:03d}")
+    num_frequent = 0
     cnt = 0
-    with gzip.open(input_file, "rt") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if len(row["assertion_ids"].split("|")) >= MIN_FREQ:
-                triples.append(row)
+    with gzip.open(part_file, "wt") as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=FIELDNAMES[1:], extrasaction="ignore")
+        writer.writeheader()
+        for row in iter_triples(input_file):
+            count = get_count(row)
+            if count >= MIN_FREQ:
+                row["count"] = count
+                row["assertion_ids"] = convert_id_cell(row["assertion_ids"], array=False)
+                writer.writerow(row)
+                num_frequent += 1
             cnt += 1
     logger.info(
-        f"Read triples from \"{input_file}\". There are {len(triples):,} / {cnt:,} triples "
+        f"Read triples from \"{input_file}\". There are {num_frequent:,} / {cnt:,} triples "
         f"with frequency >= {MIN_FREQ}")
 
-    return triples
+    return num_frequent
+
+
+def get_part_ranges(offsets: List[int], counts: List[int], start: int, end: int) -> List[Tuple[int, int, int]]:
+    # (part, local start, local end) of the parts which overlap the global range [start, end)
+    ranges = []
+    for part, (offset, count) in enumerate(zip(offsets, counts)):
+        lo = max(start, offset)
+        hi = min(end, offset + count)
+        if lo < hi:
+            ranges.append((part, lo - offset, hi - offset))
+    return ranges
 
-    # output_dir = Path("/GW/C4/work/grouped_triples_v3_geq_3")
-    # output_dir.mkdir(exist_ok=True)
-    # output_file = output_dir / f"triples-{i:03d}-of-{NUM_BATCHES:03d}.csv.gz"
+
+def read_ranges(i: int, ranges: List[Tuple[int, int, int]], part_files: List[Path], array: bool = False):
+    j = 0
+    for part, start, end in ranges:
+        with gzip.open(part_files[part], "rt") as f_in:
+            reader = csv.DictReader(f_in)
+            for k, row in enumerate(reader):
+                if k >= end:
+                    break
+                if k < start:
+                    continue
+                row["triple_id"] = f"triple-{i:03d}-{j:07d}"
+                row["assertion_ids"] = convert_id_cell(row["assertion_ids"], array)
+                yield row
+                j += 1
 
 
 def write_results(args):
-    triples, output_file = args
-    logger.info(f"Writing {len(triples):,} triples to \"{output_file}\"")
-    with gzip.open(output_file, "wt") as f:
-        writer = csv.DictWriter(f, fieldnames=["triple_id", "subject", "predicate", "object", "assertion_ids",
-                                               "subject_type", "super_subject"])
-        writer.writeheader()
-        writer.writerows(triples)
+    i, ranges, part_files, output_file = args
+    logger.info(f"Writing {sum(end - start for _, start, end in ranges):,} triples to \"{output_file}\"")
+    write_triples(output_file, read_ranges(i, ranges, part_files, array=is_parquet(output_file)),
+                  fieldnames=FIELDNAMES)
 
 
 def main():
-    with Pool(64) as p:
-        triple_lists = p.map(one_file, range(NUM_BATCHES))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", type=str, choices=FORMATS, default="csv")
 
-    logger.info(f"Combine triple lists")
-    all_triples = [t for tl in triple_lists for t in tl]
-
-    logger.info(f"There are in total {len(all_triples):,} unique triples with frequency >= {MIN_FREQ}")
+    args = parser.parse_args()
 
     output_dir = Path(f"{WORKING_DIR}/grouped_triples_geq_{MIN_FREQ}")
     output_dir.mkdir(exist_ok=True)
 
-    batch_size = int(len(all_triples) / NUM_BATCHES) + 1
+    # Workers write their frequent triples to intermediate part files and only report counts back
+    parts_dir = output_dir / "_parts"
+    parts_dir.mkdir(exist_ok=True)
+    part_files = [parts_dir / f"{i:03d}-of-{NUM_BATCHES:03d}.csv.gz" for i in range(NUM_BATCHES)]
+    with Pool(64) as p:
+        counts = p.map(one_file, zip(range(NUM_BATCHES), part_files))
+
+    total = sum(counts)
+    logger.info(f"There are in total {total:,} unique triples with frequency >= {MIN_FREQ}")
+
+    # Global position of a triple = offset of its part + its position in the part. Triple IDs derived from it
+    # are the same as if all parts were concatenated in order and sliced into NUM_BATCHES batches.
+    offsets = [0] + list(accumulate(counts))[:-1]
+    batch_size = int(total / NUM_BATCHES) + 1
     logger.info(f"Num batches: {NUM_BATCHES}. Batch size: {batch_size:,}.")
-    triples_batches = [all_triples[(i * batch_size):((i + 1) * batch_size)] for i in range(NUM_BATCHES)]
-    for i, triples_batch in enumerate(triples_batches):
-        for j, triple in enumerate(triples_batch):
-            triple["triple_id"] = f"triple-{i:03d}-{j:07d}"
-    output_file_batches = [output_dir / f"triples-{i:03d}-of-{NUM_BATCHES:03d}.csv.gz" for i in range(NUM_BATCHES)]
+
+    output_files = [get_triple_file(output_dir, f"triples-{i:03d}-of-{NUM_BATCHES:03d}", args.format)
+                    for i in range(NUM_BATCHES)]
+    tasks = [(i, get_part_ranges(offsets, counts, i * batch_size, (i + 1) * batch_size), part_files, output_file)
+             for i, output_file in enumerate(output_files)]
     with Pool(64) as p:
-        p.map(write_results, zip(triples_batches, output_file_batches))
+        p.map(write_results, tasks)
+
+    shutil.rmtree(parts_dir)
 
     logger.info("Done")
 
@@ -1,10 +1,16 @@
-import csv
-import gzip
+import argparse
 import logging
-from multiprocessing import Pool
+from array import array
+from multiprocessing import get_context
 from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
 
 from app_config import WORKING_DIR
+from triple_filtering.assertion_reader import parse_id_list, format_id_list, get_count
+from triple_filtering.triple_io import FORMATS, count_triples, find_triple_file, get_triple_file, is_parquet, \
+    iter_triples, write_triples
+from .count_min_sketch import CountMinSketch, hash_keys, width_for_rows
+from .vocabulary import Vocabulary, VOCABULARY_FILE, remap_tuple
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -12,58 +18,174 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger(__name__)
 
+# Rows hashed and added to or estimated with the Count-Min sketch together
+SKETCH_BATCH_SIZE = 100_000
+
+# Set by main() before the writer processes are forked, which decode the ID tuples of their batch with it
+VOCABULARY: Optional[Vocabulary] = None
+
 
 def read_grouped_file(filename):
-    with gzip.open(filename, "rt") as f:
-        reader = csv.DictReader(f)
-        triples = []
-        for row in reader:
-            t = {k: v for k, v in row.items()}
-            t["assertion_ids"] = t["assertion_ids"].split("|")
-            triples.append(t)
+    triples = []
+    for row in iter_triples(filename):
+        t = {k: v for k, v in row.items()}
+        t["assertion_ids"] = parse_id_list(t["assertion_ids"])
+        triples.append(t)
     return triples
 
 
+def iter_grouped_file(filename) -> Iterator[Tuple[Tuple[str, str, str, str, str], int, str]]:
+    for row in iter_triples(filename):
+        yield (row["subject"], row["predicate"], row["object"], row["subject_type"], row["super_subject"]), \
+              get_count(row), row["assertion_ids"]
+
+
+def iter_grouped_batches(filename, batch_size: int = SKETCH_BATCH_SIZE) \
+        -> Iterator[List[Tuple[Tuple[str, str, str, str, str], int, str]]]:
+    batch = []
+    for row in iter_grouped_file(filename):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def write_results(data, min_freq: int = 1):
     batch = data["batch"]
     output_file = data["output_file"]
-
-    with gzip.open(output_file, "wt") as f:
-        writer = csv.DictWriter(f, fieldnames=["subject", "predicate", "object", "assertion_ids", "subject_type",
-                                               "super_subject"])
-        writer.writeheader()
-        cnt = 0
-        for t, ids in batch:
-            if len(ids) >= min_freq:
-                writer.writerow({
-                    "subject": t[0],
-                    "predicate": t[1],
-                    "object": t[2],
-                    "assertion_ids": "|".join(ids),
-                    "subject_type": t[3],
-                    "super_subject": t[4],
-                })
-                cnt += 1
+    min_freq = data.get("min_freq", min_freq)
+    packed_ids = data.get("packed_ids", False)
+
+    rows = []
+    for key, ids in batch:
+        if len(ids) < min_freq:
+            continue
+        t = VOCABULARY.decode_tuple(key)
+        rows.append({
+            "subject": t[0],
+            "predicate": t[1],
+            "object": t[2],
+            "assertion_ids": format_id_list(ids, packed=packed_ids, array=is_parquet(output_file)),
+            "count": len(ids),
+            "subject_type": t[3],
+            "super_subject": t[4],
+        })
+    cnt = len(rows)
+    write_triples(output_file, rows, fieldnames=["subject", "predicate", "object", "assertion_ids", "count",
+                                                 "subject_type", "super_subject"])
 
     logger.info(f"There are {cnt:,} triples with frequency >= {min_freq} written to file \"{output_file}\"")
 
 
-def main():
-    filenames = [f"{WORKING_DIR}/grouped_triples/c4-train.{i:05d}-of-01024.csv.gz" for i in range(1024)]
-
+def group_exact(filenames, vocab: Vocabulary):
     triple2ids = {}
     for filename in filenames:
         triples = read_grouped_file(filename)
         logger.info(f"Read \"{filename}\": {len(triples):,} triples")
         old_cnt = len(triple2ids)
         for t in triples:
-            tup = (t["subject"], t["predicate"], t["object"], t["subject_type"], t["super_subject"])
+            tup = vocab.encode_tuple(
+                (t["subject"], t["predicate"], t["object"], t["subject_type"], t["super_subject"]))
             if tup not in triple2ids:
-                triple2ids[tup] = []
+                triple2ids[tup] = array("q")
             triple2ids[tup].extend(t["assertion_ids"])
 
         logger.info(f"Unique triples: {len(triple2ids):,} (+ {(len(triple2ids) - old_cnt):,})")
 
+    return triple2ids
+
+
+def group_with_prefilter(filenames, min_freq: int, sketch_width: Optional[int], sketch_depth: int) \
+        -> Tuple[dict, Vocabulary]:
+    if sketch_width is None:
+        num_input_rows = sum(count_triples(filename) for filename in filenames)
+        sketch_width = width_for_rows(num_input_rows)
+        logger.info(f"Input rows: {num_input_rows:,}")
+
+    # First pass: approximate counts. The sketch never underestimates, so every triple with
+    # frequency >= min_freq survives the second pass (no recall loss).
+    sketch = CountMinSketch(width=sketch_width, depth=sketch_depth)
+    logger.info(f"Count-Min sketch: width = {sketch.width:,}, depth = {sketch.depth}, "
+                f"memory = {(sketch.memory_bytes() / 2 ** 20):,.0f} MiB")
+    for filename in filenames:
+        cnt = 0
+        for batch in iter_grouped_batches(filename):
+            sketch.add(hash_keys([tup for tup, _, _ in batch]), [count for _, count, _ in batch])
+            cnt += len(batch)
+        logger.info(f"Sketched \"{filename}\": {cnt:,} triples. Total assertions: {sketch.total:,}")
+
+    # Second pass: exact ID lists, only for triples which might reach min_freq. All rows of a triple have the
+    # same estimate, so a triple is either kept or skipped in every file.
+    # Only the strings of candidates are encoded, with a vocabulary of this run: the shared one holds every
+    # string of the corpus.
+    vocab = Vocabulary()
+    triple2ids = {}
+    num_rows = 0
+    num_skipped = 0
+    for filename in filenames:
+        old_cnt = len(triple2ids)
+        for batch in iter_grouped_batches(filename):
+            estimates = sketch.estimate(hash_keys([tup for tup, _, _ in batch]))
+            num_rows += len(batch)
+            for (tup, _, ids), estimate in zip(batch, estimates):
+                if estimate < min_freq:
+                    num_skipped += 1
+                    continue
+                key = vocab.encode_tuple(tup)
+                if key not in triple2ids:
+                    triple2ids[key] = array("q")
+                triple2ids[key].extend(parse_id_list(ids))
+        logger.info(f"Read \"{filename}\". Candidate triples: {len(triple2ids):,} "
+                    f"(+ {(len(triple2ids) - old_cnt):,})")
+
+    num_frequent = sum(1 for ids in triple2ids.values() if len(ids) >= min_freq)
+    logger.info(f"Prefilter skipped {num_skipped:,} / {num_rows:,} rows. "
+                f"Candidates: {len(triple2ids):,}, of which {num_frequent:,} have frequency >= {min_freq} "
+                f"({(len(triple2ids) - num_frequent):,} false positives, recall loss: 0)")
+
+    return triple2ids, vocab
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min_freq", type=int, default=1)
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Drop triples with frequency < min_freq early using a Count-Min sketch pass")
+    parser.add_argument("--sketch_width", type=int, default=None,
+                        help="Counters per sketch table, rounded up to a power of two. "
+                             "Default: about one per input row")
+    parser.add_argument("--sketch_depth", type=int, default=4)
+    parser.add_argument("--packed_ids", action="store_true",
+                        help="Write assertion IDs as delta-encoded packed integers "
+                             "(integer lists in Parquet files)")
+    parser.add_argument("--format", type=str, choices=FORMATS, default="csv")
+    parser.add_argument("--vocabulary_file", type=str, default=VOCABULARY_FILE,
+                        help="Shared vocabulary extended without --prefilter")
+
+    args = parser.parse_args()
+
+    filenames = [find_triple_file(f"{WORKING_DIR}/grouped_triples", f"c4-train.{i:05d}-of-01024")
+                 for i in range(1024)]
+
+    if args.prefilter and args.min_freq <= 1:
+        logger.warning("--prefilter has no effect with --min_freq <= 1")
+
+    # triples are keyed by the vocabulary IDs of their strings, which the writer processes decode
+    global VOCABULARY
+
+    if args.prefilter and args.min_freq > 1:
+        triple2ids, vocab = group_with_prefilter(filenames, args.min_freq, args.sketch_width, args.sketch_depth)
+    else:
+        vocab = Vocabulary(args.vocabulary_file)
+        triple2ids = group_exact(filenames, vocab)
+        remap = vocab.save()
+        if remap:
+            logger.info(f"{len(remap):,} strings got other IDs when saving the vocabulary")
+            triple2ids = {remap_tuple(key, remap): ids for key, ids in triple2ids.items()}
+    VOCABULARY = vocab
+
     output_dir = Path(f"{WORKING_DIR}/grouped_triples_all")
     output_dir.mkdir(exist_ok=True)
     num_batches = 64
@@ -72,13 +194,17 @@ def main():
 
     logger.info("Getting items list")
     all_data = list(triple2ids.items())
+    del triple2ids
 
     datasets = [{
         "batch": all_data[(i * batch_size):((i + 1) * batch_size)],
-        "output_file": output_dir / f"{i:03d}-of-{num_batches:03d}.csv.gz"
+        "output_file": get_triple_file(output_dir, f"{i:03d}-of-{num_batches:03d}", args.format),
+        "min_freq": args.min_freq,
+        "packed_ids": args.packed_ids,
     } for i in range(num_batches)]
 
-    with Pool(64) as p:
+    # fork: the workers share the vocabulary with this process instead of receiving a copy
+    with get_context("fork").Pool(64) as p:
         p.map(write_results, datasets)
 
     logger.info("Done")
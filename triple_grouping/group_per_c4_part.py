@@ -1,10 +1,12 @@
 import argparse
-import csv
-import gzip
 import logging
-from pathlib import Path
+import sys
+from array import array
 
 from app_config import WORKING_DIR
+from triple_filtering.assertion_reader import parse_id, format_id_list
+from triple_filtering.triple_io import FORMATS, find_triple_file, get_triple_file, is_parquet, read_triples, \
+    write_triples
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(processName)s] [%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -18,40 +20,42 @@ def main():
     parser.add_argument("--file_idx", type=int, required=True)
     parser.add_argument("--in_dir", type=str, default=f"{WORKING_DIR}/relevant_triples")
     parser.add_argument("--out_dir", type=str, default=f"{WORKING_DIR}/grouped_triples")
+    parser.add_argument("--packed_ids", action="store_true",
+                        help="Write assertion IDs as delta-encoded packed integers "
+                             "(integer lists in Parquet files)")
+    parser.add_argument("--format", type=str, choices=FORMATS, default="csv")
 
     args = parser.parse_args()
 
-    input_file = Path(args.in_dir) / f"c4-train.{args.file_idx:05d}-of-01024.csv.gz"
+    input_file = find_triple_file(args.in_dir, f"c4-train.{args.file_idx:05d}-of-01024")
     logger.info(f"Reading triples from \"{input_file}\"")
-    with gzip.open(input_file, "rt") as f:
-        reader = csv.DictReader((line.replace('\0', '') for line in f))
-        triples = [row for row in reader]
+    triples = read_triples(input_file)
     logger.info(f"There are {len(triples):,} triples")
 
     logger.info("Grouping")
+    # Interned: the keys of all triples share one copy of each string, and the rows are freed below
     triple2ids = {}
     for t in triples:
-        tup = (t["subject"], t["predicate"], t["object"], t["subject_type"], t["super_subject"])
+        tup = tuple(sys.intern(t[k]) for k in ["subject", "predicate", "object", "subject_type", "super_subject"])
         if tup not in triple2ids:
-            triple2ids[tup] = []
-        triple2ids[tup].append(t["assertion_id"])
+            triple2ids[tup] = array("q")
+        triple2ids[tup].append(parse_id(str(t["assertion_id"])))
+    del triples
     logger.info(f"There are {len(triple2ids):,} unique triples")
 
-    output_file = Path(args.out_dir) / f"c4-train.{args.file_idx:05d}-of-01024.csv.gz"
+    output_file = get_triple_file(args.out_dir, f"c4-train.{args.file_idx:05d}-of-01024", args.format)
     logger.info(f"Writing to \"{output_file}\"")
-    with gzip.open(output_file, "wt") as f:
-        writer = csv.DictWriter(f, fieldnames=["subject", "predicate", "object", "assertion_ids", "subject_type",
-                                               "super_subject"])
-        writer.writeheader()
-        for t, ids in triple2ids.items():
-            writer.writerow({
-                "subject": t[0],
-                "predicate": t[1],
-                "object": t[2],
-                "assertion_ids": "|".join(ids),
-                "subject_type": t[3],
-                "super_subject": t[4],
-            })
+    rows = ({
+        "subject": t[0],
+        "predicate": t[1],
+        "object": t[2],
+        "assertion_ids": format_id_list(ids, packed=args.packed_ids, array=is_parquet(output_file)),
+        "count": len(ids),
+        "subject_type": t[3],
+        "super_subject": t[4],
+    } for t, ids in triple2ids.items())
+    write_triples(output_file, rows, fieldnames=["subject", "predicate", "object", "assertion_ids", "count",
+                                                 "subject_type", "super_subject"])
     logger.info("Done")
 
 
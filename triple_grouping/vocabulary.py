@@ -0,0 +1,104 @@
+import fcntl
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from app_config import WORKING_DIR
+
+logger = logging.getLogger(__name__)
+
+VOCABULARY_FILE = f"{WORKING_DIR}/vocabulary/strings.jsonl"
+
+
+# String <-> int ID table shared by subjects, predicates, objects, subject types and super subjects.
+# IDs are line numbers in the persisted file, which is only ever appended to, so IDs stay stable across runs.
+# group_all extends it; save() appends under an exclusive lock, so that concurrent runs cannot interleave lines.
+# Without a file, it is an in-memory table of one run.
+class Vocabulary(object):
+    def __init__(self, filename: Optional[Union[str, Path]] = None):
+        self.filename = Path(filename) if filename is not None else None
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.num_saved = 0
+        self.saved_offset = 0
+
+        if self.filename is not None and self.filename.exists():
+            logger.info(f"Reading vocabulary from \"{self.filename}\"")
+            with open(self.filename) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                self._read_saved(f)
+            logger.info(f"Vocabulary size: {len(self.strings):,}")
+
+    def __len__(self):
+        return len(self.strings)
+
+    def encode(self, s: str) -> int:
+        # adds unknown strings; find_tuple() only looks up
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.ids[s] = i
+            self.strings.append(s)
+        return i
+
+    def decode(self, i: int) -> str:
+        return self.strings[i]
+
+    def encode_tuple(self, tup: Sequence[str]) -> Tuple[int, ...]:
+        return tuple(self.encode(s) for s in tup)
+
+    def find_tuple(self, tup: Sequence[str]) -> Optional[Tuple[int, ...]]:
+        # like encode_tuple(), but without adding unknown strings
+        ids = tuple(self.ids.get(s) for s in tup)
+        if None in ids:
+            return None
+        return ids
+
+    def decode_tuple(self, tup: Sequence[int]) -> Tuple[str, ...]:
+        return tuple(self.strings[i] for i in tup)
+
+    def _read_saved(self, f):
+        # lines appended since the last read, by this or another process
+        f.seek(self.saved_offset)
+        for line in iter(f.readline, ""):
+            self.encode(json.loads(line))
+        self.saved_offset = f.tell()
+        self.num_saved = len(self.strings)
+
+    def save(self) -> Dict[int, int]:
+        # Appends the strings added since the last save. Strings that other processes appended in the meantime
+        # are read first and keep their IDs, so new strings of this process may get other IDs than they had.
+        # Returns old ID -> new ID for these; callers still holding old IDs remap them with remap_tuple().
+        assert self.filename is not None
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.filename, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            unsaved = self.strings[self.num_saved:]
+            del self.strings[self.num_saved:]
+            for s in unsaved:
+                del self.ids[s]
+            old_num_saved = self.num_saved
+            self._read_saved(f)
+
+            remap = {}
+            for old, s in enumerate(unsaved, start=old_num_saved):
+                new = self.encode(s)
+                if new != old:
+                    remap[old] = new
+
+            logger.info(f"Appending {(len(self.strings) - self.num_saved):,} new strings to \"{self.filename}\" "
+                        f"({(self.num_saved - old_num_saved):,} appended by other processes)")
+            for s in self.strings[self.num_saved:]:
+                f.write(json.dumps(s))
+                f.write("\n")
+            f.flush()
+            self.saved_offset = f.tell()
+            self.num_saved = len(self.strings)
+
+        return remap
+
+
+def remap_tuple(tup: Tuple[int, ...], remap: Dict[int, int]) -> Tuple[int, ...]:
+    return tuple(remap.get(i, i) for i in tup)